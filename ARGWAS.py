@@ -13,6 +13,8 @@ import TVariants as tvar
 import TIndividuals as tind
 import TSimulator as tsim
 import TTree as tt
+import TScratch
+import TGCTA
 from python_log_indenter import IndentedLoggerAdapter
 import logging
 import os
@@ -220,8 +222,11 @@ if args.task == "associate":
 
     pheno = pt.Phenotypes(variants=variants_orig, inds=inds, logfile=logger)
 
-    pheno.simulate(args=args, r=r, logfile=logger, variants_orig=variants_orig, trees=trees, inds=inds,
-                   plots_dir=plots_dir)
+    if args.pheno_file is None:
+        pheno.simulate(args=args, r=r, logfile=logger, variants_orig=variants_orig, trees=trees, inds=inds,
+                       plots_dir=plots_dir)
+    else:
+        pheno.read_from_file(file=args.pheno_file, logfile=logger)
     logger.sub()
 
     # --------------------------------
@@ -251,7 +256,9 @@ if args.task == "associate":
 
         if args.AIM_method is None:
             raise ValueError("ERROR: No method for tree association provided. Use '--AIM_method' to set method.")
-        if args.covariance_type is None:
+        if args.covariance_type is None and (
+                "HE" in args.AIM_method or "REML" in args.AIM_method or "score" in args.AIM_method
+                or "screen" in args.AIM_method):
             raise ValueError(
                 "ERROR: No method for covariance calculation provided. Use '--covariance_type' to set method.")
 
@@ -259,33 +266,70 @@ if args.task == "associate":
 
         pheno.find_causal_trees(trees)
 
+        # windows of trees that are tested instead of single trees
+        windows = None
+        if sum(size is not None for size in [args.window_bp, args.window_trees, args.window_variants]) > 1:
+            raise ValueError("ERROR: Only one of '--window_bp', '--window_trees' and '--window_variants' can be set")
+        if args.window_bp is not None:
+            windows = tt.TTrees.windows_bp(trees, args.window_bp, args.window_step)
+        elif args.window_trees is not None:
+            windows = tt.TTrees.windows_trees(trees, args.window_trees,
+                                              None if args.window_step is None else int(args.window_step))
+        elif args.window_variants is not None:
+            windows = tt.TTrees.windows_variants(trees, variants, args.window_variants,
+                                                 None if args.window_step is None else int(args.window_step))
+        if args.fwer_permutations > 0:
+            if args.test_only_tree_at is not None:
+                raise ValueError("ERROR: '--fwer_permutations' cannot be combined with '--test_only_tree_at'")
+            if "screen" in args.AIM_method:
+                raise ValueError("ERROR: '--fwer_permutations' cannot be combined with '--AIM_method screen'")
+        if windows is not None:
+            if args.test_only_tree_at is not None:
+                raise ValueError("ERROR: Windows cannot be combined with '--test_only_tree_at'")
+            if args.low_memory_covariance:
+                raise ValueError("ERROR: Windows cannot be combined with '--low_memory_covariance'")
+            logger.info("- Testing " + str(len(windows)) + " windows instead of single trees")
+
+        # intermediate files of each tree, the phenotypes are written once for all methods that run GCTA
+        scratch = TScratch.TScratch(args.out, directory=args.scratch_dir)
+        logger.info("- Writing intermediate files to '" + scratch.path + "'")
+        if args.AIM_engine == "gcta" and (
+                "HE" in args.AIM_method or "REML" in args.AIM_method or "screen" in args.AIM_method):
+            if args.covariance_type == "eGRM" or args.covariance_type == "GRM":
+                pheno.write_to_file_gcta_eGRM(inds=inds, out=scratch.prefix, logfile=logger)
+            else:
+                pheno.write_to_file_gcta_scaled(out=scratch.prefix, logfile=logger)
+        gcta = TGCTA.TGCTA(executable=args.gcta_executable, timeout=args.gcta_timeout, retries=args.gcta_retries)
+
         for m in args.AIM_method:
 
             if m == "HE":
 
                 if args.test_only_tree_at is None:
-                    logger.info("- Running associations test using GCTA Haseman-Elston for a sequence of trees")
+                    logger.info("- Running associations test using Haseman-Elston (" + args.AIM_engine
+                                + ") for a sequence of trees")
                 else:
-                    logger.info("- Running associations test using GCTA Haseman-Elston for a single tree")
+                    logger.info("- Running associations test using Haseman-Elston (" + args.AIM_engine
+                                + ") for a single tree")
                 logger.add()
-                treeWAS = gwas.TAssociationTesting_trees_gcta_HE(trees, pheno)
-
-                # write phenotypes in gcta format
-                if args.covariance_type == "eGRM" or args.covariance_type == "GRM":
-                    pheno.write_to_file_gcta_eGRM(inds=inds, out=args.out, logfile=logger)
-                else:
-                    pheno.write_to_file_gcta_scaled(out=args.out, logfile=logger)
+                treeWAS = gwas.TAssociationTesting_trees_gcta_HE(trees, pheno, engine=args.AIM_engine, windows=windows,
+                                                                 gcta=gcta, permutations=args.fwer_permutations,
+                                                                 seed=args.seed, alpha=args.fwer_alpha)
 
                 # run association
                 if args.test_only_tree_at is None:
                     treeWAS.run_association(ts_object=trees, variants=variants, inds=inds, out=args.out, logfile=logger,
-                                            covariance_type=args.covariance_type, skip_first_tree=args.skip_first_tree)
+                                            covariance_type=args.covariance_type, skip_first_tree=args.skip_first_tree,
+                                            low_memory=args.low_memory_covariance, workers=args.workers,
+                                            resume=args.resume, scratch=scratch)
                 else:
                     tree = trees.at(args.test_only_tree_at)
                     tree_obj = tt.TTree(tree)
                     treeWAS.run_association_one_tree(ts_object=trees, variants=variants, tree_obj=tree_obj, inds=inds,
-                                                     out=args.out, logfile=logger, covariance_type=args.covariance_type,
-                                                     skip_first_tree=args.skip_first_tree)
+                                                     out=scratch.prefix, logfile=logger,
+                                                     covariance_type=args.covariance_type,
+                                                     skip_first_tree=args.skip_first_tree,
+                                                     low_memory=args.low_memory_covariance)
 
                 treeWAS.write_to_file(trees, args.out, logger)
                 logger.sub()
@@ -293,33 +337,105 @@ if args.task == "associate":
             if m == "REML":
 
                 if args.test_only_tree_at is None:
-                    logger.info("- Running associations test using GCTA REML for a sequence of trees")
+                    logger.info("- Running associations test using REML (" + args.AIM_engine
+                                + ") for a sequence of trees")
                 else:
-                    logger.info("- Running associations test using GCTA REML for a single tree")
+                    logger.info("- Running associations test using REML (" + args.AIM_engine + ") for a single tree")
                 logger.add()
-                treeWAS = gwas.TAssociationTesting_trees_gcta_REML(trees, pheno)
+                treeWAS = gwas.TAssociationTesting_trees_gcta_REML(trees, pheno, engine=args.AIM_engine,
+                                                                   windows=windows, gcta=gcta,
+                                                                   permutations=args.fwer_permutations,
+                                                                   seed=args.seed, alpha=args.fwer_alpha)
 
-                # write phenotypes in gcta format
-                if args.covariance_type == "eGRM" or args.covariance_type == "GRM":
-                    pheno.write_to_file_gcta_eGRM(inds=inds, out=args.out, logfile=logger)
+                # run association
+                if args.test_only_tree_at is None:
+                    treeWAS.run_association(ts_object=trees, variants=variants, inds=inds, out=args.out, logfile=logger,
+                                            covariance_type=args.covariance_type, skip_first_tree=args.skip_first_tree,
+                                            low_memory=args.low_memory_covariance, workers=args.workers,
+                                            resume=args.resume, scratch=scratch)
                 else:
-                    pheno.write_to_file_gcta_scaled(out=args.out, logfile=logger)
+                    tree = trees.at(args.test_only_tree_at)
+                    tree_obj = tt.TTree(tree)
+                    treeWAS.run_association_one_tree(ts_object=trees, variants=variants, tree_obj=tree_obj, inds=inds,
+                                                     out=scratch.prefix, logfile=logger,
+                                                     covariance_type=args.covariance_type,
+                                                     skip_first_tree=args.skip_first_tree,
+                                                     low_memory=args.low_memory_covariance)
+
+                treeWAS.write_to_file(trees, args.out, logger)
+
+                logger.sub()
+
+            if m == "score":
+
+                if args.test_only_tree_at is None:
+                    logger.info("- Running associations test using the variance-component score test for a sequence "
+                                "of trees")
+                else:
+                    logger.info("- Running associations test using the variance-component score test for a single "
+                                "tree")
+                logger.add()
+                treeWAS = gwas.TAssociationTesting_trees_score(trees, pheno, windows=windows,
+                                                               permutations=args.fwer_permutations, seed=args.seed,
+                                                               alpha=args.fwer_alpha)
 
                 # run association
                 if args.test_only_tree_at is None:
                     treeWAS.run_association(ts_object=trees, variants=variants, inds=inds, out=args.out, logfile=logger,
-                                            covariance_type=args.covariance_type, skip_first_tree=args.skip_first_tree)
+                                            covariance_type=args.covariance_type, skip_first_tree=args.skip_first_tree,
+                                            low_memory=args.low_memory_covariance, workers=args.workers,
+                                            resume=args.resume, scratch=scratch)
                 else:
                     tree = trees.at(args.test_only_tree_at)
                     tree_obj = tt.TTree(tree)
                     treeWAS.run_association_one_tree(ts_object=trees, variants=variants, tree_obj=tree_obj, inds=inds,
-                                                     out=args.out, logfile=logger, covariance_type=args.covariance_type,
-                                                     skip_first_tree=args.skip_first_tree)
+                                                     out=scratch.prefix, logfile=logger,
+                                                     covariance_type=args.covariance_type,
+                                                     skip_first_tree=args.skip_first_tree,
+                                                     low_memory=args.low_memory_covariance)
+
+                treeWAS.write_to_file(trees, args.out, logger)
+
+                logger.sub()
+
+            if m == "screen":
 
+                logger.info("- Running associations test using " + args.screen_method + " to screen and REML ("
+                            + args.AIM_engine + ") to test the selected trees for a sequence of trees")
+                logger.add()
+                if args.test_only_tree_at is not None:
+                    raise ValueError("ERROR: Screening cannot be combined with '--test_only_tree_at'")
+                treeWAS = gwas.TAssociationTesting_trees_screen(trees, pheno, screen_method=args.screen_method,
+                                                                engine=args.AIM_engine, windows=windows,
+                                                                p_value_threshold=args.screen_p_value,
+                                                                top=args.screen_top,
+                                                                neighbours=args.screen_neighbours, gcta=gcta)
+
+                treeWAS.run_association(ts_object=trees, variants=variants, inds=inds, out=args.out, logfile=logger,
+                                        covariance_type=args.covariance_type, skip_first_tree=args.skip_first_tree,
+                                        low_memory=args.low_memory_covariance, workers=args.workers,
+                                        resume=args.resume, scratch=scratch)
+                treeWAS.write_to_file(trees, args.out, logger)
+
+                logger.sub()
+
+            if m == "Mantel":
+
+                logger.info("- Running associations test using Mantel test with " + str(args.mantel_permutations)
+                            + " permutations for a sequence of trees")
+                logger.add()
+                if windows is not None:
+                    raise ValueError("ERROR: The Mantel test cannot be run on windows")
+                treeWAS = gwas.TTreeAssociation_Mantel(trees, pheno)
+                treeWAS.run_association(ts_object=trees, inds=inds, logfile=logger,
+                                        skip_first_tree=args.skip_first_tree,
+                                        num_permutations=args.mantel_permutations, seed=args.seed,
+                                        exceedances=args.mantel_exceedances)
                 treeWAS.write_to_file(trees, args.out, logger)
 
                 logger.sub()
 
+        scratch.cleanup()
         logger.sub()
 
         logger.info("- Done running association tests")
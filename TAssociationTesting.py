@@ -8,16 +8,21 @@ Created on Mon Aug 16 17:37:12 2021
 import numpy as np
 import statsmodels.api as sm
 import scipy
+import scipy.stats
 import TTree as tt
+import variance_components as vc
+import TMantel
+import TGCTA
+import tskit
 # from limix_lmm.lmm_core import LMMCore
 import utils as ut
 import time
 import pandas as pd
 import matplotlib.pyplot as plt
-import subprocess
 import os
-import sys
-import struct
+import shutil
+import glob
+import multiprocessing
 
 
 class TAssociationTesting:
@@ -60,23 +65,52 @@ class TAssociationTesting_GWAS(TAssociationTesting):
         self.num_typed_variants = num_typed_variants
         self.num_associations = self.num_typed_variants
         # self._check_compatibility(ts_object, phenotypes)
-        self.p_values = np.empty(self.num_associations)
+        # one column of p-values per phenotype if the phenotypes are a matrix
+        if self.phenotypes.num_phenotypes == 1:
+            self.p_values = np.empty(self.num_associations)
+        else:
+            self.p_values = np.empty((self.num_associations, self.phenotypes.num_phenotypes))
 
-    def OLS(self, variants, inds, logfile):
-        # counter respective to typed variants
-        i = 0
-        for v, variant in enumerate(variants.variants):
-            if variants.info.iloc[v]['typed']:
-                if inds.ploidy == 2:
-                    genotypes = inds.get_diploid_genotypes(variant.genotypes)
-                else:
-                    genotypes = variant.genotypes
+    def OLS(self, variants, inds, logfile, block_size=2000):
+        """
+        Simple linear regression of the phenotype on each typed variant, with intercept. The genotypes are decoded
+        in blocks of variants and the slopes, their standard errors and the p-values of the t-tests are calculated in
+        closed form for the whole block. If the phenotypes are a matrix (num_inds x num_phenotypes), all of them are
+        tested with the same decoded genotypes. Variants without variation among the individuals get a nan p-value.
+
+        :param variants: TVariants
+        :param inds: TInds
+        :param logfile:
+        :param block_size: int, number of variants per block
+        """
+        typed = np.flatnonzero(variants.info['typed'].to_numpy(dtype=bool))
+        if inds.ploidy == 2:
+            incidence_transposed = inds.get_incidence_matrix().T.tocsr()
+
+        # phenotypes as columns of a matrix
+        y = self.phenotypes.y.reshape(self.phenotypes.num_inds, -1)
+        y = y - np.mean(y, axis=0)
+        Syy = np.sum(y ** 2, axis=0)
+        degrees_of_freedom = y.shape[0] - 2
+
+        for start in range(0, len(typed), block_size):
+            end = min(start + block_size, len(typed))
+            genotypes = np.column_stack([variants.variants[v].genotypes for v in typed[start:end]]).astype(float)
+            if inds.ploidy == 2:
+                genotypes = incidence_transposed @ genotypes
+
+            genotypes -= np.mean(genotypes, axis=0)
+            Sxx = np.einsum('ij,ij->j', genotypes, genotypes)[:, np.newaxis]
+            Sxy = genotypes.T @ y
+            with np.errstate(divide='ignore', invalid='ignore'):
+                betas = Sxy / Sxx
+                residual_sum_of_squares = np.maximum(Syy - betas * Sxy, 0.0)
+                standard_errors = np.sqrt(residual_sum_of_squares / degrees_of_freedom / Sxx)
+                t_values = betas / standard_errors
+            p_values = 2 * scipy.stats.t.sf(np.abs(t_values), degrees_of_freedom)
+            p_values[Sxx[:, 0] == 0, :] = np.nan
+            self.p_values[start:end] = p_values.reshape(self.p_values[start:end].shape)
 
-                # add intercept
-                genotypes_test = sm.tools.add_constant(genotypes)
-                PVALUE = sm.OLS(self.phenotypes.y, genotypes_test).fit().pvalues[1]
-                self.p_values[i] = PVALUE
-                i += 1
         logfile.info("- Ran OLS for " + str(variants.number_typed) + " variants")
 
     def write_to_file(self, variants, name, logfile):
@@ -89,7 +123,12 @@ class TAssociationTesting_GWAS(TAssociationTesting):
         table['start'] = info_typed['position']
         table['end'] = info_typed['position']
         # table['typed'] = variants.info['typed']
-        table['p_value'] = self.p_values
+        if self.p_values.ndim == 1:
+            table['p_value'] = self.p_values
+        else:
+            p_values = pd.DataFrame(self.p_values, index=table.index,
+                                    columns=['p_value_' + str(k) for k in range(self.p_values.shape[1])])
+            table = pd.concat([table, p_values], axis=1)
         # table['causal'] = np.repeat("FALSE", self.num_associations)
         # table.loc[self.phenotypes.causal_variant_indeces, 'causal'] = "TRUE"
         # table['betas'] = self.phenotypes.betas 
@@ -138,7 +177,8 @@ class TAssociationTesting_GWAS(TAssociationTesting):
         if index_max > len(self.p_values) or index_min > len(self.p_values):
             raise ValueError("data subset index cannot be larger than number of p-values")
 
-        p_values = self.p_values
+        # with several phenotypes, plot the first one
+        p_values = self.p_values if self.p_values.ndim == 1 else self.p_values[:, 0]
         p_values[(np.where(p_values == 0.0))] = np.nextafter(0, 1)
         q_values = -np.log10(p_values)
 
@@ -178,6 +218,8 @@ class TAssociationTesting_trees(TAssociationTesting):
         super().__init__(phenotypes)
 
         self.num_associations = ts_object.num_trees
+        # p-value threshold of genome-wide significance, e.g. from permutations. Bonferroni if None
+        self.significance_threshold = None
         # self._check_compatibility(ts_object, phenotypes)
 
     def manhattan_plot(self, variant_positions, subplot, logfile, *args):
@@ -248,36 +290,540 @@ class TAssociationTesting_trees(TAssociationTesting):
                                           return_sorted=False)
             subplot.plot(variant_positions[index_min:index_max], low, color="red")
 
-        subplot.axhline(y=8, color="red", lw=0.5)
+        threshold = self.significance_threshold
+        if threshold is None:
+            threshold = 0.05 / self.num_associations
+        subplot.axhline(y=-np.log10(threshold), color="red", lw=0.5)
+
+
+# association test and arguments of run_association_interval, set before forking the worker processes
+_worker_state = None
+
+
+def _run_association_worker(interval):
+    association, kwargs = _worker_state
+    worker, start_index, end_index = interval
+
+    # separate checkpoint and separate prefix for the files written for GCTA, which also read the phenotypes from it
+    out = kwargs['out'] + "_worker" + str(worker)
+    phenotype_file = association.gcta_prefix(kwargs['out']) + "_phenotypes.phen"
+    if association.scratch is not None:
+        association.scratch = association.scratch.subdirectory("worker" + str(worker))
+    if os.path.exists(phenotype_file):
+        shutil.copyfile(phenotype_file, association.gcta_prefix(out) + "_phenotypes.phen")
+
+    association.run_association_interval(**dict(kwargs, out=out), start_index=start_index, end_index=end_index)
+
+    return association.get_results(start_index, end_index)
 
 
 class TAssociationTesting_trees_gcta(TAssociationTesting_trees):
     """
     tree-based asssociation testing using GCTA 
-    """
 
-    def __init__(self, ts_object, phenotypes):
+    With permutations, the family-wise error rate over all trees is controlled with the max-statistic (min-p) method
+    of Westfall and Young: the phenotypes are permuted B times, and for each permutation the smallest p-value over all
+    trees is kept. The permuted phenotypes are additional columns next to the phenotype replicates, so they are tested
+    in the same pass over the trees and share what is calculated once per tree (the covariance matrix, its
+    eigendecomposition for REML, the branch sums for HE with engine branches). The permutations are drawn from a
+    seeded stream before the trees are distributed over worker processes, so that they are the same in all of them.
+    """
+    # name of the method in output files
+    method = None
+    # engines the method can run with
+    engines = ["gcta", "native"]
+    # results whose p-values are adjusted with permutations
+    permutation_p_values = "p_values"
+    # whether the in-process test only needs products with the covariance, so that with low_memory it runs on the
+    # factored covariance of a tree (see TTree.get_covariance_factored) instead of a dense matrix
+    factored_covariance = False
+
+    def __init__(self, ts_object, phenotypes, engine="gcta", windows=None, gcta=None, permutations=0, seed=None,
+                 alpha=0.05):
+        """
+        :param engine: str, with engine "native", the tests run in-process on the covariance matrix instead of
+            calling GCTA
+        :param windows: np.array of dimension number of windows x 2, test genomic windows [start, end) instead of
+            single trees (see run_association_windows)
+        :param gcta: TGCTA, runs GCTA with engine "gcta". Default is TGCTA with its default settings
+        :param permutations: int, number of permutations B of the phenotypes for the family-wise threshold and the
+            adjusted p-values. No permutations if 0. Not possible with engine "gcta"
+        :param seed: int, seed of the permutations. A random seed is drawn if None
+        :param alpha: float, family-wise error rate of the significance threshold
+        """
         super().__init__(ts_object, phenotypes)
+        if engine not in self.engines:
+            raise ValueError("Did not recognize " + str(engine) + " as an engine to run the association tests")
+        self.engine = engine
+        self.gcta = gcta if gcta is not None else TGCTA.TGCTA()
+
+        # unit that is tested, used in the output file names
+        self.windows = windows
+        self.unit = "trees"
+        if windows is not None:
+            if engine == "branches":
+                raise ValueError("Engine 'branches' cannot test windows")
+            self.num_associations = len(windows)
+            self.unit = "windows"
+
+        # with several phenotypes (replicates), the results are matrices of dimension num_associations x replicates
+        self.num_replicates = phenotypes.num_phenotypes
+        self.result_shape = self.num_associations if self.num_replicates == 1 else (self.num_associations,
+                                                                                     self.num_replicates)
+
+        # permuted phenotypes as columns, the replicates of a permutation are next to each other, and the smallest
+        # p-value over the trees for each permutation and replicate
+        if permutations > 0 and engine == "gcta":
+            raise ValueError("Permutations are not implemented for engine 'gcta', use engine native or branches")
+        self.num_permutations = permutations
+        self.alpha = alpha
+        y = self.phenotypes.y.reshape(self.phenotypes.num_inds, -1)
+        random = np.random.default_rng(seed)
+        permuted = [y[random.permutation(self.phenotypes.num_inds)] for _ in range(permutations)]
+        self.permuted_y = np.hstack(permuted) if permutations > 0 else None
+        self.min_p_values_permuted = np.ones((permutations, self.num_replicates))
+
+        # trees (or windows) whose results were read from a checkpoint
+        self.trees_done = np.zeros(self.num_associations, dtype=bool)
+        # index of the earlier identical tree whose results were reused, -1 if the tree was tested
+        self.cached_from = np.full(self.num_associations, -1)
+        # why each tree is not tested, empty for the trees that are (see TTree.TTrees.skip_reasons)
+        self.skip_reasons = None
+        # trees (or windows) that are tested if only some are selected, e.g. by a screen
+        self.selected = None
+        # TScratch for the files written for GCTA
+        self.scratch = None
+
+    def run_association(self, ts_object, variants, inds, out, logfile, covariance_type, skip_first_tree,
+                        low_memory=False, workers=1, resume=False, selected=None, scratch=None):
+        """
+        Run association test for all trees. The results of each tree are appended to a checkpoint file as soon as
+        the tree is done (see open_checkpoint).
+
+        :param workers: int, number of processes the trees are distributed over. Each process tests a contiguous
+            interval of trees with its own output prefix (see run_association_parallel)
+        :param resume: bool, read the results from the checkpoint files of a previous run with the same output prefix
+            and only test the trees that are missing. Otherwise, existing checkpoint files are removed.
+        :param selected: np.array of bool, only test the trees (or windows) for which it is True. All are tested if
+            None
+        :param scratch: TScratch, directory of the files written for GCTA (see gcta_prefix). They are written next
+            to the output files if None
+        """
+        if resume and self.num_permutations > 0:
+            raise ValueError("Runs with permutations cannot be resumed, the checkpoints do not contain the permuted "
+                             "p-values")
+        self.selected = selected
+        self.scratch = scratch
+        if resume:
+            self.read_checkpoints(out=out, logfile=logfile)
+        else:
+            for file_name in self.checkpoint_files(out):
+                os.remove(file_name)
+
+        # find the trees that can be tested before building any of them
+        if self.windows is None:
+            scan = tt.TTrees.scan(ts_object, variants if covariance_type == "GRM" else None)
+            self.skip_reasons = tt.TTrees.skip_reasons(scan, covariance_type, skip_first_tree)
+            if selected is not None:
+                self.skip_reasons[(self.skip_reasons == "") & ~selected] = "not selected"
+            tt.TTrees.log_skipped(self.skip_reasons, logfile)
+
+            # with covariance_type scaled, the covariance only depends on the tree, a tree with the same covariance
+            # as an earlier tree gets its results instead of being tested again. This is decided for all trees
+            # before they are distributed, so that the results do not depend on the number of processes
+            if covariance_type == "scaled" and self.engine != "branches":
+                first_occurrences = tt.TTrees.first_occurrences(ts_object, self.skip_reasons == "")
+                cached = (first_occurrences != -1) & (first_occurrences != np.arange(self.num_associations))
+                self.cached_from[cached] = first_occurrences[cached]
+
+        if workers > 1:
+            self.run_association_parallel(ts_object=ts_object, variants=variants, inds=inds, out=out, logfile=logfile,
+                                          covariance_type=covariance_type, skip_first_tree=skip_first_tree,
+                                          low_memory=low_memory, workers=workers)
+        else:
+            self.run_association_interval(ts_object=ts_object, variants=variants, inds=inds, out=out,
+                                          logfile=logfile, covariance_type=covariance_type,
+                                          skip_first_tree=skip_first_tree, low_memory=low_memory, start_index=0,
+                                          end_index=self.num_associations)
+
+        cached = np.flatnonzero(self.cached_from != -1)
+        for index in cached:
+            self.copy_results(self.cached_from[index], index)
+        if len(cached) > 0:
+            logfile.info("- Reused the results of an identical earlier tree for " + str(len(cached)) + " trees")
+
+        if self.num_permutations > 0:
+            self.significance_threshold = self.family_wise_thresholds()[0]
+            logfile.info("- Family-wise significance threshold from " + str(self.num_permutations)
+                         + " permutations at alpha " + str(self.alpha) + ": p-value "
+                         + str(self.significance_threshold))
+
+        logfile.info("- Done running associations")
+
+    def run_association_interval(self, ts_object, variants, inds, out, logfile, covariance_type, skip_first_tree,
+                                 low_memory, start_index, end_index):
+        """
+        Run association test for the trees with start_index <= tree.index < end_index that are not done yet. Only
+        the trees that can be tested (see TTree.TTrees.skip_reasons) are built, the incremental engines pass the
+        others without calculating anything. The trees that get the results of an earlier tree (cached_from, see
+        run_association) are not tested, their results are copied once all intervals are done.
+        """
+        if self.windows is not None:
+            self.run_association_windows(ts_object=ts_object, inds=inds, out=out, logfile=logfile,
+                                         covariance_type=covariance_type, skip_first_tree=skip_first_tree,
+                                         low_memory=low_memory, start_index=start_index, end_index=end_index)
+            return
+
+        checkpoint = self.open_checkpoint(out)
 
-    def run_association(self, ts_object, variants, inds, out, logfile, covariance_type, skip_first_tree):
         # log progress
         start = time.time()
+        first_gcta_call = len(self.gcta.calls)
+
+        # the scaled covariance is derived from the haploid covariance, which can be updated from tree to tree
+        covariance_engine = None
+        branch_engine = None
+        if self.engine == "branches":
+            if covariance_type != "scaled" or inds.ploidy != 1:
+                raise ValueError("Engine 'branches' is only implemented for haploids and covariance_type scaled")
+            branch_engine = tt.TIncrementalBranchSums(ts_object=ts_object,
+                                                      y=vc.standardize(self.phenotype_columns()))
+        elif covariance_type == "scaled" and not (low_memory and (inds.ploidy == 2 or self.factored_covariance)):
+            covariance_engine = tt.TIncrementalCovariance(ts_object=ts_object)
+
+        if self.skip_reasons is None:
+            self.skip_reasons = tt.TTrees.skip_reasons(
+                tt.TTrees.scan(ts_object, variants if covariance_type == "GRM" else None), covariance_type,
+                skip_first_tree)
+        scheduled = start_index + np.flatnonzero(self.skip_reasons[start_index:end_index] == "")
+
+        tree = tskit.Tree(ts_object)
+        for i, index in enumerate(scheduled):
+            # the branch sums are updated for every tree, this is cheap
+            if branch_engine is not None:
+                while branch_engine.index < index:
+                    branch_engine.next_tree()
+            if covariance_engine is not None:
+                while covariance_engine.index < index - 1:
+                    covariance_engine.next_tree(skip=True)
+
+            if self.trees_done[index]:
+                if covariance_engine is not None:
+                    covariance_engine.next_tree(skip=True)
+                continue
+
+            if self.cached_from[index] != -1:
+                # the covariance is still updated, so that the next tree does not need to be built from scratch
+                if covariance_engine is not None:
+                    covariance_engine.next_tree()
+                continue
 
-        for tree in ts_object.trees():
+            tree.seek_index(index)
             tree_obj = tt.TTree(tree)
+            if covariance_engine is not None:
+                covariance_engine.next_tree()
+                if covariance_engine.is_valid():
+                    tree_obj.covariance = covariance_engine.get_covariance()
+
+            if branch_engine is not None:
+                if branch_engine.height != -1:
+                    self.run_association_one_tree_branches(tree_obj, branch_engine)
+            else:
+                self.run_association_one_tree(ts_object=ts_object, variants=variants, tree_obj=tree_obj, inds=inds,
+                                              out=self.gcta_prefix(out), logfile=logfile,
+                                              covariance_type=covariance_type, skip_first_tree=skip_first_tree,
+                                              low_memory=low_memory)
+            self.write_checkpoint(checkpoint, index)
 
-            self.run_association_one_tree(ts_object=ts_object, variants=variants, tree_obj=tree_obj, inds=inds, out=out,
-                                          logfile=logfile, covariance_type=covariance_type,
-                                          skip_first_tree=skip_first_tree)
             # log progress
-            if tree.index % 100 == 0:
+            if (i + 1) % 100 == 0:
                 end = time.time()
-                logfile.info("- Ran AIM for " + str(tree.index) + " trees in " + str(round(end - start)) + " s")
+                logfile.info("- Ran AIM for " + str(i + 1) + " of " + str(len(scheduled)) + " trees in "
+                             + str(round(end - start)) + " s")
 
-        logfile.info("- Done running associations")
+        self.log_gcta_calls(logfile, first_gcta_call)
+        checkpoint.close()
+
+    def run_association_windows(self, ts_object, inds, out, logfile, covariance_type, skip_first_tree, low_memory,
+                                start_index, end_index):
+        """
+        Run association test for the windows with start_index <= index < end_index that are not done yet. The
+        covariance of a window is the span-weighted mean of the haploid covariances of its trees (see
+        TTree.TWindowCovariance), summed over the haplotypes of each individual for diploids and scaled such that its
+        trace is the number of individuals. With skip_first_tree, the first tree is left out of the windows.
+        """
+        if covariance_type != "scaled":
+            raise ValueError("Windows are only implemented for covariance_type scaled")
+        if low_memory:
+            raise ValueError("Windows are built from the covariance between haplotypes, they cannot be combined with "
+                             "low_memory")
+
+        checkpoint = self.open_checkpoint(out)
+
+        # log progress
+        start = time.time()
+        first_gcta_call = len(self.gcta.calls)
+
+        indices = [i for i in range(start_index, end_index) if
+                   not self.trees_done[i] and (self.selected is None or self.selected[i])]
+        window_engine = tt.TWindowCovariance(ts_object=ts_object, windows=self.windows,
+                                             skip_first_tree=skip_first_tree)
+        for index, covariance in window_engine.covariances(indices):
+            window = tt.TTreeWindow(index, self.windows[index, 0], self.windows[index, 1])
+
+            if covariance is not None:
+                if inds.ploidy == 2:
+                    covariance = inds.get_diploid_matrix(covariance)
+                covariance *= float(inds.num_inds) / np.trace(covariance)
+
+                if self.engine == "native":
+                    self.run_association_one_tree_native(window, covariance)
+                else:
+                    self.write_covariance_matrix_to_gcta_file(covariance=covariance, mu=None, inds=inds,
+                                                              covariance_type=covariance_type,
+                                                              out=self.gcta_prefix(out))
+                    self.run_association_one_tree_gcta(window, self.gcta_prefix(out))
+            self.write_checkpoint(checkpoint, window.index)
+
+            # log progress
+            if window.index % 100 == 0:
+                end = time.time()
+                logfile.info("- Ran AIM for " + str(window.index) + " windows in " + str(round(end - start)) + " s")
+
+        self.log_gcta_calls(logfile, first_gcta_call)
+        checkpoint.close()
+
+    def run_association_parallel(self, ts_object, variants, inds, out, logfile, covariance_type, skip_first_tree,
+                                 low_memory, workers):
+        """
+        Distribute contiguous intervals of trees over a pool of processes. Each process writes its checkpoint to the
+        prefix out + "_worker" + index of the interval and its GCTA files to a subdirectory of the scratch directory
+        (or next to the checkpoint without scratch directory). It sends its results back, they are stored by tree
+        index.
+        The processes are forked, so that they inherit the tree sequence and the variants without pickling them.
+        """
+        global _worker_state
+        _worker_state = (self, dict(ts_object=ts_object, variants=variants, inds=inds, out=out, logfile=logfile,
+                                    covariance_type=covariance_type, skip_first_tree=skip_first_tree,
+                                    low_memory=low_memory))
+
+        boundaries = np.linspace(0, self.num_associations, min(workers, self.num_associations) + 1).astype(int)
+        intervals = [(i, boundaries[i], boundaries[i + 1]) for i in range(len(boundaries) - 1)]
+        logfile.info("- Distributing " + str(self.num_associations) + " " + self.unit + " over " + str(len(intervals))
+                     + " processes")
+
+        with multiprocessing.get_context("fork").Pool(processes=len(intervals)) as pool:
+            for (_, start_index, end_index), results in zip(intervals,
+                                                             pool.map(_run_association_worker, intervals)):
+                self.set_results(start_index, end_index, results)
+
+        _worker_state = None
+
+    def log_gcta_calls(self, logfile, first_call=0):
+        """
+        Log the number, duration and failures of the GCTA calls from first_call on (see TGCTA.summary)
+        """
+        summary = self.gcta.summary(first_call)
+        if summary is not None:
+            logfile.info("- " + summary)
+
+    def gcta_prefix(self, out):
+        """
+        Prefix of the files written for GCTA (covariance matrix, phenotypes and GCTA output) of the run with output
+        prefix out, in the scratch directory if there is one.
+        """
+        if self.scratch is None:
+            return out
+        return self.scratch.prefix
+
+    def _result_names(self):
+        """
+        Names of the arrays holding results by tree index.
+        """
+        raise ValueError("function _result_names not implemented in base class")
+
+    def result_index(self, tree, replicate):
+        """
+        Index of the results of a tree and phenotype replicate in the result arrays
+        """
+        if self.num_replicates == 1:
+            return tree.index
+        return tree.index, replicate
+
+    def results_table(self, ts_object):
+        """
+        Table with the start and end of each tree (or window) and, in replicate mode, one row per tree and replicate
+        (replicates vary fastest, as in the flattened result arrays).
+        """
+        if self.windows is None:
+            breakpoints = ts_object.breakpoints(as_array=True)
+            starts = breakpoints[0:self.num_associations]
+            ends = breakpoints[1:self.num_associations + 1]
+        else:
+            starts = self.windows[:, 0]
+            ends = self.windows[:, 1]
+        table = pd.DataFrame()
+        table['start'] = np.repeat(starts, self.num_replicates)
+        table['end'] = np.repeat(ends, self.num_replicates)
+        if self.num_replicates > 1:
+            table['replicate'] = np.tile(np.arange(self.num_replicates), self.num_associations)
+        if self.windows is None:
+            # index of the earlier identical tree whose results were reused
+            cached_from = pd.array(np.repeat(self.cached_from, self.num_replicates), dtype="Int64")
+            cached_from[cached_from < 0] = pd.NA
+            table['cached_from'] = cached_from
+        return table
+
+    def causal_column(self, ts_object):
+        causal = np.repeat("FALSE", self.num_associations).astype(object)
+        if self.windows is None:
+            causal[self.phenotypes.causal_tree_indeces] = "TRUE"
+        else:
+            # windows overlapping a causal tree
+            breakpoints = ts_object.breakpoints(as_array=True)
+            for tree_index in self.phenotypes.causal_tree_indeces:
+                overlapping = (self.windows[:, 0] < breakpoints[tree_index + 1]) & (
+                        self.windows[:, 1] > breakpoints[tree_index])
+                causal[overlapping] = "TRUE"
+        return np.repeat(causal, self.num_replicates)
+
+    def checkpoint_files(self, out):
+        """
+        Checkpoint files of the run with output prefix out, including the ones of the worker processes
+        """
+        file_name = "_" + self.unit + "_" + self.method + "_checkpoint.csv"
+        return glob.glob(glob.escape(out) + file_name) + glob.glob(glob.escape(out) + "_worker*" + file_name)
+
+    def checkpoint_columns(self):
+        if self.num_replicates == 1:
+            return ["cached_from"] + self._result_names()
+        return ["cached_from"] + [name + "_" + str(k) for name in self._result_names() for k in
+                                  range(self.num_replicates)]
+
+    def open_checkpoint(self, out):
+        """
+        Open the checkpoint file of output prefix out for appending. The file has one line per tree with its index
+        and results. A last line that was not completely written before the run was interrupted is removed.
+
+        :param out: str
+        :return: file object
+        """
+        file_name = out + "_" + self.unit + "_" + self.method + "_checkpoint.csv"
+        if os.path.exists(file_name):
+            with open(file_name, "rb+") as f:
+                content = f.read()
+                f.truncate(content.rfind(b"\n") + 1)
+        new_file = not os.path.exists(file_name) or os.path.getsize(file_name) == 0
+
+        checkpoint = open(file_name, "a")
+        if new_file:
+            checkpoint.write(",".join(["tree_index"] + self.checkpoint_columns()) + "\n")
+        return checkpoint
+
+    def write_checkpoint(self, checkpoint, tree_index):
+        # repr of floats is exact, so that resumed results are identical
+        values = [str(tree_index), str(self.cached_from[tree_index])] + [
+            repr(float(v)) for name in self._result_names() for v in np.atleast_1d(getattr(self, name)[tree_index])]
+        checkpoint.write(",".join(values) + "\n")
+        checkpoint.flush()
+
+    def read_checkpoints(self, out, logfile):
+        """
+        Fill the result arrays with the results in the checkpoint files of output prefix out and mark these trees
+        as done. Incomplete lines are ignored.
+        """
+        columns = self.checkpoint_columns()
+        names = self._result_names()
+        for file_name in self.checkpoint_files(out):
+            with open(file_name) as f:
+                header = f.readline()
+                if not header.endswith("\n"):
+                    continue
+                if header.rstrip("\n").split(",")[1:] != columns:
+                    raise ValueError("Checkpoint file '" + file_name + "' does not contain the results of "
+                                     + self.method + " for " + str(self.num_replicates) + " phenotype(s)")
+                for line in f:
+                    fields = line.rstrip("\n").split(",")
+                    if not line.endswith("\n") or len(fields) != len(columns) + 1:
+                        continue
+                    tree_index = int(fields[0])
+                    self.cached_from[tree_index] = int(fields[1])
+                    values = np.array(fields[2:], dtype=float).reshape(len(names), self.num_replicates)
+                    for name, value in zip(names, values):
+                        getattr(self, name)[tree_index] = value if self.num_replicates > 1 else value[0]
+                    self.trees_done[tree_index] = True
+
+        logfile.info("- Resuming from checkpoint, " + str(np.sum(self.trees_done)) + " of " + str(
+            self.num_associations) + " trees are done")
+
+    def get_results(self, start_index, end_index):
+        results = {name: getattr(self, name)[start_index:end_index] for name in self._result_names() + ["cached_from"]}
+        results["min_p_values_permuted"] = self.min_p_values_permuted
+        return results
+
+    def set_results(self, start_index, end_index, results):
+        for name in self._result_names() + ["cached_from"]:
+            getattr(self, name)[start_index:end_index] = results[name]
+        # the smallest p-values of a permutation are combined over the intervals of the worker processes
+        self.min_p_values_permuted = np.fmin(self.min_p_values_permuted, results["min_p_values_permuted"])
+
+    def phenotype_columns(self):
+        """
+        Phenotype replicates as columns, followed by the permuted phenotypes (see permuted_y)
+        """
+        y = self.phenotypes.y.reshape(self.phenotypes.num_inds, -1)
+        if self.num_permutations == 0:
+            return y
+        return np.hstack([y, self.permuted_y])
+
+    def update_permutations(self, p_values):
+        """
+        Keep the smallest p-value over the trees of each permutation and replicate.
+
+        :param p_values: np.array with the p-values of a tree for the columns of permuted_y
+        """
+        self.min_p_values_permuted = np.fmin(self.min_p_values_permuted,
+                                             np.reshape(p_values, (self.num_permutations, self.num_replicates)))
+
+    def family_wise_thresholds(self):
+        """
+        p-value threshold of each phenotype that controls the family-wise error rate over all trees at alpha, the
+        alpha quantile of the smallest p-values of the permutations.
+        """
+        return np.quantile(self.min_p_values_permuted, self.alpha, axis=0)
+
+    def adjusted_p_values(self):
+        """
+        Single-step min-p adjusted p-values, the proportion of permutations (counting the observed phenotype as one)
+        whose smallest p-value over all trees is at most the p-value of the tree.
+        """
+        p_values = getattr(self, self.permutation_p_values).reshape(self.num_associations, self.num_replicates)
+        adjusted = np.full(p_values.shape, np.nan)
+        for k in range(self.num_replicates):
+            min_p_values = np.sort(self.min_p_values_permuted[:, k])
+            tested = ~np.isnan(p_values[:, k])
+            counts = np.searchsorted(min_p_values, p_values[tested, k], side='right')
+            adjusted[tested, k] = (counts + 1) / (self.num_permutations + 1.0)
+        return adjusted.reshape(self.result_shape)
+
+    def write_thresholds_to_file(self, name, logfile):
+        thresholds = pd.DataFrame({'phenotype': np.arange(self.num_replicates),
+                                   'permutations': self.num_permutations,
+                                   'alpha': self.alpha,
+                                   'p_value_threshold': self.family_wise_thresholds()})
+        file_name = name + "_" + self.unit + "_" + self.method + "_thresholds.csv"
+        thresholds.to_csv(file_name, index=False, header=True)
+        logfile.info("- Wrote family-wise significance thresholds to '" + file_name + "'")
+
+    def copy_results(self, from_index, to_index):
+        """
+        Copy the results of all phenotype replicates of tree from_index to tree to_index.
+        """
+        for name in self._result_names():
+            getattr(self, name)[to_index] = getattr(self, name)[from_index]
 
     def run_association_one_tree(self, ts_object, variants, tree_obj, inds, out, logfile, covariance_type,
-                                 skip_first_tree):
+                                 skip_first_tree, low_memory=False):
         """
         :param ts_object: TreeSequence
         :param variants: TVariants
@@ -287,6 +833,7 @@ class TAssociationTesting_trees_gcta(TAssociationTesting_trees):
         :param logfile:
         :param covariance_type: str
         :param skip_first_tree: bool
+        :param low_memory: bool
         :return:
         """
         # logfile.info("starting association testing for tree with corrdinates: " + str(tree.interval.left) + ",
@@ -296,61 +843,52 @@ class TAssociationTesting_trees_gcta(TAssociationTesting_trees):
         #  from zero to the first tree. This causes problems with eGRM. Needs to be investigated what the problem is
         #  and a better condition needs to be found!
         if tree_obj.height != -1 and not (skip_first_tree and tree_obj.index == 0):
-            # TODO: calculating and writing should be separate functions, only write if tree is valid and matrix is
-            #  not empty. Only possible to do this when eGRM functionality runs internally
-            covariance = self.calculate_and_write_covariance_matrix_to_gcta_file(ts_object=ts_object, variants=variants,
-                                                                                 tree_obj=tree_obj, inds=inds,
-                                                                                 covariance_type=covariance_type,
-                                                                                 out=out, logfile=logfile,
-                                                                                 skip_first_tree=skip_first_tree)
-            if covariance is not None:
+            covariance, mu = self.calculate_covariance_matrix(ts_object=ts_object, variants=variants,
+                                                              tree_obj=tree_obj, inds=inds,
+                                                              covariance_type=covariance_type, out=out,
+                                                              logfile=logfile, skip_first_tree=skip_first_tree,
+                                                              low_memory=low_memory)
+            if covariance is None:
+                return
+
+            # a single tree is tested on its covariance matrix also with engine "branches"
+            if self.engine != "gcta":
+                self.run_association_one_tree_native(tree_obj, covariance)
+            else:
+                self.write_covariance_matrix_to_gcta_file(covariance=covariance, mu=mu, inds=inds,
+                                                          covariance_type=covariance_type, out=out)
                 self.run_association_one_tree_gcta(tree_obj, out)
 
     @staticmethod
-    def write_covariance_matrix_R(covariance, out):
-        with open(out + '_GRM_covariance.txt', 'w') as f:
-            np.savetxt(f, covariance)
-        f.close()
-
-        subprocess.call(["Rscript", os.path.dirname(sys.argv[0]) + "/create_gcta_GRM.R", out])
-
-    @staticmethod
-    def write_covariance_matrix_bin(covariance, mu, inds, out):
+    def write_covariance_matrix_bin(covariance, mu, family_ids, individual_ids, out):
         """
-        Write out eGRM in GCTA binary format.
+        Write out covariance matrix in GCTA binary format.
         :param: covariance numpy.ndarray of expected relatedness
         :param: mu floating point number of expected mutations
-        :param: numpy.ndarray/list of individual IDs
+        :param: family_ids numpy.ndarray/list of family IDs
+        :param: individual_ids numpy.ndarray/list of individual IDs
         :param: str of output
         :returns: None
         """
         # K = prefix_path.grm.bin; relatedness diagonal + lower diagonal
         # mu = prefix_path.grm.N.bin; number of shared mutations between individuals on diagonal + lower diagonal
         # samples = prefix_path.grm.id; 2 column text = family_id individual_id
+        # the lower triangle row by row is what a boolean mask of the lower triangle selects in C order, written as
+        # native float32 like struct.pack("f")
         n, n = covariance.shape
-        with open("{}.grm.bin".format(out), "wb") as grmfile:
-            for idx in range(n):
-                for jdx in range(idx + 1):
-                    val = struct.pack("f", covariance[idx, jdx])
-                    grmfile.write(val)
-
-        with open("{}.grm.N.bin".format(out), "wb") as grmfile:
-            for idx in range(n):
-                for jdx in range(idx + 1):
-                    val = struct.pack("f", mu)
-                    grmfile.write(val)
+        lower_triangle = np.asarray(covariance)[np.tri(n, dtype=bool)]
+        lower_triangle.astype(np.float32).tofile("{}.grm.bin".format(out))
+
+        np.full(len(lower_triangle), mu, dtype=np.float32).tofile("{}.grm.N.bin".format(out))
 
         with open("{}.grm.id".format(out), "w") as grmfile:
-            for idx in range(n):
-                fid = 0
-                iid = inds.names[idx]
+            for fid, iid in zip(family_ids, individual_ids):
                 grmfile.write("\t".join([str(fid), str(iid)]) + os.linesep)
 
-    # TODO: could be static?
-    def calculate_and_write_covariance_matrix_to_gcta_file(self, ts_object, variants, tree_obj, inds, covariance_type,
-                                                           out, skip_first_tree, logfile):
+    def calculate_covariance_matrix(self, ts_object, variants, tree_obj, inds, covariance_type, out, skip_first_tree,
+                                    logfile, low_memory=False):
         """
-        Writes covariance and other files necessary to run gcta. The program egrm does that automatically, the scaled
+        Calculate the covariance matrix of a tree that is tested for association.
 
         Parameters
         ----------
@@ -362,6 +900,10 @@ class TAssociationTesting_trees_gcta(TAssociationTesting_trees):
         out : str
         skip_first_tree: bool
         logfile : IndentedLoggerAdapter
+        low_memory : bool
+            Build the diploid scaled covariance directly from the branches, see TTree.get_covariance_individuals. If
+            the test runs in-process on products with the covariance (factored_covariance), the scaled covariance is
+            not built at all and a TTree.TFactoredCovariance is returned instead
 
         Raises
         ------
@@ -370,18 +912,21 @@ class TAssociationTesting_trees_gcta(TAssociationTesting_trees):
 
         Returns
         -------
-        Covariance: ndarray(inds.num_inds, inds.num_inds).
-
+        Covariance: ndarray(inds.num_inds, inds.num_inds) or TFactoredCovariance, None for a GRM of a tree without
+            variants.
+        mu: number of variants (GRM) or expected number of mutations (eGRM), None for scaled covariance.
         """
         if covariance_type == "scaled":
-            covariance = tree_obj.get_covariance_scaled(inds=inds)
-            self.write_covariance_matrix_R(covariance=covariance, out=out)
+            if low_memory and self.engine != "gcta" and self.factored_covariance:
+                covariance = tree_obj.get_covariance_factored(inds=inds, scaled=True)
+            else:
+                covariance = tree_obj.get_covariance_scaled(inds=inds, low_memory=low_memory)
+            mu = None
 
         elif covariance_type == "eGRM":
             # trees = ts_object.keep_intervals(np.array([[tree_obj.start, tree_obj.end]]), simplify=True)
-            covariance, mu = tree_obj.get_eGRM(tskit_obj=ts_object, tree_obj=tree_obj, inds=inds, out=out, logfile=logfile,
-                                               skip_first_tree=skip_first_tree)
-            self.write_covariance_matrix_bin(covariance=covariance, mu=mu, inds=inds, out=out)
+            covariance, mu = tree_obj.get_eGRM(tskit_obj=ts_object, tree_obj=tree_obj, inds=inds, out=out,
+                                               logfile=logfile, skip_first_tree=skip_first_tree)
 
             # if np.trace(covariance) != inds.num_inds:
             # raise ValueError("Trace of matrix is not equal to the number of individuals. Was expecting " + str(
@@ -394,115 +939,198 @@ class TAssociationTesting_trees_gcta(TAssociationTesting_trees):
                 raise ValueError("GRM not implemented for diploids")
             covariance, mu = tree_obj.get_GRM(variants=variants, inds=inds, out=out, logfile=logfile)
             if covariance is None:
-                return None
+                return None, None
             if np.trace(covariance) != inds.num_inds:
                 logfile.info("Trace of matrix is not equal to the number of individuals. Was expecting " + str(
                     inds.num_inds) + " but obtained " + str(np.trace(covariance)))
-            self.write_covariance_matrix_bin(covariance=covariance, mu=mu, inds=inds, out=out)
 
         else:
             raise ValueError("Did not recognize " + str(covariance_type) + " as a covariance type")
 
-        return covariance
+        return covariance, mu
+
+    def write_covariance_matrix_to_gcta_file(self, covariance, mu, inds, covariance_type, out):
+        """
+        Writes covariance and other files necessary to run gcta.
+
+        Parameters
+        ----------
+        covariance : ndarray(inds.num_inds, inds.num_inds)
+        mu : float
+        inds : TInds
+        covariance_type : str
+        out : str
+        """
+        if covariance_type == "scaled":
+            # ids as in TPhenotypes.write_to_file_gcta_scaled, there are no variants to count
+            ids = np.arange(1, inds.num_inds + 1)
+            self.write_covariance_matrix_bin(covariance=covariance, mu=1, family_ids=ids, individual_ids=ids, out=out)
+        else:
+            self.write_covariance_matrix_bin(covariance=covariance, mu=mu, family_ids=np.repeat(0, inds.num_inds),
+                                             individual_ids=inds.names, out=out)
+
+    def gcta_phenotype(self, replicate):
+        """
+        Column of a phenotype replicate in the phenotype file for GCTA (--mpheno), None if there is only one
+        phenotype (see TPhenotypes.write_to_file_gcta_scaled)
+        """
+        return replicate + 1 if self.num_replicates > 1 else None
 
     def run_association_one_tree_gcta(self, tree, out):
         raise ValueError("function run_association_one_tree_gcta not implemented in base class")
 
+    def run_association_one_tree_native(self, tree, covariance):
+        raise ValueError("function run_association_one_tree_native not implemented in base class")
+
+    def run_association_one_tree_branches(self, tree, branch_sums):
+        raise ValueError("function run_association_one_tree_branches not implemented in base class")
+
 
 class TAssociationTesting_trees_gcta_HE(TAssociationTesting_trees_gcta):
     """
     tree-based association testing using GCTA Haseman-Elston algorithm
     """
+    method = "HE"
+    # with engine "branches", the HE statistics are calculated from the branches of the trees (haploids only)
+    engines = ["gcta", "native", "branches"]
+    # the jackknife is not calculated for the permuted phenotypes
+    permutation_p_values = "p_values_HECP_OLS"
+    # without the jackknife, which needs the dense covariance
+    factored_covariance = True
 
-    def __init__(self, ts_object, phenotypes):
+    def __init__(self, ts_object, phenotypes, engine="gcta", windows=None, gcta=None, permutations=0, seed=None,
+                 alpha=0.05):
 
-        super().__init__(ts_object, phenotypes)
+        super().__init__(ts_object, phenotypes, engine, windows, gcta, permutations, seed, alpha)
 
         # p-value containers
-        self.p_values_HECP_OLS = np.empty(self.num_associations)
+        self.p_values_HECP_OLS = np.empty(self.result_shape)
         self.p_values_HECP_OLS.fill(np.nan)
-        self.p_values_HECP_Jackknife = np.empty(self.num_associations)
+        self.p_values_HECP_Jackknife = np.empty(self.result_shape)
         self.p_values_HECP_Jackknife.fill(np.nan)
-        self.p_values_HESD_OLS = np.empty(self.num_associations)
+        self.p_values_HESD_OLS = np.empty(self.result_shape)
         self.p_values_HESD_OLS.fill(np.nan)
-        self.p_values_HESD_Jackknife = np.empty(self.num_associations)
+        self.p_values_HESD_Jackknife = np.empty(self.result_shape)
         self.p_values_HESD_Jackknife.fill(np.nan)
 
         # other statistics
-        self.V_G_over_Vp_HECP = np.empty(self.num_associations)
+        self.V_G_over_Vp_HECP = np.empty(self.result_shape)
         self.V_G_over_Vp_HECP.fill(np.nan)
-        self.V_G_over_Vp_HESD = np.empty(self.num_associations)
+        self.V_G_over_Vp_HESD = np.empty(self.result_shape)
         self.V_G_over_Vp_HESD.fill(np.nan)
-        self.V_G_over_Vp_SE_OLS_HECP = np.empty(self.num_associations)
+        self.V_G_over_Vp_SE_OLS_HECP = np.empty(self.result_shape)
         self.V_G_over_Vp_SE_OLS_HECP.fill(np.nan)
-        self.V_G_over_Vp_SE_OLS_HESD = np.empty(self.num_associations)
+        self.V_G_over_Vp_SE_OLS_HESD = np.empty(self.result_shape)
         self.V_G_over_Vp_SE_OLS_HESD.fill(np.nan)
-        self.V_G_over_Vp_SE_Jackknife_HECP = np.empty(self.num_associations)
+        self.V_G_over_Vp_SE_Jackknife_HECP = np.empty(self.result_shape)
         self.V_G_over_Vp_SE_Jackknife_HECP.fill(np.nan)
-        self.V_G_over_Vp_SE_Jackknife_HESD = np.empty(self.num_associations)
+        self.V_G_over_Vp_SE_Jackknife_HESD = np.empty(self.result_shape)
         self.V_G_over_Vp_SE_Jackknife_HESD.fill(np.nan)
 
     def run_association_one_tree_gcta(self, tree, out):
-        # create gcta input files, run gcta and parse output
-        exit_code = subprocess.call([os.path.dirname(sys.argv[0]) + "/run_gcta_HE.sh", out])
-        # exit_code = subprocess.call([os.getcwd() + "/run_gcta_HE.sh", out])
-
-        # read results
-        HE_CP = pd.read_table(out + "_HE-CP_result.txt")
-        HE_SD = pd.read_table(out + "_HE-SD_result.txt")
+        # the results stay nan if GCTA fails, each phenotype replicate is tested on the same GRM files
+        for k in range(self.num_replicates):
+            result = self.gcta.HE(out, phenotype=self.gcta_phenotype(k))
+            if result is not None:
+                HE_CP, HE_SD = result
+                self.set_results_one_tree(tree, HE_CP, HE_SD, replicate=k)
+
+    def _result_names(self):
+        return ["p_values_HECP_OLS", "p_values_HECP_Jackknife", "p_values_HESD_OLS", "p_values_HESD_Jackknife",
+                "V_G_over_Vp_HECP", "V_G_over_Vp_HESD", "V_G_over_Vp_SE_OLS_HECP", "V_G_over_Vp_SE_OLS_HESD",
+                "V_G_over_Vp_SE_Jackknife_HECP", "V_G_over_Vp_SE_Jackknife_HESD"]
+
+    def run_association_one_tree_native(self, tree, covariance):
+        # each phenotype replicate is a column
+        y = self.phenotypes.y.reshape(self.phenotypes.num_inds, -1)
+        for k in range(self.num_replicates):
+            HE_CP, HE_SD = vc.HE_regression(covariance=covariance, y=y[:, k])
+            self.set_results_one_tree(tree, HE_CP, HE_SD, replicate=k)
+
+        # all permuted phenotypes are regressed at once with one product with the covariance
+        if self.num_permutations > 0:
+            HE_CP, _ = vc.HE_regression(covariance=covariance, y=self.permuted_y, jackknife=False)
+            self.update_permutations(HE_CP["P_OLS"])
+
+    def run_association_one_tree_branches(self, tree, branch_sums):
+        # the jackknife requires the covariance matrix, its standard errors and p-values are nan. The branch sums
+        # have a column per phenotype replicate, followed by the permuted phenotypes (see phenotype_columns)
+        y = vc.standardize(self.phenotype_columns())
+        moments = branch_sums.get_covariance_moments(scaled=True)
+        for k in range(self.num_replicates):
+            moments_k = {name: value[k] if np.ndim(value) > 0 else value for name, value in moments.items()}
+            statistics = vc.HE_statistics_from_moments(moments_k, y[:, k])
+            HE_CP, HE_SD = vc.HE_regression_from_statistics(statistics)
+            self.set_results_one_tree(tree, HE_CP, HE_SD, replicate=k)
+
+        if self.num_permutations > 0:
+            moments_permuted = {name: value[self.num_replicates:] if np.ndim(value) > 0 else value for name, value in
+                                moments.items()}
+            statistics = vc.HE_statistics_from_moments(moments_permuted, y[:, self.num_replicates:])
+            HE_CP, _ = vc.HE_regression_from_statistics(statistics)
+            self.update_permutations(HE_CP["P_OLS"])
+
+    def set_results_one_tree(self, tree, HE_CP, HE_SD, replicate=0):
+        """
+        :param tree: TTree
+        :param HE_CP: results for V(G)/Vp of HE-CP with the fields of the GCTA output (Estimate, SE_OLS, SE_Jackknife,
+            P_OLS, P_Jackknife)
+        :param HE_SD: same for HE-SD
+        :param replicate: index of the phenotype replicate
+        """
+        index = self.result_index(tree, replicate)
 
         # p-values
-        self.p_values_HECP_OLS[tree.index] = HE_CP["P_OLS"][1]
-        if HE_CP["P_OLS"][1] < 0:
+        self.p_values_HECP_OLS[index] = HE_CP["P_OLS"]
+        if HE_CP["P_OLS"] < 0:
             raise ValueError("tree index", tree.index, "produced negative p-value for CP OLS")
 
-        self.p_values_HECP_Jackknife[tree.index] = HE_CP["P_Jackknife"][1]
-        if HE_CP["P_Jackknife"][1] < 0:
+        self.p_values_HECP_Jackknife[index] = HE_CP["P_Jackknife"]
+        if HE_CP["P_Jackknife"] < 0:
             raise ValueError("tree index", tree.index, "produced negative p-value for CP Jackknife")
 
-        self.p_values_HESD_OLS[tree.index] = HE_SD["P_OLS"][1]
-        if HE_SD["P_OLS"][1] < 0:
+        self.p_values_HESD_OLS[index] = HE_SD["P_OLS"]
+        if HE_SD["P_OLS"] < 0:
             raise ValueError("tree index", tree.index, "produced negative p-value for SD OLS")
 
-        self.p_values_HESD_Jackknife[tree.index] = HE_SD["P_Jackknife"][1]
-        if HE_SD["P_Jackknife"][1] < 0:
+        self.p_values_HESD_Jackknife[index] = HE_SD["P_Jackknife"]
+        if HE_SD["P_Jackknife"] < 0:
             raise ValueError("tree index", tree.index, "produced negative p-value for SD Jackknife")
 
         # other statistics
-        self.V_G_over_Vp_HECP[tree.index] = HE_CP["Estimate"][1]
-        self.V_G_over_Vp_HESD[tree.index] = HE_SD["Estimate"][1]
+        self.V_G_over_Vp_HECP[index] = HE_CP["Estimate"]
+        self.V_G_over_Vp_HESD[index] = HE_SD["Estimate"]
 
-        self.V_G_over_Vp_SE_OLS_HECP[tree.index] = HE_CP["SE_OLS"][1]
-        self.V_G_over_Vp_SE_OLS_HESD[tree.index] = HE_SD["SE_OLS"][1]
-        self.V_G_over_Vp_SE_Jackknife_HECP[tree.index] = HE_CP["SE_Jackknife"][1]
-        self.V_G_over_Vp_SE_Jackknife_HESD[tree.index] = HE_SD["SE_Jackknife"][1]
+        self.V_G_over_Vp_SE_OLS_HECP[index] = HE_CP["SE_OLS"]
+        self.V_G_over_Vp_SE_OLS_HESD[index] = HE_SD["SE_OLS"]
+        self.V_G_over_Vp_SE_Jackknife_HECP[index] = HE_CP["SE_Jackknife"]
+        self.V_G_over_Vp_SE_Jackknife_HESD[index] = HE_SD["SE_Jackknife"]
 
     def write_to_file(self, ts_object, out, logfile):
-        table = pd.DataFrame()
-        table['start'] = ts_object.breakpoints(as_array=True)[
-                         0:self.num_associations]  # otherwise the next start is included, i think this tree is removed due to incompleteness when taking tree subset
+        table = self.results_table(ts_object)
         table['end'] = table['start']
 
         # p-values
-        table['p_values_HECP_OLS'] = self.p_values_HECP_OLS
-        table['p_values_HECP_Jackknife'] = self.p_values_HECP_Jackknife
-        table['p_values_HESD_OLS'] = self.p_values_HESD_OLS
-        table['p_values_HESD_Jackknife'] = self.p_values_HESD_Jackknife
+        table['p_values_HECP_OLS'] = self.p_values_HECP_OLS.ravel()
+        table['p_values_HECP_Jackknife'] = self.p_values_HECP_Jackknife.ravel()
+        table['p_values_HESD_OLS'] = self.p_values_HESD_OLS.ravel()
+        table['p_values_HESD_Jackknife'] = self.p_values_HESD_Jackknife.ravel()
+        if self.num_permutations > 0:
+            table['p_values_HECP_OLS_adjusted'] = self.adjusted_p_values().ravel()
 
         # other stats
-        table['V_G_over_Vp_HECP'] = self.V_G_over_Vp_HECP
-        table['V_G_over_Vp_HESD'] = self.V_G_over_Vp_HESD
-        table['V_G_over_Vp_SE_OLS_HECP'] = self.V_G_over_Vp_SE_OLS_HECP
-        table['V_G_over_Vp_SE_OLS_HESD'] = self.V_G_over_Vp_SE_OLS_HESD
-        table['V_G_over_Vp_SE_Jackknife_HECP'] = self.V_G_over_Vp_SE_Jackknife_HECP
-        table['V_G_over_Vp_SE_Jackknife_HESD'] = self.V_G_over_Vp_SE_Jackknife_HESD
+        table['V_G_over_Vp_HECP'] = self.V_G_over_Vp_HECP.ravel()
+        table['V_G_over_Vp_HESD'] = self.V_G_over_Vp_HESD.ravel()
+        table['V_G_over_Vp_SE_OLS_HECP'] = self.V_G_over_Vp_SE_OLS_HECP.ravel()
+        table['V_G_over_Vp_SE_OLS_HESD'] = self.V_G_over_Vp_SE_OLS_HESD.ravel()
+        table['V_G_over_Vp_SE_Jackknife_HECP'] = self.V_G_over_Vp_SE_Jackknife_HECP.ravel()
+        table['V_G_over_Vp_SE_Jackknife_HESD'] = self.V_G_over_Vp_SE_Jackknife_HESD.ravel()
 
         # causal or not
-        table['causal'] = np.repeat("FALSE", self.num_associations)
-        table.loc[self.phenotypes.causal_tree_indeces, 'causal'] = "TRUE"
+        table['causal'] = self.causal_column(ts_object)
 
-        table.to_csv(out + "_trees_HE_results.csv", index=False, header=True)
-        logfile.info("- Wrote results from tree association tests to '" + out + "_trees_HE_results.csv'")
+        table.to_csv(out + "_" + self.unit + "_HE_results.csv", index=False, header=True)
+        logfile.info("- Wrote results from tree association tests to '" + out + "_" + self.unit + "_HE_results.csv'")
 
         stats = pd.DataFrame({'min_p_value_HECP_OLS': [np.nanmin(self.p_values_HECP_OLS)],
                               'min_p_value_HECP_Jackknife': [np.nanmin(self.p_values_HECP_Jackknife)],
@@ -513,133 +1141,392 @@ class TAssociationTesting_trees_gcta_HE(TAssociationTesting_trees_gcta):
                               'max_p_value_HESD_OLS': [np.nanmax(self.p_values_HESD_OLS)],
                               'max_p_value_HESD_Jackknife': [np.nanmax(self.p_values_HESD_Jackknife)]
                               })
-        stats.to_csv(out + "_trees_HE_stats.csv", index=False, header=True)
-        logfile.info("- Wrote stats from HE to '" + out + "_trees_HE_stats.csv'")
+        stats.to_csv(out + "_" + self.unit + "_HE_stats.csv", index=False, header=True)
+        logfile.info("- Wrote stats from HE to '" + out + "_" + self.unit + "_HE_stats.csv'")
+
+        if self.num_permutations > 0:
+            self.write_thresholds_to_file(out, logfile)
 
 
 class TAssociationTesting_trees_gcta_REML(TAssociationTesting_trees_gcta):
     """
     tree-based association testing using CGTA REML algorithm
     """
+    method = "REML"
 
-    def __init__(self, ts_object, phenotypes):
+    def __init__(self, ts_object, phenotypes, engine="gcta", windows=None, gcta=None, permutations=0, seed=None,
+                 alpha=0.05):
 
-        super().__init__(ts_object, phenotypes)
+        super().__init__(ts_object, phenotypes, engine, windows, gcta, permutations, seed, alpha)
 
         # results containers
-        self.p_values = np.empty(self.num_associations)
+        self.p_values = np.empty(self.result_shape)
         self.p_values.fill(np.nan)
-        self.V_G = np.empty(self.num_associations)
+        self.V_G = np.empty(self.result_shape)
         self.V_G.fill(np.nan)
-        self.V_e = np.empty(self.num_associations)
+        self.V_e = np.empty(self.result_shape)
         self.V_e.fill(np.nan)
-        self.Vp = np.empty(self.num_associations)
+        self.Vp = np.empty(self.result_shape)
         self.Vp.fill(np.nan)
-        self.V_G_over_Vp = np.empty(self.num_associations)
+        self.V_G_over_Vp = np.empty(self.result_shape)
         self.V_G_over_Vp.fill(np.nan)
-        self.logL = np.empty(self.num_associations)
+        self.logL = np.empty(self.result_shape)
         self.logL.fill(np.nan)
-        self.logL0 = np.empty(self.num_associations)
+        self.logL0 = np.empty(self.result_shape)
         self.logL0.fill(np.nan)
-        self.LRT = np.empty(self.num_associations)
+        self.LRT = np.empty(self.result_shape)
         self.LRT.fill(np.nan)
 
-        self.V_G_SE = np.empty(self.num_associations)
+        self.V_G_SE = np.empty(self.result_shape)
         self.V_G_SE.fill(np.nan)
-        self.V_e_SE = np.empty(self.num_associations)
+        self.V_e_SE = np.empty(self.result_shape)
         self.V_e_SE.fill(np.nan)
-        self.Vp_SE = np.empty(self.num_associations)
+        self.Vp_SE = np.empty(self.result_shape)
         self.Vp_SE.fill(np.nan)
-        self.V_G_over_Vp_SE = np.empty(self.num_associations)
+        self.V_G_over_Vp_SE = np.empty(self.result_shape)
         self.V_G_over_Vp_SE.fill(np.nan)
 
     def run_association_one_tree_gcta(self, tree, out):
-        # create gcta input files, run gcta and parse output
-        exit_code = subprocess.call([os.path.dirname(sys.argv[0]) + "/run_gcta_REML.sh", out])
-
-        # read results
-        result = pd.read_table(out + "_REML.hsq")
-        result_pvalue = float(result['Variance'][result['Source'] == 'Pval'])
+        # the results stay nan if GCTA fails, each phenotype replicate is tested on the same GRM files
+        for k in range(self.num_replicates):
+            result = self.gcta.REML(out, phenotype=self.gcta_phenotype(k))
+            if result is not None:
+                variance, SE = result
+                self.set_results_one_tree(tree, variance, SE, replicate=k)
+
+    def _result_names(self):
+        return ["p_values", "V_G", "V_e", "Vp", "V_G_over_Vp", "logL", "logL0", "LRT", "V_G_SE", "V_e_SE", "Vp_SE",
+                "V_G_over_Vp_SE"]
+
+    def run_association_one_tree_native(self, tree, covariance):
+        # the eigendecomposition is shared by all phenotype replicates, each replicate is a column
+        eigendecomposition = vc.REML_eigendecomposition(covariance)
+        y = self.phenotypes.y.reshape(self.phenotypes.num_inds, -1)
+        for k in range(self.num_replicates):
+            variance, SE = vc.REML(covariance=covariance, y=y[:, k], eigendecomposition=eigendecomposition)
+            self.set_results_one_tree(tree, variance, SE, replicate=k)
+
+        if self.num_permutations > 0:
+            # a full REML fit per permutation, only the eigendecomposition is shared (see --fwer_permutations)
+            self.update_permutations([vc.REML(covariance=covariance, y=column,
+                                              eigendecomposition=eigendecomposition)[0]['Pval'] for column in
+                                      self.permuted_y.T])
+
+    def set_results_one_tree(self, tree, variance, SE, replicate=0):
+        """
+        :param tree: TTree
+        :param variance: estimates by name of the Source column of the GCTA .hsq file (V(G), V(e), Vp, V(G)/Vp,
+            logL, logL0, LRT, Pval)
+        :param SE: standard errors of V(G), V(e), Vp and V(G)/Vp
+        :param replicate: index of the phenotype replicate
+        """
+        index = self.result_index(tree, replicate)
+        result_pvalue = variance['Pval']
         if result_pvalue < 0:
-            raise ValueError("Negative p-value for tree starting at " + str(tree.interval.left))
+            raise ValueError("Negative p-value for tree starting at " + str(tree.start))
         if result_pvalue > 1:
-            raise ValueError("p-value larger than 1 for tree starting at " + str(tree.interval.left))
+            raise ValueError("p-value larger than 1 for tree starting at " + str(tree.start))
 
-        self.p_values[tree.index] = result_pvalue
-        if (result_pvalue < 0):
-            raise ValueError("tree index", tree.index, "produced negative p-value with REML")
+        self.p_values[index] = result_pvalue
 
-        self.V_G[tree.index] = float(result['Variance'][result['Source'] == 'V(G)'])
-        self.V_e[tree.index] = float(result['Variance'][result['Source'] == 'V(e)'])
-        self.Vp[tree.index] = float(result['Variance'][result['Source'] == 'Vp'])
-        self.V_G_over_Vp[tree.index] = float(result['Variance'][result['Source'] == 'V(G)/Vp'])
-        self.logL[tree.index] = float(result['Variance'][result['Source'] == 'logL'])
-        self.logL0[tree.index] = float(result['Variance'][result['Source'] == 'logL0'])
-        self.LRT[tree.index] = float(result['Variance'][result['Source'] == 'LRT'])
+        self.V_G[index] = variance['V(G)']
+        self.V_e[index] = variance['V(e)']
+        self.Vp[index] = variance['Vp']
+        self.V_G_over_Vp[index] = variance['V(G)/Vp']
+        self.logL[index] = variance['logL']
+        self.logL0[index] = variance['logL0']
+        self.LRT[index] = variance['LRT']
 
-        self.V_G_SE[tree.index] = float(result['SE'][result['Source'] == 'V(G)'])
-        self.V_e_SE[tree.index] = float(result['SE'][result['Source'] == 'V(e)'])
-        self.Vp_SE[tree.index] = float(result['SE'][result['Source'] == 'Vp'])
-        self.V_G_over_Vp_SE[tree.index] = float(result['SE'][result['Source'] == 'V(G)/Vp'])
+        self.V_G_SE[index] = SE['V(G)']
+        self.V_e_SE[index] = SE['V(e)']
+        self.Vp_SE[index] = SE['Vp']
+        self.V_G_over_Vp_SE[index] = SE['V(G)/Vp']
 
     def write_to_file(self, ts_object, name, logfile):
-        table = pd.DataFrame()
-        table['start'] = ts_object.breakpoints(as_array=True)[
-                         0:self.num_associations]  # otherwise the next start is included, i think this tree is removed due to incompleteness when taking tree subset
-        table['end'] = ts_object.breakpoints(as_array=True)[1:]
-        table['p_values'] = self.p_values
-        table['V_G'] = self.V_G
-        table['V_e'] = self.V_e
-        table['Vp'] = self.Vp
-        table['V_G_over_Vp'] = self.V_G_over_Vp
-        table['logL'] = self.logL
-        table['logL0'] = self.logL0
-        table['LRT'] = self.LRT
-        table['V_G_SE'] = self.V_G_SE
-        table['V_e_SE'] = self.V_e_SE
-        table['Vp_SE'] = self.Vp_SE
-        table['V_G_over_Vp_SE'] = self.V_G_over_Vp_SE
-
-        table['causal'] = np.repeat("FALSE", self.num_associations)
-        table.loc[self.phenotypes.causal_tree_indeces, 'causal'] = "TRUE"
-
-        table.to_csv(name + "_trees_REML_results.csv", index=False, header=True)
-        logfile.info("- Wrote results from tree association tests to '" + name + "_trees_REML_results.csv'")
+        table = self.results_table(ts_object)
+        table['p_values'] = self.p_values.ravel()
+        if self.num_permutations > 0:
+            table['p_values_adjusted'] = self.adjusted_p_values().ravel()
+        table['V_G'] = self.V_G.ravel()
+        table['V_e'] = self.V_e.ravel()
+        table['Vp'] = self.Vp.ravel()
+        table['V_G_over_Vp'] = self.V_G_over_Vp.ravel()
+        table['logL'] = self.logL.ravel()
+        table['logL0'] = self.logL0.ravel()
+        table['LRT'] = self.LRT.ravel()
+        table['V_G_SE'] = self.V_G_SE.ravel()
+        table['V_e_SE'] = self.V_e_SE.ravel()
+        table['Vp_SE'] = self.Vp_SE.ravel()
+        table['V_G_over_Vp_SE'] = self.V_G_over_Vp_SE.ravel()
+
+        table['causal'] = self.causal_column(ts_object)
+
+        table.to_csv(name + "_" + self.unit + "_REML_results.csv", index=False, header=True)
+        logfile.info("- Wrote results from tree association tests to '" + name + "_" + self.unit + "_REML_results.csv'")
+
+        stats = pd.DataFrame({'min_p_value': [np.nanmin(self.p_values)],
+                              'max_p_value': [np.nanmax(self.p_values)]
+                              })
+        stats.to_csv(name + "_" + self.unit + "_REML_stats.csv", index=False, header=True)
+        logfile.info("- Wrote stats from tree association tests to '" + name + "_" + self.unit + "_REML_stats.csv'")
+
+        if self.num_permutations > 0:
+            self.write_thresholds_to_file(name, logfile)
+
+
+class TAssociationTesting_trees_score(TAssociationTesting_trees_gcta):
+    """
+    tree-based association testing with the variance-component score test (see variance_components.score_test). It
+    always runs in-process, nothing is fitted per tree. The score statistic of a permuted phenotype is a quadratic form
+    in the permuted residuals, so all permutations are tested against the covariance of a tree with one matrix
+    product.
+    """
+    method = "score"
+    factored_covariance = True
+
+    def __init__(self, ts_object, phenotypes, windows=None, permutations=0, seed=None, alpha=0.05):
+        super().__init__(ts_object, phenotypes, engine="native", windows=windows, permutations=permutations,
+                         seed=seed, alpha=alpha)
+
+        # results containers
+        self.p_values = np.empty(self.result_shape)
+        self.p_values.fill(np.nan)
+        self.Q = np.empty(self.result_shape)
+        self.Q.fill(np.nan)
+        self.scale = np.empty(self.result_shape)
+        self.scale.fill(np.nan)
+        self.df = np.empty(self.result_shape)
+        self.df.fill(np.nan)
+
+    def _result_names(self):
+        return ["p_values", "Q", "scale", "df"]
+
+    def run_association_one_tree_native(self, tree, covariance):
+        # all phenotype replicates (columns) are tested at once
+        y = self.phenotypes.y.reshape(self.phenotypes.num_inds, -1)
+        score = vc.score_test(covariance=covariance, y=y)
+        for k in range(self.num_replicates):
+            index = self.result_index(tree, k)
+            self.p_values[index] = score['Pval'][k]
+            self.Q[index] = score['Q'][k]
+            self.scale[index] = score['scale']
+            self.df[index] = score['df']
+
+        if self.num_permutations > 0:
+            self.update_permutations(vc.score_test(covariance=covariance, y=self.permuted_y)['Pval'])
+
+    def write_to_file(self, ts_object, name, logfile):
+        table = self.results_table(ts_object)
+        table['p_values'] = self.p_values.ravel()
+        if self.num_permutations > 0:
+            table['p_values_adjusted'] = self.adjusted_p_values().ravel()
+        table['Q'] = self.Q.ravel()
+        table['scale'] = self.scale.ravel()
+        table['df'] = self.df.ravel()
+
+        table['causal'] = self.causal_column(ts_object)
+
+        table.to_csv(name + "_" + self.unit + "_score_results.csv", index=False, header=True)
+        logfile.info("- Wrote results from tree association tests to '" + name + "_"
+                     + self.unit + "_score_results.csv'")
 
         stats = pd.DataFrame({'min_p_value': [np.nanmin(self.p_values)],
                               'max_p_value': [np.nanmax(self.p_values)]
                               })
-        stats.to_csv(name + "_trees_REML_stats.csv", index=False, header=True)
-        logfile.info("- Wrote stats from tree association tests to '" + name + "_trees_REML_stats.csv'")
+        stats.to_csv(name + "_" + self.unit + "_score_stats.csv", index=False, header=True)
+        logfile.info("- Wrote stats from tree association tests to '" + name + "_" + self.unit + "_score_stats.csv'")
+
+        if self.num_permutations > 0:
+            self.write_thresholds_to_file(name, logfile)
+
+
+class TAssociationTesting_trees_screen(TAssociationTesting_trees):
+    """
+    Two-stage tree-based association testing. All trees are first tested with a cheap statistic (HE or the score
+    test), then only the trees that pass a p-value threshold or are among the top trees, together with their
+    neighbours, are tested with REML. The results of both stages are written to one table.
+    """
+    method = "screen"
+    # p-values of the first stage on which the trees are selected
+    screen_p_values = {"HE": "p_values_HECP_OLS", "score": "p_values"}
+
+    def __init__(self, ts_object, phenotypes, screen_method="score", engine="gcta", windows=None,
+                 p_value_threshold=None, top=None, neighbours=1, gcta=None):
+        """
+        :param screen_method: str, test of the first stage, HE or score
+        :param engine: str, engine of HE and REML. REML runs natively if HE runs with engine branches
+        :param p_value_threshold: float, trees with a p-value of the first stage at most this large are tested with
+            REML
+        :param top: int, the trees with the top smallest p-values of the first stage are tested with REML
+        :param neighbours: int, also test this many trees (or windows) on each side of a selected tree with REML
+        :param gcta: TGCTA, runs GCTA for HE and REML with engine gcta
+        """
+        super().__init__(ts_object, phenotypes)
+
+        if screen_method == "HE":
+            self.screen = TAssociationTesting_trees_gcta_HE(ts_object, phenotypes, engine=engine, windows=windows,
+                                                            gcta=gcta)
+        elif screen_method == "score":
+            self.screen = TAssociationTesting_trees_score(ts_object, phenotypes, windows=windows)
+        else:
+            raise ValueError("Screening method '" + str(screen_method) + "' not recognized, use HE or score")
+        if p_value_threshold is None and top is None:
+            raise ValueError("Screening needs a p-value threshold or a number of top trees")
+        if neighbours < 0:
+            raise ValueError("Number of neighbours must not be negative")
+
+        self.REML = TAssociationTesting_trees_gcta_REML(ts_object, phenotypes,
+                                                        engine="native" if engine == "branches" else engine,
+                                                        windows=windows, gcta=gcta)
+        self.num_associations = self.REML.num_associations
+        self.unit = self.REML.unit
+        self.p_value_threshold = p_value_threshold
+        self.top = top
+        self.neighbours = neighbours
+        self.selected = np.zeros(self.num_associations, dtype=bool)
+
+    def select(self, p_values):
+        """
+        Trees (or windows) that are tested in the second stage. With several phenotypes, a tree passes if it passes
+        for one of them, and REML is run for all of them.
+
+        :param p_values: np.array of the first stage, of dimension num_associations (x phenotypes)
+        :return: np.array of bool
+        """
+        p_values = p_values.reshape(self.num_associations, -1)
+        p_values = np.min(np.where(np.isnan(p_values), np.inf, p_values), axis=1)
+
+        passing = np.zeros(self.num_associations, dtype=bool)
+        if self.p_value_threshold is not None:
+            passing |= p_values <= self.p_value_threshold
+        if self.top is not None:
+            ranked = np.argsort(p_values, kind="stable")[:self.top]
+            passing[ranked[np.isfinite(p_values[ranked])]] = True
+
+        hits = np.flatnonzero(passing)
+        selected = np.zeros(self.num_associations, dtype=bool)
+        for offset in range(-self.neighbours, self.neighbours + 1):
+            selected[np.clip(hits + offset, 0, self.num_associations - 1)] = True
+        return selected
+
+    def run_association(self, ts_object, variants, inds, out, logfile, covariance_type, skip_first_tree,
+                        low_memory=False, workers=1, resume=False, scratch=None):
+        """
+        Run the first stage for all trees and REML for the selected trees. Both stages have their own checkpoint
+        files, so that an interrupted run can be resumed in either stage.
+        """
+        logfile.info("- Stage 1: testing all " + self.unit + " with " + self.screen.method)
+        self.screen.run_association(ts_object=ts_object, variants=variants, inds=inds, out=out, logfile=logfile,
+                                    covariance_type=covariance_type, skip_first_tree=skip_first_tree,
+                                    low_memory=low_memory, workers=workers, resume=resume, scratch=scratch)
+
+        self.selected = self.select(getattr(self.screen, self.screen_p_values[self.screen.method]))
+        logfile.info("- Stage 2: testing " + str(np.sum(self.selected)) + " of " + str(self.num_associations) + " "
+                     + self.unit + " with REML")
+        self.REML.run_association(ts_object=ts_object, variants=variants, inds=inds, out=out, logfile=logfile,
+                                  covariance_type=covariance_type, skip_first_tree=skip_first_tree,
+                                  low_memory=low_memory, workers=workers, resume=resume, selected=self.selected,
+                                  scratch=scratch)
+
+    def write_to_file(self, ts_object, name, logfile):
+        table = self.REML.results_table(ts_object)
+        for result_name in self.screen._result_names():
+            table[self.screen.method + "_" + result_name] = getattr(self.screen, result_name).ravel()
+        table['selected'] = np.repeat(np.where(self.selected, "TRUE", "FALSE"), self.REML.num_replicates)
+        for result_name in self.REML._result_names():
+            table["REML_" + result_name] = getattr(self.REML, result_name).ravel()
+
+        table['causal'] = self.REML.causal_column(ts_object)
+
+        table.to_csv(name + "_" + self.unit + "_screen_results.csv", index=False, header=True)
+        logfile.info("- Wrote results from tree association tests to '" + name + "_" + self.unit
+                     + "_screen_results.csv'")
 
 
 class TTreeAssociation_Mantel(TAssociationTesting_trees):
+    """
+    Mantel test between the TMRCA matrix of each tree and the absolute phenotype differences, see TMantel
+    """
 
     def __init__(self, ts_object, phenotypes):
 
         super().__init__(ts_object, phenotypes)
 
-        # p-value containers
+        if phenotypes.num_phenotypes > 1:
+            raise ValueError("Mantel test is only implemented for a single phenotype")
+
+        # result containers
         self.p_values = np.empty(self.num_associations)
+        self.p_values.fill(np.nan)
+        self.r = np.empty(self.num_associations)
+        self.r.fill(np.nan)
+        self.num_permutations = np.zeros(self.num_associations, dtype=int)
+
+    def run_association(self, ts_object, inds, logfile, skip_first_tree, num_permutations=1000, seed=None,
+                        exceedances=None, block_size=None):
+        """
+        Test all trees against the same seeded stream of permutations. The condensed TMRCA matrices of block_size
+        trees are collected and tested together, so that each batch of permuted phenotype differences is shared by
+        the whole block.
+
+        :param num_permutations: int, (maximal) number of permutations including the observed order
+        :param seed: int, seed of the permutation stream
+        :param exceedances: int, stop the permutations of a tree after this many exceedances (sequential p-values,
+            see TMantel.test_block)
+        :param block_size: int, number of trees tested together. By default chosen such that a block has about
+            2.5 * 10^7 pairs
+        """
+        mantel = TMantel.TMantel(self.phenotypes.y, seed=seed)
+        if block_size is None:
+            block_size = max(1, int(2.5 * 10 ** 7) // mantel.num_pairs)
+
+        # only the trees that can be tested are built
+        skip_reasons = tt.TTrees.skip_reasons(tt.TTrees.scan(ts_object), skip_first_tree=skip_first_tree)
+        tt.TTrees.log_skipped(skip_reasons, logfile)
+        scheduled = np.flatnonzero(skip_reasons == "")
 
-    def run_Mantel(self, ts_object, phenotypes, inds):
-        # test for associations
-        diffs = phenotypes.diffs()
         start = time.time()
-        for tree in ts_object.trees():
-            if tree.index % 100 == 0:
+        block_indices = []
+        block = []
+        tree = tskit.Tree(ts_object)
+        for i, index in enumerate(scheduled):
+            if i % 100 == 0:
                 end = time.time()
-                print("Ran Mantel for", tree.index, "trees in ", round(end - start), "s")
-            if tree.total_branch_length == 0:
-                print("tree's total branch length is zero")
-                continue
-            tree_obj = tt.TTree(tree, inds.num_haplotypes)
-            tmrca = tree_obj.TMRCA(inds.num_haplotypes)
-            # print("tmrca",tmrca)
-            self.p_values[tree.index] = ut.mantel(tmrca, diffs)
-            if self.p_values[tree.index] < 0:
-                print(tmrca)
-                raise ValueError("p-value is negative")
+                logfile.info("- Ran Mantel for " + str(i) + " of " + str(len(scheduled)) + " trees in "
+                             + str(round(end - start)) + " s")
+            tree.seek_index(index)
+            tmrca = tt.TTree(tree).TMRCA(inds.num_haplotypes)
+            if inds.ploidy == 2:
+                tmrca = inds.get_diploid_matrix(tmrca) / 4
+            block_indices.append(tree.index)
+            block.append(mantel.condense(tmrca))
+            if len(block) == block_size:
+                self.r[block_indices], self.p_values[block_indices], self.num_permutations[block_indices] = \
+                    mantel.test_block(np.column_stack(block), num_permutations=num_permutations,
+                                      exceedances=exceedances)
+                block_indices = []
+                block = []
+        if len(block) > 0:
+            self.r[block_indices], self.p_values[block_indices], self.num_permutations[block_indices] = \
+                mantel.test_block(np.column_stack(block), num_permutations=num_permutations, exceedances=exceedances)
+        logfile.info("- Done running associations, using " + str(np.sum(self.num_permutations))
+                     + " permutations in total")
+
+    def write_to_file(self, ts_object, name, logfile):
+        breakpoints = ts_object.breakpoints(as_array=True)
+        table = pd.DataFrame()
+        table['start'] = breakpoints[0:self.num_associations]
+        table['end'] = breakpoints[1:self.num_associations + 1]
+        table['r'] = self.r
+        table['p_value'] = self.p_values
+        table['permutations'] = self.num_permutations
+        causal = np.repeat("FALSE", self.num_associations).astype(object)
+        causal[self.phenotypes.causal_tree_indeces] = "TRUE"
+        table['causal'] = causal
+
+        table.to_csv(name + "_trees_Mantel_results.csv", index=False, header=True)
+        logfile.info("- Wrote results from tree association tests to '" + name + "_trees_Mantel_results.csv'")
+
 
 # def runLimix(self, ts_object, N, y, F, random):   
 # self.lrt = np.empty(self.num_associations)
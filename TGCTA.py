@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Running GCTA on the covariance matrix and phenotypes of a tree and parsing its output files.
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+class TGCTA:
+    """
+    Runs GCTA on the files written with a prefix (<prefix>.grm.bin, .grm.N.bin, .grm.id and _phenotypes.phen, see
+    TAssociationTesting_trees_gcta.write_covariance_matrix_to_gcta_file) and parses its output.
+
+    Each call has a timeout and is retried a bounded number of times if it fails, i.e. if GCTA times out, exits with
+    an error or does not write a complete output file. The output file of an earlier call with the same prefix is
+    removed before each attempt, so that results are never read from a stale file. Each call is recorded with its
+    duration, number of attempts and success (see summary).
+    """
+    default_executable = "gcta_v1.94.0Beta_linux_kernel_3_x86_64/gcta_v1.94.0Beta_linux_kernel_3_x86_64_static"
+
+    def __init__(self, executable=None, timeout=None, retries=2, threads=2):
+        """
+        :param executable: str, path of the GCTA executable. Default is default_executable in the directory of the
+            program
+        :param timeout: float, seconds after which a GCTA call is stopped and counts as failed. No timeout if None
+        :param retries: int, number of times a failed call is repeated
+        :param threads: int, number of threads of GCTA
+        """
+        if executable is None:
+            executable = os.path.join(os.path.dirname(sys.argv[0]), self.default_executable)
+        if retries < 0:
+            raise ValueError("Number of GCTA retries must not be negative")
+        self.executable = executable
+        self.timeout = timeout
+        self.retries = retries
+        self.threads = threads
+        # duration in s, number of attempts and success of each call
+        self.calls = []
+
+    def HE(self, prefix, phenotype=None):
+        """
+        Haseman-Elston regression (GCTA --HEreg).
+
+        :param phenotype: int, column of the phenotype in the phenotype file if it has several (GCTA --mpheno, the
+            first phenotype is 1)
+        :return: results for V(G)/Vp of HE-CP and HE-SD, each a dict with the columns of the GCTA output (Estimate,
+            SE_OLS, SE_Jackknife, P_OLS, P_Jackknife). None if GCTA failed
+        """
+        return self._run(["--HEreg", "--grm", prefix, "--pheno", prefix + "_phenotypes.phen",
+                          "--out", prefix + "_GRM_covariance_tests"] + self._mpheno(phenotype),
+                         prefix=prefix, output=prefix + "_GRM_covariance_tests.HEreg", parse=self.parse_HEreg)
+
+    def REML(self, prefix, phenotype=None):
+        """
+        REML (GCTA --reml).
+
+        :param phenotype: int, column of the phenotype in the phenotype file if it has several (GCTA --mpheno, the
+            first phenotype is 1)
+        :return: estimates and standard errors by name of the Source column of the .hsq file (see parse_hsq). None if
+            GCTA failed
+        """
+        return self._run(["--reml", "--grm", prefix, "--pheno", prefix + "_phenotypes.phen", "--out", prefix + "_REML",
+                          "--reml-maxit", "500"] + self._mpheno(phenotype),
+                         prefix=prefix, output=prefix + "_REML.hsq", parse=self.parse_hsq)
+
+    @staticmethod
+    def _mpheno(phenotype):
+        return [] if phenotype is None else ["--mpheno", str(phenotype)]
+
+    def _run(self, arguments, prefix, output, parse):
+        command = [self.executable] + arguments + ["--threads", str(self.threads)]
+        start = time.time()
+        for attempt in range(1, self.retries + 2):
+            if os.path.exists(output):
+                os.remove(output)
+            try:
+                with open(prefix + "_tmp.out", "w") as log:
+                    exit_code = subprocess.run(command, stdout=log, stderr=subprocess.STDOUT,
+                                               timeout=self.timeout).returncode
+            except subprocess.TimeoutExpired:
+                exit_code = None
+
+            if exit_code == 0 and os.path.exists(output):
+                try:
+                    result = parse(output)
+                except ValueError:
+                    continue
+                self.calls.append((time.time() - start, attempt, True))
+                return result
+
+        self.calls.append((time.time() - start, self.retries + 1, False))
+        return None
+
+    @staticmethod
+    def parse_HEreg(file_name):
+        """
+        Parse the V(G)/Vp lines of the HE-CP and HE-SD sections of a GCTA .HEreg file. Each section starts with its
+        name, followed by a line with the column names and one line per coefficient.
+
+        :return: dicts of HE-CP and HE-SD with the columns of the file (Estimate, SE_OLS, SE_Jackknife, P_OLS,
+            P_Jackknife) as keys
+        """
+        results = {}
+        section = None
+        columns = None
+        with open(file_name) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 1:
+                    section = fields[0]
+                    columns = None
+                elif "Estimate" in fields:
+                    columns = fields[1:]
+                elif len(fields) > 1 and fields[0] == "V(G)/Vp" and columns is not None:
+                    if len(fields) != len(columns) + 1:
+                        raise ValueError("Incomplete line in GCTA output '" + file_name + "'")
+                    results[section] = dict(zip(columns, map(float, fields[1:])))
+
+        if "HE-CP" not in results or "HE-SD" not in results:
+            raise ValueError("GCTA output '" + file_name + "' does not contain V(G)/Vp of HE-CP and HE-SD")
+        return results["HE-CP"], results["HE-SD"]
+
+    @staticmethod
+    def parse_hsq(file_name):
+        """
+        Parse a GCTA .hsq file, a header line (Source Variance SE) followed by one line per estimate. The estimates
+        of the likelihood test (logL, logL0, LRT, df, Pval, n) have no standard error.
+
+        :return: estimates and standard errors as dicts by name of the Source column
+        """
+        variance = {}
+        SE = {}
+        with open(file_name) as f:
+            if f.readline().split()[:2] != ["Source", "Variance"]:
+                raise ValueError("GCTA output '" + file_name + "' does not start with the header 'Source Variance'")
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2:
+                    variance[fields[0]] = float(fields[1])
+                if len(fields) >= 3:
+                    SE[fields[0]] = float(fields[2])
+
+        if not {"V(G)", "V(e)", "Vp", "V(G)/Vp", "logL", "logL0", "LRT", "Pval"}.issubset(variance) or not {
+                "V(G)", "V(e)", "Vp", "V(G)/Vp"}.issubset(SE):
+            raise ValueError("GCTA output '" + file_name + "' is incomplete")
+        return variance, SE
+
+    def summary(self, first_call=0):
+        """
+        One line summary of the calls from first_call on, None if there were none
+        """
+        calls = self.calls[first_call:]
+        if len(calls) == 0:
+            return None
+        durations = np.array([c[0] for c in calls])
+        return (str(len(calls)) + " GCTA calls in " + str(round(np.sum(durations), 1)) + " s (mean "
+                + str(round(np.mean(durations), 3)) + " s, max " + str(round(np.max(durations), 3)) + " s), "
+                + str(sum(c[1] > 1 for c in calls)) + " retried, " + str(sum(not c[2] for c in calls)) + " failed")
@@ -8,6 +8,7 @@ Created on Wed Oct 20 15:43:16 2021
 
 import pandas as pd
 import numpy as np
+import scipy.sparse
 
 
 class Individuals:
@@ -21,12 +22,7 @@ class Individuals:
         self._num_inds = int(self._num_haplotypes / self._ploidy)
         self._ind_assignment = pd.DataFrame()
         self._ind_assignment['haplotype'] = range(0, self._num_haplotypes)
-        self._ind_assignment['individual'] = np.repeat(-1, self._num_haplotypes)
-        assignment = -1
-        for i in range(self._num_haplotypes):
-            if i % 2 == 0:
-                assignment += 1
-            self._ind_assignment['individual'][i] = assignment
+        self._ind_assignment['individual'] = np.arange(self._num_haplotypes) // self._ploidy
         self._names = ["id_" + str(i) for i in np.arange(0, self._num_inds)]
 
     @property
@@ -66,6 +62,20 @@ class Individuals:
             raise ValueError("Haplotype out of bounds")
         return (self._ind_assignment['individual'][haplotype])['individual']
 
+    def get_individuals(self, haplotypes):
+        """
+        Vectorized version of get_individual
+
+        Parameters
+        ----------
+        haplotypes : np.array of haplotype indeces
+
+        Returns
+        -------
+        np.array of the individuals the haplotypes are assigned to
+        """
+        return self._ind_assignment['individual'].values[haplotypes]
+
     def get_haplotypes(self, individual):
         if individual > self._num_inds or individual < 0:
             raise ValueError("Individual out of bounds")
@@ -83,6 +93,38 @@ class Individuals:
         )
         return table['diploid_genotypes']
 
+    def get_incidence_matrix(self):
+        """
+        Returns
+        -------
+        scipy.sparse.csr_matrix of dimension num_haplotypes x num_inds with a one where a haplotype belongs to an
+        individual
+        """
+        return scipy.sparse.csr_matrix((np.ones(self._num_haplotypes), (self._ind_assignment['haplotype'].values,
+                                                                         self._ind_assignment['individual'].values)),
+                                       shape=(self._num_haplotypes, self._num_inds))
+
+    def get_diploid_matrix(self, haploid_matrix):
+        """
+        Sum a matrix between haplotypes over the haplotypes of each individual, e.g. to get the covariance between
+        individuals from the covariance between haplotypes.
+
+        Parameters
+        ----------
+        haploid_matrix : np.array of dimension num_haplotypes x num_haplotypes
+
+        Returns
+        -------
+        np.array of dimension num_inds x num_inds
+        """
+        individuals = self._ind_assignment['individual'].values
+        if np.array_equal(individuals, np.arange(self._num_haplotypes) // self._ploidy):
+            # haplotypes of an individual are neighbours
+            return haploid_matrix.reshape(self._num_inds, self._ploidy, self._num_inds, self._ploidy).sum(axis=(1, 3))
+
+        incidence = self.get_incidence_matrix()
+        return (incidence.T @ (incidence.T @ haploid_matrix).T).T
+
     def write_shapeit2(self, out, logfile):
         logfile.info("- Writing individuals in Shapeit2 format to file '" + out + "_inds.sample'")
 
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Mantel test between the distance matrices of local trees and the absolute phenotype differences, with the matrices
+kept in condensed form (the upper triangle as a vector) and the permutations evaluated in batches.
+"""
+
+import numpy as np
+from scipy import spatial
+
+
+class TMantel:
+    """
+    Mantel test of one phenotype against many distance matrices.
+
+    The phenotype differences |y_i - y_j| are never built as a square matrix: for a batch of permutations pi, the
+    permuted differences |y_pi(i) - y_pi(j)| of all pairs i < j are gathered with precomputed pair index arrays into a
+    matrix of dimension batch x pairs. The permuted differences only depend on the phenotype, so a block of distance
+    matrices (one column each) is tested against them with one matrix product.
+
+    The permutations come from a stream that is restarted from the seed for every block, so each distance matrix sees
+    the same permutations, whatever the batch size and the blocks it was tested in.
+
+    As in Mantel.test (two-tail), the p-value is the proportion of covariances, including the observed one, whose
+    absolute value is at least that of the observed covariance.
+    """
+
+    def __init__(self, y, seed=None, batch_size=None):
+        """
+        :param y: np.array, phenotype of the objects (individuals) in the order of the distance matrices
+        :param seed: int, seed of the permutation stream. A random seed is drawn if None
+        :param batch_size: int, number of permutations evaluated at once. By default chosen such that a batch has
+            about 10^7 permuted pairs
+        """
+        self.y = np.asarray(y, dtype=float)
+        self.num_objects = len(self.y)
+        if self.num_objects < 3:
+            raise ValueError("Mantel test needs at least 3 objects")
+
+        self.rows, self.columns = np.triu_indices(self.num_objects, 1)
+        self.num_pairs = len(self.rows)
+
+        y_diffs = spatial.distance.pdist(self.y.reshape(-1, 1), metric='cityblock')
+        self.y_mean = np.mean(y_diffs)
+        self.y_norm = np.sqrt(np.sum((y_diffs - self.y_mean) ** 2))
+
+        self.seed = np.random.SeedSequence(seed).entropy
+        self.batch_size = batch_size if batch_size is not None else max(1, 10 ** 7 // self.num_pairs)
+
+    def condense(self, X):
+        """
+        Condensed residuals (deviations from the mean) of a distance matrix given in square or condensed form. The
+        diagonal of a square matrix is ignored.
+        """
+        X = np.asarray(X, dtype=float)
+        if X.ndim == 2:
+            X = X[self.rows, self.columns]
+        if len(X) != self.num_pairs:
+            raise ValueError("Distance matrix does not have " + str(self.num_objects) + " objects")
+        return X - np.mean(X)
+
+    def permutations(self, num_permutations):
+        """
+        Generator of the first num_permutations permutations of the seeded stream, in batches of at most batch_size
+        permutations (one per row). Permutations are drawn one at a time, so the stream does not depend on the batch
+        size.
+        """
+        random = np.random.default_rng(self.seed)
+        for start in range(0, num_permutations, self.batch_size):
+            batch = min(self.batch_size, num_permutations - start)
+            yield np.array([random.permutation(self.num_objects) for _ in range(batch)]).reshape(batch,
+                                                                                                  self.num_objects)
+
+    def permuted_differences(self, permutations):
+        """
+        Condensed phenotype differences under each permutation, centered with the (permutation invariant) mean.
+
+        :param permutations: np.array of dimension batch x num_objects
+        :return: np.array of dimension batch x num_pairs
+        """
+        y_permuted = self.y[permutations]
+        y_diffs = np.abs(y_permuted[:, self.rows] - y_permuted[:, self.columns])
+        y_diffs -= self.y_mean
+        return y_diffs
+
+    def test_block(self, x_residuals, num_permutations=1000, exceedances=None):
+        """
+        Test a block of distance matrices against the same permutations.
+
+        With exceedances h set, the p-values are sequential Monte Carlo p-values (Besag and Clifford 1991): the
+        permutations of a distance matrix stop as soon as h of them have an absolute covariance at least as large as
+        the observed one, and the p-value is h / L, with L the number of permutations used. Matrices that do not reach
+        h exceedances run all permutations and get the usual p-value. Large p-values are thereby resolved with few
+        permutations, while small ones get all of them, and stopped matrices are dropped from the matrix products.
+
+        :param x_residuals: np.array of dimension num_pairs x num_matrices, condensed residuals of the distance
+            matrices (see condense)
+        :param num_permutations: int, (maximal) number of permutations including the observed order, as perms in
+            Mantel.test
+        :param exceedances: int, number of exceedances h after which the permutations of a matrix stop. If None,
+            all matrices run all permutations
+        :return: correlations r, p-values and number of permutations used (including the observed order), np.arrays
+            of length num_matrices. r and p are NaN for constant distance matrices
+        """
+        x_residuals = np.asarray(x_residuals, dtype=float).reshape(self.num_pairs, -1)
+        num_matrices = x_residuals.shape[1]
+        x_norm = np.sqrt(np.sum(x_residuals ** 2, axis=0))
+
+        observed = self.permuted_differences(np.arange(self.num_objects).reshape(1, -1))[0] @ x_residuals
+        counts = np.zeros(num_matrices, dtype=int)
+        used = np.zeros(num_matrices, dtype=int)
+        stopped = np.zeros(num_matrices, dtype=bool)
+        active = np.arange(num_matrices)
+        for permutations in self.permutations(num_permutations - 1):
+            covariances = self.permuted_differences(permutations) @ x_residuals[:, active]
+            exceeding = np.abs(covariances) >= np.abs(observed[active])
+            if exceedances is None:
+                counts[active] += np.sum(exceeding, axis=0)
+                used[active] += len(permutations)
+                continue
+
+            # permutation at which each active matrix reaches h exceedances, if it does in this batch
+            cumulative = counts[active] + np.cumsum(exceeding, axis=0)
+            reached = cumulative[-1] >= exceedances
+            stop = np.argmax(cumulative >= exceedances, axis=0)
+            counts[active] = np.where(reached, exceedances, cumulative[-1])
+            used[active] += np.where(reached, stop + 1, len(permutations))
+            stopped[active[reached]] = True
+            active = active[~reached]
+            if len(active) == 0:
+                break
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = observed / (x_norm * self.y_norm)
+            p = np.where(stopped, counts / used, (counts + 1) / (used + 1.0))
+
+        constant = (x_norm == 0) | (self.y_norm == 0)
+        r[constant] = np.nan
+        p[constant] = np.nan
+
+        return r, p, used + 1
+
+    def test(self, X, num_permutations=1000, exceedances=None):
+        """
+        :param X: np.array, distance matrix (square or condensed)
+        :param num_permutations: int, (maximal) number of permutations including the observed order, as perms in
+            Mantel.test
+        :param exceedances: int, stop after this many exceedances, see test_block
+        :return: correlation r and p-value
+        """
+        r, p, _ = self.test_block(self.condense(X).reshape(-1, 1), num_permutations=num_permutations,
+                                  exceedances=exceedances)
+        return r[0], p[0]
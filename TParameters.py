@@ -70,6 +70,13 @@ class TParameters:
 
         # simulating phenotypes
         pty = parser.add_argument_group('simulating phenotypes')
+        pty.add_argument('--pty_replicates', type=int, default=1,
+                         help="Simulate this many phenotypes, each with its own trait architecture and noise. The "
+                              "covariance of each tree is calculated once and tested against all of them. With "
+                              "--AIM_engine gcta, GCTA is called once per phenotype (--mpheno) on the same GRM files")
+        pty.add_argument('--pheno_file', type=str,
+                         help="Read phenotypes from this file in gcta format instead of simulating them. Each column "
+                              "after the family and individual ids is a phenotype, GWAS tests all of them")
         pty.add_argument('--ploidy', type=int, choices=[1, 2],
                          help="Ploidy of individuals. Haplotypes will be assigned to individuals in increasing order")
         pty.add_argument('--pty_sd_envNoise', type=float,
@@ -112,7 +119,9 @@ class TParameters:
         assoc.add_argument('--ass_method', choices=["GWAS", "AIM", "both"],
                            help="Either run only GWAS, AIM or both")
         assoc.add_argument('--AIM_method', nargs='+',
-                           help="Use either Haseman-Elston or REML to test trees for association")
+                           help="Use Haseman-Elston (HE), REML, the variance-component score test (score), a "
+                                "Mantel test (Mantel) or a screen followed by REML (screen) to test trees for "
+                                "association")
         assoc.add_argument('--covariance_type', type=str, choices=["scaled", "eGRM", "GRM"],
                            help="Use scaled variance-covariance matrix calculated as the covariance scaled by "
                                 "N/trace, or use the eGRM calculated by egrm (Fan et al. 2022)")
@@ -120,6 +129,72 @@ class TParameters:
                            help="Only test tree that is overlapping the given position for association")
         assoc.add_argument('--skip_first_tree', type=bool, default=False,
                            help='Do not run association test on first tree')
+        assoc.add_argument('--AIM_engine', type=str, choices=["gcta", "native", "branches"], default="gcta",
+                           help="Run the tree-based association tests (HE and REML) with GCTA or in-process with numpy. "
+                                "With 'branches', HE is calculated from the branches of the trees without building "
+                                "covariance matrices. It only supports haploids (--ploidy 1, each sample is an "
+                                "individual) and covariance_type scaled, and has no jackknife")
+        assoc.add_argument('--window_bp', type=float,
+                           help="Test genomic windows of this many bp instead of single trees (HE, REML and score). "
+                                "The covariance of a window is the span-weighted mean of the covariances of its trees")
+        assoc.add_argument('--window_trees', type=int,
+                           help="Test windows of this many consecutive trees instead of single trees")
+        assoc.add_argument('--window_variants', type=int,
+                           help="Test windows of this many consecutive typed variants instead of single trees")
+        assoc.add_argument('--window_step', type=float,
+                           help="Distance between the starts of two windows, in the unit of the window size. Default "
+                                "is the window size, i.e. windows do not overlap")
+        assoc.add_argument('--mantel_permutations', type=int, default=1000,
+                           help="Number of permutations of the Mantel test, including the observed order. The "
+                                "permutations are drawn from a stream seeded with '--seed'")
+        assoc.add_argument('--mantel_exceedances', type=int,
+                           help="Stop the permutations of a tree's Mantel test once this many permutations are at least "
+                                "as extreme as the observed statistic (sequential p-values of Besag and Clifford). "
+                                "'--mantel_permutations' is then the maximal number of permutations")
+        assoc.add_argument('--fwer_permutations', '--score_permutations', dest='fwer_permutations', type=int, default=0,
+                           help="Permute the phenotypes this many times to obtain a family-wise significance "
+                                "threshold over all trees and adjusted p-values for HE (HE-CP OLS), REML and the score "
+                                "test (max-statistic method). Requires '--AIM_engine' native or branches for HE and "
+                                "REML. The permutations are drawn from a stream seeded with '--seed'. For REML, each "
+                                "permutation fits a full REML for every tree (only the eigendecomposition of the "
+                                "covariance is shared), so the run takes about B+1 times as long as without "
+                                "permutations. '--score_permutations' is the old name of this option")
+        assoc.add_argument('--fwer_alpha', type=float, default=0.05,
+                           help="Family-wise error rate of the significance threshold from '--fwer_permutations'")
+        assoc.add_argument('--screen_method', type=str, choices=["HE", "score"], default="score",
+                           help="Test of the first stage of '--AIM_method screen', it is run for all trees. Only "
+                                "the trees it selects are tested with REML")
+        assoc.add_argument('--screen_p_value', type=float,
+                           help="Trees with a p-value of the first stage of at most this value are tested with REML")
+        assoc.add_argument('--screen_top', type=int,
+                           help="The trees with this many smallest p-values of the first stage are tested with REML")
+        assoc.add_argument('--screen_neighbours', type=int, default=1,
+                           help="Also test this many trees (or windows) on each side of a selected tree with REML")
+        assoc.add_argument('--workers', type=int, default=1,
+                           help="Number of processes that test trees for association in parallel")
+        assoc.add_argument('--resume', action='store_true',
+                           help="Continue an interrupted run of tree-based association tests with the same '--out' "
+                                "from its checkpoint files, only the missing trees are tested")
+        assoc.add_argument('--scratch_dir', type=str,
+                           help="Directory in which a temporary directory for the intermediate files of each tree "
+                                "(e.g. the files for GCTA) is created, it is removed at the end of the run. Default "
+                                "is /dev/shm if available, otherwise the temporary directory of the system (TMPDIR)")
+        assoc.add_argument('--gcta_executable', type=str,
+                           help="Path of the GCTA executable. Default is "
+                                "gcta_v1.94.0Beta_linux_kernel_3_x86_64/gcta_v1.94.0Beta_linux_kernel_3_x86_64_static "
+                                "in the directory of ARGWAS.py")
+        assoc.add_argument('--gcta_timeout', type=float,
+                           help="Stop a GCTA call after this many seconds and count it as failed. Default is no "
+                                "timeout")
+        assoc.add_argument('--gcta_retries', type=int, default=2,
+                           help="Number of times a failed GCTA call (timeout, error or incomplete output) is repeated "
+                                "before the tree is given NaN results")
+        assoc.add_argument('--low_memory_covariance', action='store_true',
+                           help='For diploids and covariance_type scaled, accumulate the covariance between '
+                                'individuals directly from the branches of each tree instead of first building the '
+                                'covariance between haplotypes. The score test and HE with --AIM_engine native (also '
+                                'for haploids) do not build the covariance matrix at all, they run on the branches '
+                                'of each tree (TTree.TFactoredCovariance). HE then has no jackknife results')
 
         args = parser.parse_args()
 
@@ -20,16 +20,7 @@ class Phenotypes:
 
     def __init__(self, variants, inds, logfile):
         self.num_inds = inds.num_inds
-        self._y = np.zeros(self.num_inds)
-        self._random_noise = np.zeros(self.num_inds)
-        self._genetic_variance = -1.0
-        self.betas = [0] * variants.number
-        self.causal_variants = []
-        self.causal_betas = []
-        self.causal_power = []
-        self.causal_trees = []
-        self.causal_variant_indeces = []
-        self.causal_tree_indeces = []
+        self.reset(variants)
         self.filled = False
 
     @property
@@ -40,6 +31,15 @@ class Phenotypes:
     def y(self, y: np.ndarray):
         self._y = y
 
+    @property
+    def num_phenotypes(self):
+        """
+        Number of phenotypes, y is a matrix of dimension num_inds x num_phenotypes if there are more than one
+        """
+        if self._y.ndim == 1:
+            return 1
+        return self._y.shape[1]
+
     @property
     def genetic_variance(self):
         return self._genetic_variance
@@ -50,7 +50,7 @@ class Phenotypes:
 
     def simulate(self, args, r, logfile, variants_orig, inds, trees, plots_dir):
         """
-        Simulate phenotypes
+        Simulate phenotypes. With args.pty_replicates > 1, simulate that many phenotypes, see simulate_replicates.
         :param args: TArgs
         :param r: TRandomGenerator
         :param logfile: IndentedLoggerAdapter
@@ -60,6 +60,25 @@ class Phenotypes:
         :param plots_dir: str
         :return:
         """
+        if args.pty_replicates > 1:
+            self.simulate_replicates(args=args, r=r, logfile=logfile, variants_orig=variants_orig, inds=inds,
+                                     trees=trees, plots_dir=plots_dir)
+            return
+
+        self.simulate_one_phenotype(args=args, r=r, logfile=logfile, variants_orig=variants_orig, inds=inds,
+                                    trees=trees, plots_dir=plots_dir)
+
+        # self.standardize(logfile)
+
+        # write phenotypes to file
+        self.write_to_file(variants_orig, inds, args.out, logfile)
+
+        self.filled = True
+
+    def simulate_one_phenotype(self, args, r, logfile, variants_orig, inds, trees, plots_dir):
+        """
+        Simulate trait architecture and random noise of one phenotype
+        """
         # simulate trait architecture
         self.simulate_trait_architecture(args=args, r=r, logfile=logfile, variants_orig=variants_orig, inds=inds,
                                          trees=trees, plots_dir=plots_dir)
@@ -83,10 +102,82 @@ class Phenotypes:
 
         self._y += self._random_noise
 
-        # self.standardize(logfile)
+    def simulate_replicates(self, args, r, logfile, variants_orig, inds, trees, plots_dir):
+        """
+        Simulate args.pty_replicates phenotypes, each with its own draw of the trait architecture and the random
+        noise. y becomes a matrix of dimension num_inds x pty_replicates. The causal variants differ between
+        replicates, they are written to '<out>_pheno_replicates.csv' instead of the per-variant table of write_to_file,
+        and no tree is marked as causal.
+        """
+        y = np.empty((self.num_inds, args.pty_replicates))
+        table = pd.DataFrame(index=range(args.pty_replicates))
+        table['replicate'] = range(args.pty_replicates)
+        table['causal_variant_indeces'] = ""
+        table['var_genotypic_empiric'] = np.nan
+        table['var_random'] = np.nan
+        table['var_phenotypic'] = np.nan
+
+        for k in range(args.pty_replicates):
+            logfile.info("- Replicate " + str(k) + ":")
+            logfile.add()
+            self.reset(variants_orig)
+            self.simulate_one_phenotype(args=args, r=r, logfile=logfile, variants_orig=variants_orig, inds=inds,
+                                        trees=trees, plots_dir=plots_dir)
+            logfile.sub()
 
-        # write phenotypes to file
-        self.write_to_file(variants_orig, inds, args.out, logfile)
+            y[:, k] = self._y
+            table.loc[k, 'causal_variant_indeces'] = ";".join(str(v) for v in self.causal_variant_indeces)
+            table.loc[k, 'var_genotypic_empiric'] = self._genetic_variance
+            table.loc[k, 'var_random'] = np.var(self._random_noise)
+            table.loc[k, 'var_phenotypic'] = np.var(self._y)
+
+        self.reset(variants_orig)
+        self._y = y
+
+        table.to_csv(args.out + "_pheno_replicates.csv", index=False, header=True)
+        logfile.info("- Wrote variance components and causal variants of " + str(args.pty_replicates)
+                     + " phenotype replicates to '" + args.out + "_pheno_replicates.csv'")
+
+        self.filled = True
+
+    def reset(self, variants):
+        """
+        Remove simulated phenotype and its trait architecture
+        :param variants: TVariants
+        """
+        self._y = np.zeros(self.num_inds)
+        self._random_noise = np.zeros(self.num_inds)
+        self._genetic_variance = -1.0
+        self.betas = [0] * variants.number
+        self.causal_variants = []
+        self.causal_betas = []
+        self.causal_power = []
+        self.causal_trees = []
+        self.causal_variant_indeces = []
+        self.causal_tree_indeces = []
+
+    def read_from_file(self, file, logfile):
+        """
+        Read phenotypes from a file in gcta format (first column=family, second=ind id, then one column per
+        phenotype), with the individuals in the same order as inds. With more than one phenotype column, y is a matrix
+        of dimension num_inds x num_phenotypes.
+
+        :param file: str
+        :param logfile: IndentedLoggerAdapter
+        :return:
+        """
+        table = pd.read_csv(file, sep=r"\s+", header=None)
+        if table.shape[0] != self.num_inds:
+            raise ValueError("Phenotype file '" + file + "' contains " + str(table.shape[0]) + " individuals, but "
+                             + str(self.num_inds) + " are expected")
+        if table.shape[1] < 3:
+            raise ValueError("Phenotype file '" + file + "' must contain family, individual and phenotype columns")
+
+        y = table.iloc[:, 2:].to_numpy(dtype=float)
+        if y.shape[1] == 1:
+            y = y[:, 0]
+        self._y = y
+        logfile.info("- Read " + str(self.num_phenotypes) + " phenotypes from '" + file + "'")
 
         self.filled = True
 
@@ -432,7 +523,9 @@ class Phenotypes:
 
     def write_to_file_gcta_eGRM(self, inds, out, logfile):
         """
-        Write phenotypes to file in gtca format (first column=family, second=ind id, third=pheno value). This format will match the binary output created with plinkFile R package.
+        Write phenotypes to file in gtca format (first column=family, second=ind id, third=pheno value). This format
+        will match the binary output created with write_covariance_matrix_bin for the eGRM and GRM. With several
+        phenotypes, each has its own column from the third on (selected with GCTA --mpheno).
 
         Returns
         -------
@@ -444,14 +537,16 @@ class Phenotypes:
         tmp_pheno = pd.DataFrame()
         tmp_pheno['1'] = np.repeat(0, self.num_inds)
         tmp_pheno['2'] = inds.names
-        tmp_pheno['3'] = self._y
+        for k, column in enumerate(self._y.reshape(self.num_inds, -1).T):
+            tmp_pheno[str(k + 3)] = column
 
         tmp_pheno.to_csv(out + "_phenotypes.phen", sep=' ', index=False, header=False)
 
     def write_to_file_gcta_scaled(self, out, logfile):
         """
         Write phenotypes to file in gtca format (first column=family, second=ind id, third=pheno value). This format
-        will match the binary output created with egrm.
+        will match the binary output created with write_covariance_matrix_bin for the scaled covariance. With several
+        phenotypes, each has its own column from the third on (selected with GCTA --mpheno).
 
         Returns
         -------
@@ -462,7 +557,8 @@ class Phenotypes:
         tmp_pheno = pd.DataFrame()
         tmp_pheno['1'] = np.arange(1, self.num_inds + 1)
         tmp_pheno['2'] = tmp_pheno['1']
-        tmp_pheno['3'] = self._y
+        for k, column in enumerate(self._y.reshape(self.num_inds, -1).T):
+            tmp_pheno[str(k + 3)] = column
 
         tmp_pheno.to_csv(out + "_phenotypes.phen", sep=' ', index=False, header=False)
 
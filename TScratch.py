@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Scratch directory for the intermediate files written for each tree (covariance matrices and phenotypes in GCTA format
+and the output of GCTA), kept apart from the results of a run.
+"""
+
+import copy
+import os
+import tempfile
+
+
+class TScratch:
+    """
+    Temporary directory that is removed with all its content by cleanup, or at the latest when the program exits. By
+    default it is created in /dev/shm, so that the intermediate files are only held in memory, or in the temporary
+    directory of the system (TMPDIR, usually node-local) if there is no /dev/shm.
+
+    The files of a run are written with the same base name as the output prefix of the run, see prefix.
+    """
+
+    def __init__(self, out, directory=None):
+        """
+        :param out: str, output prefix of the run
+        :param directory: str, directory in which the scratch directory is created. Default see default_directory
+        """
+        if directory is None:
+            directory = self.default_directory()
+        self.name = os.path.basename(out)
+        self._temporary = tempfile.TemporaryDirectory(prefix=self.name + "_scratch_", dir=directory)
+        self.path = self._temporary.name
+
+    @staticmethod
+    def default_directory():
+        if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+            return "/dev/shm"
+        return tempfile.gettempdir()
+
+    @property
+    def prefix(self):
+        """
+        Prefix of the intermediate files in the scratch directory
+        """
+        return os.path.join(self.path, self.name)
+
+    def subdirectory(self, name):
+        """
+        Scratch in a subdirectory of this one, e.g. for a worker process. It is removed together with this one.
+        """
+        scratch = copy.copy(self)
+        scratch.path = os.path.join(self.path, name)
+        os.makedirs(scratch.path, exist_ok=True)
+        return scratch
+
+    def cleanup(self):
+        self._temporary.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
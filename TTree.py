@@ -5,8 +5,10 @@ Created on Tue Sep  7 17:43:29 2021
 
 @author: linkv
 """
+import hashlib
 import numpy as np
 import pandas as pd
+import scipy.sparse
 import tskit
 from egrm import varGRM_C
 from egrm import varGRM
@@ -50,6 +52,162 @@ class TTrees:
         trees.dump(out + "_focal.trees")
         logfile.info("- Wrote trees with " + str(focal_tree.interval) + " to " + out + "_focal.trees")
 
+    @staticmethod
+    def scan(ts_object, variants=None):
+        """
+        Summary of each tree computed from the table arrays of the tree sequence, without building TTree objects.
+
+        The number of roots is that of tskit, which only counts the roots with samples below them (the parts of
+        unsimplified tree sequences without samples are not roots). tskit updates it with the edge differences
+        between trees, so iterating over the trees for it costs about as much as the vectorized columns.
+
+        Parameters
+        ----------
+        ts_object : tskit.TreeSequence
+        variants : TVariantsFiltered
+            If given, the number of typed variants with allele frequency > 0 of each tree is counted as well.
+
+        Returns
+        -------
+        pd.DataFrame with columns index, start, end, span, num_roots, num_mutations (and num_typed_variants)
+        """
+        breakpoints = ts_object.breakpoints(as_array=True)
+        num_trees = ts_object.num_trees
+        num_roots = np.fromiter((tree.num_roots for tree in ts_object.trees()), dtype=int, count=num_trees)
+
+        mutation_positions = ts_object.sites_position[ts_object.mutations_site]
+        mutation_trees = np.searchsorted(breakpoints, mutation_positions, side='right') - 1
+
+        info = pd.DataFrame()
+        info['index'] = np.arange(num_trees)
+        info['start'] = breakpoints[:-1]
+        info['end'] = breakpoints[1:]
+        info['span'] = np.diff(breakpoints)
+        info['num_roots'] = num_roots
+        info['num_mutations'] = np.bincount(mutation_trees, minlength=num_trees)
+        if variants is not None:
+            typed = variants.info['typed'].to_numpy(dtype=bool) & (variants.info['allele_freq'].to_numpy() > 0.0)
+            info['num_typed_variants'] = np.bincount(variants.info['tree_index'].to_numpy(dtype=int)[typed],
+                                                     minlength=num_trees)
+        return info
+
+    @staticmethod
+    def skip_reasons(scan, covariance_type=None, skip_first_tree=False):
+        """
+        Why each tree cannot be tested for association, given the summary of the trees (see scan). A tree is skipped
+        if it has multiple roots (no height), if it is the first tree and skip_first_tree is set, or if the covariance
+        type is GRM and it has no typed variants. Only the first applicable reason is given.
+
+        Returns
+        -------
+        np.array of str with one reason per tree, empty for the trees that are tested
+        """
+        reasons = np.full(len(scan), "", dtype=object)
+        if covariance_type == "GRM":
+            reasons[scan['num_typed_variants'].to_numpy() == 0] = "no typed variants"
+        if skip_first_tree and len(scan) > 0:
+            reasons[0] = "first tree"
+        reasons[scan['num_roots'].to_numpy() != 1] = "multiple roots"
+        return reasons
+
+    @staticmethod
+    def first_occurrences(ts_object, tested):
+        """
+        Index of the first tested tree with the same signature (see TTree.get_signature), i.e. with the same
+        covariance, for each tested tree. The hashes of the samples are drawn from a fixed seed, so the signatures do
+        not depend on the run.
+
+        Parameters
+        ----------
+        ts_object : tskit.TreeSequence
+        tested : np.array of bool, one per tree
+
+        Returns
+        -------
+        np.array of int, the index of the tree itself if it is the first tree with its signature, -1 for the trees
+        that are not tested
+        """
+        sample_hashes = np.random.default_rng(0).integers(0, 2 ** 64, size=ts_object.num_samples, dtype=np.uint64)
+        first = {}
+        first_occurrences = np.full(ts_object.num_trees, -1)
+        tree = tskit.Tree(ts_object)
+        for index in np.flatnonzero(tested):
+            tree.seek_index(index)
+            tree_obj = TTree(tree)
+            if tree_obj.height != -1:
+                first_occurrences[index] = first.setdefault(tree_obj.get_signature(sample_hashes), index)
+        return first_occurrences
+
+    @staticmethod
+    def log_skipped(reasons, logfile):
+        """
+        Log how many trees are skipped for each reason (see skip_reasons).
+        """
+        labels, counts = np.unique(reasons[reasons != ""], return_counts=True)
+        if len(labels) > 0:
+            logfile.info("- Skipping " + str(np.sum(counts)) + " of " + str(len(reasons)) + " trees ("
+                         + ", ".join(label + ": " + str(c) for label, c in zip(labels, counts)) + ")")
+
+    @staticmethod
+    def windows_bp(ts_object, window_size, window_step=None):
+        """
+        Genomic windows [start, end) of window_size bp, starting every window_step bp (default window_size).
+
+        Returns
+        -------
+        np.array of dimension number of windows x 2
+        """
+        if window_step is None:
+            window_step = window_size
+        if window_size <= 0 or window_step <= 0:
+            raise ValueError("Window size and step must be positive")
+        starts = np.arange(0, ts_object.sequence_length, window_step)
+        ends = np.minimum(starts + window_size, ts_object.sequence_length)
+        return np.column_stack([starts, ends])
+
+    @staticmethod
+    def windows_trees(ts_object, window_size, window_step=None):
+        """
+        Windows of window_size consecutive trees, starting every window_step trees (default window_size).
+        """
+        if window_step is None:
+            window_step = window_size
+        if window_size <= 0 or window_step <= 0:
+            raise ValueError("Window size and step must be positive")
+        breakpoints = ts_object.breakpoints(as_array=True)
+        first_trees = np.arange(0, ts_object.num_trees, window_step)
+        return np.column_stack([breakpoints[first_trees],
+                                breakpoints[np.minimum(first_trees + window_size, ts_object.num_trees)]])
+
+    @staticmethod
+    def windows_variants(ts_object, variants, window_size, window_step=None):
+        """
+        Windows of window_size consecutive typed variants, starting every window_step typed variants (default
+        window_size). A window goes from its first variant to the first variant of the next window, or to the end of
+        the sequence.
+        """
+        if window_step is None:
+            window_step = window_size
+        if window_size <= 0 or window_step <= 0:
+            raise ValueError("Window size and step must be positive")
+        typed = variants.info['typed'].to_numpy(dtype=bool)
+        positions = np.append(variants.info['position'].to_numpy(dtype=float)[typed], ts_object.sequence_length)
+        num_typed = len(positions) - 1
+        first_variants = np.arange(0, num_typed, window_step)
+        return np.column_stack([positions[first_variants],
+                                positions[np.minimum(first_variants + window_size, num_typed)]])
+
+
+class TTreeWindow:
+    """
+    Genomic window that is tested for association in place of a single tree, see TWindowCovariance.
+    """
+
+    def __init__(self, index, start, end):
+        self.index: int = index
+        self.start: float = start
+        self.end: float = end
+
 
 class TTree:
     def __init__(self, tree_iterator):
@@ -79,6 +237,102 @@ class TTree:
     def TMRCA(self, num_haplotypes):
         """
         see tskit to understand these classes: https://tskit.dev/tskit/docs/stable/python-api.html#the-tree-class
+
+        - the goal of this function is to get pairwise branch lengths between all nodes of the tree
+        - the samples are first reordered as they appear in a preorder traversal of the tree. In this order, the
+        samples below any node form one contiguous block, so each branch is deducted from a square slice of the
+        matrix instead of a scatter over the node's sample list
+        - branches are deducted in preorder, the same order in which TMRCA_nodes visits them, so the result is
+        identical to that of TMRCA_nodes
+        - at the end, the rows and columns are put back into the order of the sample ids
+
+        Parameters
+        ----------
+        num_haplotypes : int
+            number of haplotypes.
+
+        Returns
+        -------
+        tmrca : pairwise distance between two haplotypes. square matrix of dimension num_haplotypes and type float.
+
+        """
+        sample_order, block_starts, preorder = self.get_sample_blocks()
+
+        tmrca = np.zeros([num_haplotypes, num_haplotypes])
+        for c, start in zip(preorder, block_starts):
+            n = self.tree.num_samples(c)
+            if (n == 0 or n == num_haplotypes or self.tree.time(
+                    c) == 0):  # The branch length for a node that has no parent (e.g., a root) is defined as zero.
+                continue
+            t = self.tree.time(self.tree.parent(c)) - self.tree.time(c)
+            tmrca[start:start + n, start:start + n] -= t
+        tmrca += self.height
+        np.fill_diagonal(tmrca, 0)
+
+        # undo sample reordering
+        position = np.empty(num_haplotypes, dtype=int)
+        position[sample_order] = np.arange(num_haplotypes)
+        tmrca = tmrca[np.ix_(position, position)]
+
+        return tmrca
+
+    def get_sample_blocks(self):
+        """
+        Order the samples as they appear in a preorder traversal of the tree. The samples below each node then occupy
+        the contiguous block sample_order[start:start + tree.num_samples(node)].
+
+        Returns
+        -------
+        sample_order : np.array of sample ids in preorder
+        block_starts : np.array with start of the block of each node in preorder
+        preorder : np.array of node ids in preorder
+        """
+        preorder = self.tree.preorder()
+        is_sample = np.array([self.tree.is_sample(u) for u in preorder], dtype=bool)
+        sample_order = preorder[is_sample]
+        block_starts = np.cumsum(is_sample) - is_sample
+
+        return sample_order, block_starts, preorder
+
+    def get_signature(self, sample_hashes):
+        """
+        Signature of the covariance of the tree, a digest of the height of the tree and of the clade and length of
+        each branch counted by TMRCA. Trees with the same signature have the same covariance. A clade is identified by
+        the sum (modulo 2^64) of random hashes of its samples, so the signature does not depend on node ids.
+
+        Parameters
+        ----------
+        sample_hashes : np.array of random np.uint64 values, one per sample id
+
+        Returns
+        -------
+        str
+        """
+        sample_order, block_starts, preorder = self.get_sample_blocks()
+        num_samples = np.array([self.tree.num_samples(u) for u in preorder])
+        times = self.tree.tree_sequence.nodes_time
+
+        # the clade hash of a node is the sum over its block of samples in preorder
+        cumulative_hashes = np.concatenate([np.zeros(1, dtype=np.uint64),
+                                            np.cumsum(sample_hashes[sample_order], dtype=np.uint64)])
+        counted = (num_samples > 0) & (num_samples < len(sample_order)) & (times[preorder] > 0)
+        nodes = preorder[counted]
+        starts = block_starts[counted]
+        clades = cumulative_hashes[starts + num_samples[counted]] - cumulative_hashes[starts]
+        lengths = times[self.tree.parent_array[nodes]] - times[nodes]
+
+        order = np.lexsort((lengths, clades))
+        digest = hashlib.sha256(np.float64(self.height).tobytes())
+        digest.update(clades[order].tobytes())
+        digest.update(lengths[order].tobytes())
+        return digest.hexdigest()
+
+    def TMRCA_nodes(self, num_haplotypes):
+        """
+        Reference implementation of TMRCA that scatters into the matrix with the sample list of each node. Kept to
+        benchmark TMRCA against (see benchmark_TMRCA.py).
+
+        see tskit to understand these classes: https://tskit.dev/tskit/docs/stable/python-api.html#the-tree-class
         
         - the goal of this function is to get pairwise branch lengths between all nodes of the tree
         - we go through all internal nodes and update the cells of all their descendants at once
@@ -137,62 +391,131 @@ class TTree:
             self.covariance = -TMRCA + self.height
         return self.covariance
 
-    def get_covariance_scaled(self, inds) -> np.array:
+    def get_covariance_scaled(self, inds, low_memory=False) -> np.array:
         """
         Caclulate scaled variance-covariance between haplotypes. This allows gcta REML to run without numeric issues
         such as singular Information matrix.
 
+        Parameters
+        ----------
+        inds : TInds
+        low_memory : bool
+            For diploids, accumulate the covariance between individuals directly from the branches of the tree
+            (see get_covariance_individuals) instead of collapsing the covariance between haplotypes.
+
         Returns
         -------
         Scaled variance-covariance matrix
 
         """
+        if low_memory and inds.ploidy == 2:
+            if self.covariance_scaled_diploid is None:
+                self.covariance_scaled_diploid = self.get_covariance_individuals(inds)
+                self.covariance_scaled_diploid *= float(inds.num_inds) / np.trace(self.covariance_scaled_diploid)
+            return self.covariance_scaled_diploid
+
         # calculate haploid covariance and covariance scaled
         if self.covariance is None:
             TMRCA = self.TMRCA(inds.num_haplotypes)
             self.covariance = -TMRCA + self.height
 
-        if self.covariance_scaled is None:
-            self.covariance_scaled = self.covariance * float(inds.num_haplotypes) / np.trace(self.covariance)
-
         if inds.ploidy == 1:
+            if self.covariance_scaled is None:
+                self.covariance_scaled = self.covariance * float(inds.num_haplotypes) / np.trace(self.covariance)
             return self.covariance_scaled
 
         # calculate diploid covariance scaled
         else:
             if self.covariance_scaled_diploid is None:
-                # logfile.add()
-
                 # add together unscaled covariance of haplotypes of one individual
-                self.covariance_diploid = np.zeros([inds.num_inds, inds.num_inds])
-
-                # off-diagonals upper triangle (this only works if ind assignment is equal to neighboring pairs!)
-                for i in range(inds.num_inds):
-                    # if i % 100 == 0:
-                    #     logfile.info("- Filling diploid covariance matrix for individual " + str(i) + " of " + str(inds.num_inds))
-                    i1 = i * 2
-                    i2 = i1 + 1
-                    for j in range(i + 1, inds.num_inds):
-                        j1 = j * 2
-                        j2 = j1 + 1
-                        self.covariance_diploid[i, j] = self.covariance[i1, j1] + self.covariance[i1, j2] + \
-                                                        self.covariance[i2, j1] + self.covariance[i2, j2]
-
-                # lower triangle
-                self.covariance_diploid = self.covariance_diploid + self.covariance_diploid.T
-
-                # diagonals
-                for ii in range(inds.num_inds):
-                    ii1 = inds.get_haplotypes(ii)[0]
-                    ii2 = inds.get_haplotypes(ii)[1]
-                    self.covariance_diploid[ii, ii] = 2.0 * self.height + 2.0 * self.covariance[ii1, ii2]
-
-                self.covariance_diploid = self.covariance_diploid * float(inds.num_inds) / np.trace(
+                self.covariance_diploid = inds.get_diploid_matrix(self.covariance)
+                self.covariance_scaled_diploid = self.covariance_diploid * float(inds.num_inds) / np.trace(
                     self.covariance_diploid)
 
-                # logfile.sub()
+            return self.covariance_scaled_diploid
 
-            return self.covariance_diploid
+    def get_branch_dosages(self, inds):
+        """
+        Branches counted by TMRCA (the ones below the MRCA of all samples) together with the number of haplotypes
+        each individual carries below them.
+
+        Parameters
+        ----------
+        inds : TInds
+
+        Returns
+        -------
+        dosages : scipy.sparse.csr_matrix of dimension num_inds x number of branches
+        lengths : np.array of branch lengths
+        """
+        sample_order, block_starts, preorder = self.get_sample_blocks()
+        individuals = inds.get_individuals(sample_order)
+
+        rows = []
+        columns = []
+        lengths = []
+        for c, start in zip(preorder, block_starts):
+            n = self.tree.num_samples(c)
+            if n == 0 or n == inds.num_haplotypes or self.tree.time(c) == 0:
+                continue
+            rows.append(individuals[start:start + n])
+            columns.append(np.repeat(len(lengths), n))
+            lengths.append(self.tree.time(self.tree.parent(c)) - self.tree.time(c))
+
+        rows = np.concatenate(rows) if len(rows) > 0 else np.zeros(0, dtype=int)
+        columns = np.concatenate(columns) if len(columns) > 0 else np.zeros(0, dtype=int)
+        # duplicate entries are summed, which gives the dosage
+        dosages = scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(inds.num_inds, len(lengths)))
+
+        return dosages, np.array(lengths)
+
+    def get_covariance_factored(self, inds, scaled=False):
+        """
+        Variance-covariance between individuals (or haplotypes if ploidy is 1) as a TFactoredCovariance, i.e. without
+        building a dense matrix.
+
+        Parameters
+        ----------
+        inds : TInds
+        scaled : bool
+            Scale the covariance such that its trace is the number of individuals, as in get_covariance_scaled.
+
+        Returns
+        -------
+        TFactoredCovariance
+        """
+        if self.height == -1:
+            raise ValueError("Cannot calculate covariance from tree with multiple roots")
+
+        dosages, lengths = self.get_branch_dosages(inds)
+        # the variance of each haplotype is the height of the tree, also the terminal branches and the ones above the
+        # MRCA of all samples count towards it
+        diagonal_correction = -(dosages @ lengths) + self.height * np.bincount(
+            inds.get_individuals(np.arange(inds.num_haplotypes)), minlength=inds.num_inds)
+        covariance = TFactoredCovariance(dosages, lengths, diagonal_correction)
+        if scaled:
+            covariance = covariance.scaled(float(inds.num_inds) / covariance.trace())
+
+        return covariance
+
+    def get_covariance_individuals(self, inds, chunk_size=256):
+        """
+        Calculate the (unscaled) variance-covariance between individuals directly from the branches of the tree,
+        without building the covariance between haplotypes. Each branch adds its length times the outer product of
+        its individual dosage vector. The result is the same as inds.get_diploid_matrix(get_covariance(inds)), but
+        only one num_inds x num_inds matrix is allocated.
+
+        Parameters
+        ----------
+        inds : TInds
+        chunk_size : int
+            Number of rows of the matrix filled at once.
+
+        Returns
+        -------
+        Variance-covariance matrix between individuals.
+        """
+        return self.get_covariance_factored(inds).to_dense(chunk_size=chunk_size)
 
     def get_eGRM(self, tskit_obj, tree_obj, inds, out, skip_first_tree, logfile):
         """       
@@ -221,11 +544,7 @@ class TTree:
             self.eGRM = EK_relate
 
             if inds.ploidy == 2:
-                N = self.eGRM.shape[0]
-                maternals = np.array(range(0, N, 2))
-                paternals = np.array(range(1, N, 2))
-                self.eGRM = 0.5 * (self.eGRM[maternals, :][:, maternals] + self.eGRM[maternals, :][:, paternals]
-                                   + self.eGRM[paternals, :][:, maternals] + self.eGRM[paternals, :][:, paternals])
+                self.eGRM = 0.5 * inds.get_diploid_matrix(self.eGRM)
 
         return self.eGRM, EK_relate_mu
 
@@ -242,16 +561,17 @@ class TTree:
 
         Returns
         -------
-        np.array if there are variants that are typed and have allele freq > 0. Otherwise None.
+        np.array and the number of variants if there are variants that are typed and have allele freq > 0.
+        Otherwise None and 0.
 
         """
         # tree_variant_info = variants.info[(variants.info['tree_index'] == self.index) & (variants.info['typed'] == True) & (variants.info['allele_freq'] > 0.0)]
         tree_variants = np.array(variants.variants)[
-            (variants.info['tree_index'] == self.index) & (variants.info['typed'] is True) & (
+            (variants.info['tree_index'] == self.index) & variants.info['typed'].to_numpy(dtype=bool) & (
                     variants.info['allele_freq'] > 0.0)]
         num_vars = tree_variants.shape[0]
         if num_vars == 0:
-            return None
+            return None, 0
 
         # loop over variants
         M_sum = np.zeros(shape=(inds.num_inds, inds.num_inds))
@@ -283,3 +603,629 @@ class TTree:
         tmp = np.dot(inv, array)
         # print("shape of my dot product",np.shape(tmp))
         return (tmp)
+
+
+class TFactoredCovariance:
+    """
+    Variance-covariance matrix of a marginal tree kept as a sum of one rank-1 term per branch plus a diagonal:
+
+        K = D diag(lengths) D^T + diag(diagonal_correction)
+
+    D is the sparse incidence matrix between rows (haplotypes or individuals) and the branches counted by TTree.TMRCA,
+    holding how many haplotypes of each row are below the branch. The diagonal correction makes the variance of each
+    haplotype equal to the height of the tree. Memory is O(N * depth) instead of O(N^2), and all methods except
+    to_dense work on the factors.
+    """
+
+    def __init__(self, incidence, lengths, diagonal_correction):
+        self.incidence: scipy.sparse.csr_matrix = incidence
+        self.lengths: np.array = lengths
+        self.diagonal_correction: np.array = diagonal_correction
+        self.dimension: int = incidence.shape[0]
+
+    def scaled(self, factor):
+        """
+        Returns a new TFactoredCovariance for factor * K.
+        """
+        return TFactoredCovariance(self.incidence, self.lengths * factor, self.diagonal_correction * factor)
+
+    def diagonal(self):
+        return self.incidence.multiply(self.incidence) @ self.lengths + self.diagonal_correction
+
+    def trace(self):
+        return np.sum(self.diagonal())
+
+    def matvec(self, x):
+        """
+        Product K x, x is a vector of length dimension or a matrix with dimension rows.
+        """
+        branch_sums = self.incidence.T @ x
+        if x.ndim == 1:
+            return self.incidence @ (self.lengths * branch_sums) + self.diagonal_correction * x
+        return self.incidence @ (self.lengths[:, np.newaxis] * branch_sums) + self.diagonal_correction[:,
+                                                                                np.newaxis] * x
+
+    def frobenius_norm(self):
+        """
+        ||K||_F. With M = D diag(lengths) D^T, ||M||_F^2 = sum_bc lengths_b lengths_c (D^T D)_bc^2. D^T D is only
+        non-zero for nested branches, so it stays sparse.
+        """
+        overlap = (self.incidence.T @ self.incidence).tocoo()
+        norm_squared = np.sum(self.lengths[overlap.row] * self.lengths[overlap.col] * overlap.data ** 2)
+        diagonal_branches = self.incidence.multiply(self.incidence) @ self.lengths
+        norm_squared += 2 * np.sum(self.diagonal_correction * diagonal_branches) + np.sum(
+            self.diagonal_correction ** 2)
+        return np.sqrt(norm_squared)
+
+    def to_dense(self, chunk_size=256):
+        """
+        Build the dense matrix, chunk_size rows at a time so that no other matrix of the same size is allocated.
+        """
+        incidence_weighted = self.incidence.multiply(self.lengths).tocsr()
+        incidence_transposed = self.incidence.T.tocsc()
+
+        covariance = np.empty([self.dimension, self.dimension])
+        for start in range(0, self.dimension, chunk_size):
+            end = min(start + chunk_size, self.dimension)
+            covariance[start:end, :] = (incidence_weighted[start:end, :] @ incidence_transposed).toarray()
+        covariance[np.diag_indices(self.dimension)] += self.diagonal_correction
+
+        return covariance
+
+
+class TIncrementalCovariance:
+    """
+    Haploid variance-covariance of the marginal trees of a tree sequence, obtained by updating the covariance of
+    the previous tree with the edges that are removed and inserted between the two trees (tskit edge_diffs).
+
+    The covariance of two samples i and j is time(m) - time(mrca(i, j)), where m is the MRCA of all samples
+    (TTree.TMRCA does not count the branches above it). We therefore keep the matrix of MRCA times and only update
+    the pairs whose MRCA can have changed. If neither path from i and j up to their new MRCA contains an inserted
+    edge, both paths were already in the previous tree and so was the MRCA. For an inserted edge (p, c), the samples
+    below c are thus paired with the samples that join them on the way up from p: at each ancestor, the samples below
+    its other children (and the ancestor itself if it is a sample) get the ancestor's time. The walk stops at the
+    first ancestor w that c was already below in the previous tree, e.g. at p itself if the edge only replaces a path
+    through removed nodes. Above w, the samples below c are on the same side as before, unless another inserted edge
+    on the path or on the path of the joining samples changed that, which is then updated by that edge. Below w, all
+    joining samples have a new MRCA with the samples below c. At w, only the pairs that were not below two different
+    children of w in the previous tree are updated. Edges below nodes that are new in this tree are not walked, the
+    walks of the inserted edges below them cover their samples, and the pairs between two children that both have
+    inserted edges are only updated by one of the two walks. The work per tree is thus about proportional to the
+    number of changed pairs plus the number of samples below the nodes w, instead of all pairs.
+
+    Trees with multiple roots are skipped, the first tree after them is built from scratch.
+
+    Rows and columns are in the order of ts_object.samples(). get_covariance returns the same matrix as
+    TTree.get_covariance, up to floating point rounding. The matrix is written into the same array for every tree,
+    so it is only valid until the next call of next_tree.
+    """
+
+    def __init__(self, ts_object):
+        self.index: int = -1
+        self._num_samples: int = ts_object.num_samples
+        self._sample_index = np.full(ts_object.num_nodes, -1)
+        self._sample_index[ts_object.samples()] = np.arange(self._num_samples)
+        self._tree = tskit.Tree(ts_object)
+        self._tree_previous = tskit.Tree(ts_object)
+        self._edge_diffs = ts_object.edge_diffs()
+        self._mrca_times = np.zeros([self._num_samples, self._num_samples])
+        self._covariance = np.empty([self._num_samples, self._num_samples])
+        self._valid: bool = False
+
+    def next_tree(self, skip=False):
+        """
+        Move to the next tree of the tree sequence. Must be called once per tree, in the same order as
+        ts_object.trees().
+
+        Parameters
+        ----------
+        skip : bool
+            Only move to the next tree without calculating its covariance. The next tree that is not skipped is
+            built from scratch.
+        """
+        interval, edges_out, edges_in = next(self._edge_diffs)
+        self._tree.next()
+        self.index += 1
+
+        if skip:
+            self._valid = False
+        elif len(self._tree.roots) == 1:
+            if self._valid:
+                self._update(edges_in)
+            else:
+                self._rebuild()
+            self._valid = True
+        else:
+            self._valid = False
+
+        self._tree_previous.next()
+
+    def is_valid(self):
+        """
+        Whether the covariance of the current tree is available, i.e. the tree was not skipped and has a single root.
+        """
+        return self._valid
+
+    def get_covariance(self):
+        """
+        Returns
+        -------
+        Variance-covariance matrix of the current tree, as calculated by TTree.get_covariance. It is overwritten
+        by the next tree.
+        """
+        if not self._valid:
+            raise ValueError("Cannot calculate covariance from tree with multiple roots")
+
+        root = self._tree.root
+        mrca = root
+        while True:
+            full_children = [c for c in self._tree.children(mrca) if
+                             self._tree.num_samples(c) == self._num_samples]
+            if len(full_children) == 0:
+                break
+            mrca = full_children[0]
+
+        np.subtract(self._tree.time(mrca), self._mrca_times, out=self._covariance)
+        np.fill_diagonal(self._covariance, self._tree.time(root))
+
+        return self._covariance
+
+    def _get_samples_below(self, tree, node):
+        samples = self._sample_index[tree.preorder(node)]
+        return samples[samples != -1]
+
+    def _get_sample_groups(self, tree, node):
+        """
+        Samples below each child of node. If node is a sample itself, it forms its own group.
+        """
+        groups = [self._get_samples_below(tree, c) for c in tree.children(node)]
+        if tree.is_sample(node):
+            groups.append(np.array([self._sample_index[node]]))
+        return [g for g in groups if len(g) > 0]
+
+    def _rebuild(self):
+        tree_obj = TTree(self._tree)
+        sample_order, block_starts, preorder = tree_obj.get_sample_blocks()
+        position = self._sample_index[sample_order]
+
+        # descendants come after their ancestors in preorder, so each pair ends up with the time of its MRCA
+        mrca_times = np.zeros([self._num_samples, self._num_samples])
+        for c, start in zip(preorder, block_starts):
+            n = self._tree.num_samples(c)
+            mrca_times[start:start + n, start:start + n] = self._tree.time(c)
+
+        self._mrca_times[np.ix_(position, position)] = mrca_times
+
+    def _is_new_node(self, node):
+        """
+        Whether node was not in the previous tree. All edges below such a node are inserted, their updates already
+        cover the pairs whose MRCA changed.
+        """
+        return (self._tree_previous.parent(node) == -1 and self._tree_previous.num_children(node) == 0 and not
+                self._tree_previous.is_sample(node))
+
+    def _set_mrca_time(self, samples1, samples2, time):
+        self._mrca_times[np.ix_(samples1, samples2)] = time
+        self._mrca_times[np.ix_(samples2, samples1)] = time
+
+    def _update(self, edges_in):
+        children = {edge.child for edge in edges_in if not self._is_new_node(edge.child)}
+        for child in children:
+            moved = self._get_samples_below(self._tree, child)
+            if len(moved) == 0:
+                continue
+
+            ancestors_previous = set()
+            node = self._tree_previous.parent(child)
+            while node != -1:
+                ancestors_previous.add(node)
+                node = self._tree_previous.parent(node)
+
+            below = child
+            node = self._tree.parent(child)
+            while node != -1:
+                # the pairs with the samples below a child with a smaller id whose edge is also inserted are updated
+                # by the walk of that child
+                joining = [self._get_samples_below(self._tree, c) for c in self._tree.children(node) if
+                           c != below and not (c in children and c < below)]
+                if self._tree.is_sample(node):
+                    joining.append(np.array([self._sample_index[node]]))
+                joining = np.concatenate(joining) if len(joining) > 0 else np.empty(0, dtype=int)
+                time = self._tree.time(node)
+
+                if node in ancestors_previous:
+                    # which child of node the samples were below in the previous tree
+                    labels = np.full(self._num_samples, -1)
+                    for g, group in enumerate(self._get_sample_groups(self._tree_previous, node)):
+                        labels[group] = g
+                    for label1 in np.unique(labels[moved]):
+                        for label2 in np.unique(labels[joining]):
+                            if label1 == -1 or label2 == -1 or label1 == label2:
+                                self._set_mrca_time(moved[labels[moved] == label1],
+                                                    joining[labels[joining] == label2], time)
+                    break
+
+                self._set_mrca_time(moved, joining, time)
+                below = node
+                node = self._tree.parent(node)
+
+
+class TIncrementalBranchSums:
+    """
+    Sums over the branches of the marginal trees of a tree sequence from which the sums over the haploid covariance
+    needed for HE regression follow (see variance_components.covariance_moments), without building any matrix.
+
+    The covariance is K = D diag(l) D^T + diag(H - a), with D the incidence between samples and the branches counted
+    by TTree.TMRCA (not the terminal branches and not the ones above the MRCA m of all samples), l their lengths, H
+    the height of the tree and a_i the sum of the counted branches above sample i. For a branch b with n_b samples
+    below it, the sum s_b and the sum of squares q_b of the phenotype over these samples, e.g.
+
+        y^T K y = sum_b l_b s_b^2 + H sum_i y_i^2 - sum_b l_b q_b
+
+    Two counted branches overlap only if one is above the other, so that also the Frobenius norm of K is a sum over
+    branches: sum_b l_b^2 n_b^2 + 2 sum_c l_c w_c, with w_c the sum of l_b n_b^2 over the counted branches b below
+    c. All terms of these sums are positive, nothing cancels.
+
+    n_b, s_b, q_b and w_b are kept per node and updated with the edges that are removed and inserted between two
+    trees (tskit edge_diffs): the clade of the child of an edge is subtracted from or added to all nodes above it. The
+    contribution of each changed branch to the sums is replaced, so the work per tree is proportional to the number
+    of changed edges times the depth of the tree, independent of the number of samples. Every recompute_every trees,
+    all sums are recalculated from the current tree, so that the rounding errors of the updates do not accumulate
+    along the tree sequence.
+
+    Only haploid samples are supported: the samples are the individuals, in the order of ts_object.samples(). The
+    phenotypes are the columns of y.
+    """
+
+    # branch sums that do not depend on the phenotype: l n, l n^2, l^2 n^2, l w, l^2 n, l v (see _update_branch)
+    _NUM_SUMS = 6
+
+    def __init__(self, ts_object, y, recompute_every=1000):
+        """
+        Parameters
+        ----------
+        ts_object : tskit.TreeSequence
+        y : np.array
+            Phenotype, or matrix with one phenotype per column, one row per sample.
+        recompute_every : int
+            Number of trees after which all sums are recalculated from scratch instead of updated.
+        """
+        self.index: int = -1
+        self._num_samples: int = ts_object.num_samples
+        self._y = np.asarray(y, dtype=float).reshape(self._num_samples, -1)
+        self._y_squared_sum = np.sum(self._y ** 2, axis=0)
+        self._times = ts_object.tables.nodes.time
+        self._edge_diffs = ts_object.edge_diffs()
+        self._samples = ts_object.samples()
+        self._recompute_every = recompute_every
+
+        num_nodes = ts_object.num_nodes
+        num_phenotypes = self._y.shape[1]
+        self._parent = np.full(num_nodes, -1)
+        self._num_below = np.zeros(num_nodes)
+        self._sum_below = np.zeros([num_nodes, num_phenotypes])
+        self._squares_below = np.zeros([num_nodes, num_phenotypes])
+        # sums of l n and l n^2 over the counted branches below each node
+        self._weighted_below = np.zeros([num_nodes, 2])
+
+        # current contribution of each branch (indexed by its child node) and their totals
+        self._contribution = np.zeros([num_nodes, self._NUM_SUMS])
+        self._contribution_y = np.zeros([num_nodes, 3, num_phenotypes])
+        self._sums = np.zeros(self._NUM_SUMS)
+        self._sums_y = np.zeros([3, num_phenotypes])
+        self._reset()
+
+        self.height: float = -1.0
+
+    def next_tree(self):
+        """
+        Move to the next tree of the tree sequence. Must be called once per tree, in the same order as
+        ts_object.trees().
+        """
+        interval, edges_out, edges_in = next(self._edge_diffs)
+        self.index += 1
+
+        if self.index % self._recompute_every == 0:
+            for edge in edges_out:
+                self._parent[edge.child] = -1
+            for edge in edges_in:
+                self._parent[edge.child] = edge.parent
+            self._recompute()
+        else:
+            for edge in edges_out:
+                below = -(self._weighted_below[edge.child] + self._contribution[edge.child, :2])
+                self._parent[edge.child] = -1
+                self._update_branch(edge.child)
+                self._add_to_ancestors(edge.parent, edge.child, -1, below)
+            for edge in edges_in:
+                self._parent[edge.child] = edge.parent
+                self._update_branch(edge.child)
+                below = self._weighted_below[edge.child] + self._contribution[edge.child, :2]
+                self._add_to_ancestors(edge.parent, edge.child, 1, below)
+
+        # height of the tree, the tree has multiple roots if the root above the first sample is not above all samples
+        node = self._samples[0]
+        while self._parent[node] != -1:
+            node = self._parent[node]
+        self.height = self._times[node] if self._num_below[node] == self._num_samples else -1.0
+
+    def _add_to_ancestors(self, node, child, sign, weighted):
+        """
+        Add (sign 1) or remove (sign -1) the clade of child to or from all nodes from node up to the root. weighted
+        is the change of the sums of l n and l n^2 below node, it grows by the changes of the branches on the way.
+        """
+        while node != -1:
+            self._num_below[node] += sign * self._num_below[child]
+            self._sum_below[node] += sign * self._sum_below[child]
+            self._squares_below[node] += sign * self._squares_below[child]
+            self._weighted_below[node] += weighted
+            weighted = weighted - self._contribution[node, :2]
+            self._update_branch(node)
+            weighted += self._contribution[node, :2]
+            node = self._parent[node]
+
+    def _update_branch(self, node):
+        self._sums -= self._contribution[node]
+        self._sums_y -= self._contribution_y[node]
+
+        parent = self._parent[node]
+        n = self._num_below[node]
+        if parent == -1 or n == self._num_samples or self._times[node] == 0:
+            self._contribution[node] = 0
+            self._contribution_y[node] = 0
+            return
+
+        length = self._times[parent] - self._times[node]
+        n_below, n_squared_below = self._weighted_below[node]
+        self._contribution[node] = [length * n, length * n ** 2, length ** 2 * n ** 2, length * n_squared_below,
+                                    length ** 2 * n, length * n_below]
+        self._contribution_y[node, 0] = length * self._sum_below[node] ** 2
+        self._contribution_y[node, 1] = length * self._squares_below[node]
+        self._contribution_y[node, 2] = length * n * self._squares_below[node]
+
+        self._sums += self._contribution[node]
+        self._sums_y += self._contribution_y[node]
+
+    def _reset(self):
+        self._num_below[:] = 0
+        self._sum_below[:] = 0
+        self._squares_below[:] = 0
+        self._weighted_below[:] = 0
+        self._num_below[self._samples] = 1
+        self._sum_below[self._samples] = self._y
+        self._squares_below[self._samples] = self._y ** 2
+        self._contribution[:] = 0
+        self._contribution_y[:] = 0
+        self._sums[:] = 0
+        self._sums_y[:] = 0
+
+    def _recompute(self):
+        """
+        Calculate all sums of the current tree from scratch. Children are younger than their parents, so the nodes
+        are visited from the youngest to the oldest.
+        """
+        self._reset()
+        nodes = np.flatnonzero(self._parent != -1)
+        nodes = nodes[np.argsort(self._times[nodes], kind="stable")]
+        for node in nodes:
+            parent = self._parent[node]
+            self._num_below[parent] += self._num_below[node]
+            self._sum_below[parent] += self._sum_below[node]
+            self._squares_below[parent] += self._squares_below[node]
+        for node in nodes:
+            self._update_branch(node)
+            self._weighted_below[self._parent[node]] += self._weighted_below[node] + self._contribution[node, :2]
+
+    def get_covariance_moments(self, scaled=False):
+        """
+        Parameters
+        ----------
+        scaled : bool
+            Moments of the covariance scaled such that its trace is the number of samples, as in
+            TTree.get_covariance_scaled.
+
+        Returns
+        -------
+        dict with the same entries as variance_components.covariance_moments(covariance, y) for the haploid
+        covariance of the current tree, the phenotype dependent ones are np.arrays with one entry per phenotype
+        """
+        if self.height == -1:
+            raise ValueError("Cannot calculate covariance from tree with multiple roots")
+
+        l_n, l_nn, ll_nn, l_w, ll_n, l_v = self._sums
+        l_ss, l_q, l_nq = self._sums_y
+        N = self._num_samples
+        H = self.height
+
+        # squared Frobenius norm of D diag(l) D^T and sum of squares of its diagonal a
+        frobenius_branches = ll_nn + 2 * l_w
+        a_squared = ll_n + 2 * l_v
+
+        moments = {'sum': l_nn + N * H - l_n,
+                   'trace': N * H,
+                   'diagonal_squared': N * H ** 2,
+                   'frobenius_squared': frobenius_branches + N * H ** 2 - a_squared,
+                   'yKy': l_ss + H * self._y_squared_sum - l_q,
+                   'diagonal_y_squared': H * self._y_squared_sum,
+                   'row_sums_y_squared': l_nq + H * self._y_squared_sum - l_q}
+
+        if scaled:
+            factor = 1.0 / H
+            for name in moments:
+                moments[name] = moments[name] * (factor ** 2 if name in ['diagonal_squared', 'frobenius_squared']
+                                                 else factor)
+
+        return moments
+
+
+class _TCovarianceCursor:
+    """
+    Moves along the genome and integrates the haploid covariance of the trees it passes (see TWindowCovariance).
+    """
+
+    def __init__(self, ts_object, skip_first_tree=False):
+        self._covariance_engine = TIncrementalCovariance(ts_object)
+        self._breakpoints = ts_object.breakpoints(as_array=True)
+        self._num_trees = ts_object.num_trees
+        self._skip_first_tree = skip_first_tree
+        self._covariance = None
+        self.position: float = 0.0
+
+    def _next_tree(self, skip):
+        self._covariance_engine.next_tree(skip=skip)
+        self._covariance = None
+
+    def _current_covariance(self):
+        """
+        Covariance of the current tree, None if it has multiple roots or is the first tree and skipped.
+        """
+        if self._skip_first_tree and self._covariance_engine.index == 0:
+            return None
+        if self._covariance is None and self._covariance_engine.is_valid():
+            self._covariance = self._covariance_engine.get_covariance()
+        return self._covariance
+
+    def _tree_index_at(self, position):
+        # index of the tree containing position, the last tree for the end of the sequence
+        return min(np.searchsorted(self._breakpoints, position, side='right') - 1, self._num_trees - 1)
+
+    def move_to(self, position):
+        """
+        Move to position without integrating. The trees before the one containing position are skipped, their
+        covariance is not needed.
+        """
+        tree_index = self._tree_index_at(position)
+        while self._covariance_engine.index < tree_index - 1:
+            self._next_tree(skip=True)
+        self.position = position
+
+    def integrate_to(self, position, covariance_sum):
+        """
+        Add the integral of the covariance from the current position to position to covariance_sum and move there.
+
+        Returns
+        -------
+        Length of the integrated part of the genome that is covered by trees with a single root.
+        """
+        span = 0.0
+        while self.position < position:
+            while self._covariance_engine.index < self._tree_index_at(self.position):
+                self._next_tree(skip=False)
+            tree_end = self._breakpoints[self._covariance_engine.index + 1]
+            length = min(position, tree_end) - self.position
+            covariance = self._current_covariance()
+            if covariance is not None:
+                covariance_sum += length * covariance
+                span += length
+            self.position += length
+        return span
+
+
+class TWindowCovariance:
+    """
+    Span-weighted mean of the haploid covariances of the trees overlapping genomic windows. Each tree contributes its
+    covariance (as TTree.get_covariance) times the length of its overlap with the window, trees with multiple roots
+    (and optionally the first tree) are left out.
+
+    The windows are processed in order. The sum over a window is updated from the sum over the previous window by
+    adding the integral of the covariance over the part entering at the right and subtracting the integral over the
+    part leaving at the left, i.e. as the difference of prefix sums. Two cursors walk along the genome for this, one
+    at the right and one at the left end of the windows, each with its own TIncrementalCovariance. Every tree
+    covariance is thus calculated at most twice, and the memory is a fixed number of N x N matrices, whatever the
+    number of trees in a window.
+
+    The sum is started from zero at restart points that only depend on the windows: a window that does not overlap
+    the previous one, and otherwise about every restart_every windows. The additions and subtractions that lead to
+    the sum of a window therefore start at the same restart point whichever windows are requested, so that the
+    covariances are identical if the windows are split over worker processes, and rounding errors do not accumulate
+    along long scans. At a restart within overlapping windows the right cursor is already past the start of the
+    window, a third cursor that trails behind takes its place. The restart points are chosen such that the trailing
+    cursor is never past the start of a window at which it is needed.
+    """
+
+    def __init__(self, ts_object, windows, skip_first_tree=False, restart_every=50):
+        """
+        Parameters
+        ----------
+        ts_object : tskit.TreeSequence
+        windows : np.array of dimension number of windows x 2 with start and end of the windows, starts and ends
+            must be non-decreasing
+        skip_first_tree : bool
+            Leave the first tree out of all windows
+        restart_every : int
+            Minimal number of windows between two restart points within overlapping windows
+        """
+        self._windows = np.asarray(windows, dtype=float).reshape(-1, 2)
+        if np.any(np.diff(self._windows, axis=0) < 0):
+            raise ValueError("Window starts and ends must be non-decreasing")
+        self._num_samples = ts_object.num_samples
+        self._right = _TCovarianceCursor(ts_object, skip_first_tree)
+        self._left = _TCovarianceCursor(ts_object, skip_first_tree)
+        self._trailing = _TCovarianceCursor(ts_object, skip_first_tree)
+
+        # last restart point at or before each window. The trailing cursor takes the place of the right cursor at a
+        # restart within overlapping windows, and the right cursor, at the end of the previous window, trails behind
+        # from then on
+        self._last_restart = np.zeros(len(self._windows), dtype=int)
+        trailing_position = 0.0
+        last_restart = 0
+        for index, (start, end) in enumerate(self._windows):
+            if index > 0 and start < self._windows[index - 1, 1]:
+                if index - last_restart >= restart_every and start >= trailing_position:
+                    trailing_position = self._windows[index - 1, 1]
+                    last_restart = index
+            else:
+                last_restart = index
+            self._last_restart[index] = last_restart
+
+    def _restart(self, start, end, covariance_sum):
+        # all cursors only move forwards
+        if self._right.position > start:
+            self._right, self._trailing = self._trailing, self._right
+        if self._right.position > start:
+            raise ValueError("Cannot restart the window sum at " + str(start) + ", the cursors are past it")
+        covariance_sum[:] = 0
+        self._right.move_to(start)
+        self._left.move_to(start)
+        return self._right.integrate_to(end, covariance_sum)
+
+    def covariances(self, indices=None):
+        """
+        Generator of the windows and their covariance.
+
+        Parameters
+        ----------
+        indices : increasing indices of the windows whose covariance is needed, all windows if None. The windows
+            between the last restart point before a requested window and the window are also summed.
+
+        Returns
+        -------
+        index of the window, mean covariance between haplotypes (None if the window is not covered by any tree with a
+        single root)
+        """
+        if indices is None:
+            indices = range(len(self._windows))
+        covariance_sum = np.zeros([self._num_samples, self._num_samples])
+        leaving = np.zeros([self._num_samples, self._num_samples])
+        span = 0.0
+        # last window whose sum is in covariance_sum
+        current = -1
+        for index in indices:
+            # the windows before the last restart point are not needed
+            current = max(current, self._last_restart[index] - 1)
+            while current < index:
+                current += 1
+                start, end = self._windows[current]
+                if self._last_restart[current] == current:
+                    span = self._restart(start, end, covariance_sum)
+                    continue
+                span += self._right.integrate_to(end, covariance_sum)
+                if self._left.position < start:
+                    leaving[:] = 0
+                    span -= self._left.integrate_to(start, leaving)
+                    covariance_sum -= leaving
+
+            if span <= 0:
+                yield index, None
+            else:
+                yield index, covariance_sum / span
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare run time of TTree.TMRCA (contiguous sample blocks) with TTree.TMRCA_nodes (per-node scatter) on msprime
+trees and check that both return identical matrices.
+
+usage: python benchmark_TMRCA.py [sample sizes]
+"""
+import sys
+import time
+import msprime
+import numpy as np
+import TTree as tt
+
+
+def time_function(function, num_haplotypes):
+    start = time.time()
+    result = function(num_haplotypes)
+    return result, time.time() - start
+
+
+sample_sizes = [int(s) for s in sys.argv[1:]] if len(sys.argv) > 1 else [500, 1000, 2000, 5000, 10000]
+
+print("num_haplotypes", "time_TMRCA_nodes", "time_TMRCA", "identical", sep="\t")
+for num_haplotypes in sample_sizes:
+    trees = msprime.sim_ancestry(samples=num_haplotypes, ploidy=1, sequence_length=1, random_seed=1)
+    tree_obj = tt.TTree(trees.first())
+
+    tmrca, time_blocks = time_function(tree_obj.TMRCA, num_haplotypes)
+    tmrca_nodes, time_nodes = time_function(tree_obj.TMRCA_nodes, num_haplotypes)
+
+    print(num_haplotypes, round(time_nodes, 3), round(time_blocks, 3), np.array_equal(tmrca, tmrca_nodes), sep="\t")
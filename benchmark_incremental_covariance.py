@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare run time of the incremental covariance of TTree.TIncrementalCovariance (updated with the edge differences
+between trees) with building the covariance of each tree from scratch (TTree.get_covariance) on msprime tree
+sequences and check that both return the same matrices.
+
+usage: python benchmark_incremental_covariance.py [sample sizes]
+"""
+import sys
+import time
+import msprime
+import numpy as np
+import TTree as tt
+
+
+class Inds:
+    def __init__(self, num_haplotypes):
+        self.num_haplotypes = num_haplotypes
+
+
+sample_sizes = [int(s) for s in sys.argv[1:]] if len(sys.argv) > 1 else [500, 1000, 2000]
+
+print("num_haplotypes", "num_trees", "time_rebuild", "time_incremental", "max_abs_diff", sep="\t")
+for num_haplotypes in sample_sizes:
+    trees = msprime.sim_ancestry(samples=num_haplotypes, ploidy=1, sequence_length=2e5, recombination_rate=1e-8,
+                                 population_size=1e4, random_seed=1)
+    inds = Inds(num_haplotypes)
+    covariance_engine = tt.TIncrementalCovariance(trees)
+
+    time_rebuild = 0
+    time_incremental = 0
+    max_diff = 0
+    for tree in trees.trees():
+        start = time.time()
+        covariance_engine.next_tree()
+        covariance = covariance_engine.get_covariance()
+        time_incremental += time.time() - start
+
+        start = time.time()
+        covariance_rebuild = tt.TTree(tree).get_covariance(inds)
+        time_rebuild += time.time() - start
+
+        max_diff = max(max_diff, np.max(np.abs(covariance - covariance_rebuild)))
+
+    print(num_haplotypes, trees.num_trees, round(time_rebuild, 3), round(time_incremental, 3), max_diff, sep="\t")
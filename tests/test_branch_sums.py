@@ -0,0 +1,25 @@
+import msprime
+import numpy as np
+import pytest
+import TIndividuals as ti
+import TTree as tt
+import variance_components as vc
+
+
+@pytest.mark.parametrize("recompute_every", [1, 100, 10 ** 9])
+def test_branch_sums_equal_dense_moments_along_long_sequence(recompute_every):
+    ts = msprime.sim_ancestry(50, ploidy=1, sequence_length=3e6, recombination_rate=1e-8, population_size=1e4,
+                             random_seed=6)
+    inds = ti.Individuals(1, ts.num_samples)
+    y = vc.standardize(np.random.default_rng(0).normal(size=(ts.num_samples, 2)))
+    branch_sums = tt.TIncrementalBranchSums(ts, y, recompute_every=recompute_every)
+
+    assert ts.num_trees > 1000
+    for tree in ts.trees():
+        branch_sums.next_tree()
+        if tree.index % 25 != 0 and tree.index != ts.num_trees - 1:
+            continue
+        moments = branch_sums.get_covariance_moments(scaled=True)
+        expected = vc.covariance_moments(tt.TTree(tree).get_covariance_scaled(inds), y)
+        for name in expected:
+            np.testing.assert_allclose(moments[name], expected[name], rtol=1e-11, err_msg=name)
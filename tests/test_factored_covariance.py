@@ -0,0 +1,46 @@
+import msprime
+import numpy as np
+import pytest
+import TIndividuals as ti
+import TTree as tt
+import variance_components as vc
+
+
+@pytest.fixture(params=[1, 2])
+def tree_and_inds(request):
+    ploidy = request.param
+    ts = msprime.sim_ancestry(20, ploidy=ploidy, sequence_length=1e4, recombination_rate=0, population_size=1e4,
+                              random_seed=7)
+    return tt.TTree(ts.first()), ti.Individuals(ploidy, ts.num_samples)
+
+
+def test_factored_covariance_equals_dense(tree_and_inds):
+    tree_obj, inds = tree_and_inds
+    dense = tree_obj.get_covariance_scaled(inds)
+    factored = tree_obj.get_covariance_factored(inds, scaled=True)
+    x = np.random.default_rng(1).normal(size=(inds.num_inds, 3))
+
+    np.testing.assert_allclose(factored.to_dense(chunk_size=7), dense, rtol=1e-10, atol=1e-10)
+    np.testing.assert_allclose(factored.diagonal(), np.diagonal(dense), rtol=1e-10)
+    np.testing.assert_allclose(factored.trace(), inds.num_inds, rtol=1e-10)
+    np.testing.assert_allclose(factored.frobenius_norm(), np.linalg.norm(dense), rtol=1e-10)
+    np.testing.assert_allclose(factored.matvec(x), dense @ x, rtol=1e-10, atol=1e-10)
+    np.testing.assert_allclose(factored.matvec(x[:, 0]), dense @ x[:, 0], rtol=1e-10, atol=1e-10)
+
+
+def test_tests_on_factored_covariance(tree_and_inds):
+    tree_obj, inds = tree_and_inds
+    dense = tree_obj.get_covariance_scaled(inds)
+    factored = tree_obj.get_covariance_factored(inds, scaled=True)
+    y = np.random.default_rng(2).normal(size=(inds.num_inds, 4))
+
+    score_dense = vc.score_test(dense, y)
+    score_factored = vc.score_test(factored, y)
+    for field in ["Q", "scale", "df", "Pval"]:
+        np.testing.assert_allclose(score_factored[field], score_dense[field], rtol=1e-10)
+
+    for result_dense, result_factored in zip(vc.HE_regression(dense, y[:, 0]), vc.HE_regression(factored, y[:, 0])):
+        for field in ["Estimate", "SE_OLS", "P_OLS"]:
+            np.testing.assert_allclose(result_factored[field], result_dense[field], rtol=1e-10)
+        # the jackknife needs the dense covariance
+        assert np.isnan(result_factored["SE_Jackknife"])
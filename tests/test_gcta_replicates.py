@@ -0,0 +1,80 @@
+import logging
+import os
+import stat
+import sys
+import types
+import msprime
+import numpy as np
+import pytest
+import TAssociationTesting as at
+import TGCTA
+import TIndividuals as ti
+import TPhenotypes as tp
+
+# stands in for GCTA: reads the files written for GCTA and writes the results of variance_components in the format of
+# GCTA, for the phenotype column selected with --mpheno
+fake_gcta = """#!{python}
+import sys
+sys.path.insert(0, {repo!r})
+import numpy as np
+import pandas as pd
+import variance_components as vc
+import validate_HE
+
+arguments = sys.argv[1:]
+value = {{arguments[i]: arguments[i + 1] for i in range(len(arguments) - 1) if arguments[i].startswith("--")}}
+column = int(value.get("--mpheno", 1))
+with open(sys.argv[0] + ".calls", "a") as calls:
+    calls.write(str(column) + "\\n")
+y = pd.read_csv(value["--pheno"], sep=r"\\s+", header=None)[column + 1].to_numpy()
+covariance = validate_HE.read_grm_bin(value["--grm"], len(y))
+with open(value["--out"] + (".HEreg" if "--HEreg" in arguments else ".hsq"), "w") as f:
+    if "--HEreg" in arguments:
+        for name, result in zip(["HE-CP", "HE-SD"], vc.HE_regression(covariance=covariance, y=y)):
+            f.write(name + "\\nCoefficient Estimate SE_OLS SE_Jackknife P_OLS P_Jackknife\\n")
+            f.write("V(G)/Vp " + " ".join("%.10g" % result[k] for k in validate_HE.fields) + "\\n")
+    else:
+        variance, SE = vc.REML(covariance=covariance, y=y)
+        f.write("Source Variance SE\\n")
+        for name in variance:
+            f.write(name + " %.10g" % variance[name] + (" %.10g" % SE[name] if name in SE else "") + "\\n")
+"""
+
+
+@pytest.fixture
+def gcta(tmp_path):
+    executable = tmp_path / "gcta"
+    executable.write_text(fake_gcta.format(python=sys.executable,
+                                           repo=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    executable.chmod(executable.stat().st_mode | stat.S_IEXEC)
+    return TGCTA.TGCTA(executable=str(executable), retries=0)
+
+
+@pytest.mark.parametrize("association_class, p_values", [
+    (at.TAssociationTesting_trees_gcta_HE, "p_values_HECP_Jackknife"),
+    (at.TAssociationTesting_trees_gcta_REML, "p_values")])
+def test_gcta_tests_each_replicate(tmp_path, gcta, association_class, p_values):
+    logfile = logging.getLogger("test_gcta_replicates")
+    # a few trees, each GCTA call starts a python process
+    trees = msprime.sim_ancestry(20, ploidy=1, sequence_length=1e5, recombination_rate=1e-9, population_size=1e4,
+                                 random_seed=2)
+    inds = ti.Individuals(1, trees.num_samples)
+    phenotypes = tp.Phenotypes(types.SimpleNamespace(number=0), inds, logfile)
+    phenotypes.y = np.random.default_rng(5).normal(size=(inds.num_inds, 3))
+    phenotypes.causal_tree_indeces = []
+    out = str(tmp_path / "run")
+    phenotypes.write_to_file_gcta_scaled(out=out + "gcta", logfile=logfile)
+
+    results = {}
+    for engine in ["gcta", "native"]:
+        association = association_class(trees, phenotypes, engine=engine, gcta=gcta)
+        association.run_association(trees, None, inds, out + engine, logfile, covariance_type="scaled",
+                                    skip_first_tree=False)
+        results[engine] = getattr(association, p_values)
+
+    # one GCTA call per tree and phenotype, on the same GRM files
+    with open(gcta.executable + ".calls") as calls:
+        assert [int(c) for c in calls] == [1, 2, 3] * trees.num_trees
+    assert results["gcta"].shape == (trees.num_trees, 3)
+    # the covariance is written as float32 for GCTA
+    np.testing.assert_allclose(results["gcta"], results["native"], rtol=1e-4)
@@ -0,0 +1,56 @@
+import msprime
+import numpy as np
+import pytest
+import TTree as tt
+
+
+class Inds:
+    def __init__(self, num_haplotypes):
+        self.num_haplotypes = num_haplotypes
+
+
+def simulate(model):
+    if model == "hudson":
+        return msprime.sim_ancestry(30, ploidy=1, sequence_length=2e5, recombination_rate=1e-8, population_size=1e4,
+                                    random_seed=5)
+    if model == "full_arg":
+        return msprime.sim_ancestry(15, ploidy=2, sequence_length=2e5, recombination_rate=1e-8, population_size=1e4,
+                                    random_seed=5, record_full_arg=True)
+    # discrete generations give polytomies and nodes with equal times
+    return msprime.sim_ancestry(15, ploidy=2, sequence_length=2e5, recombination_rate=1e-7, population_size=50,
+                                random_seed=5, model="dtwf")
+
+
+@pytest.mark.parametrize("model", ["hudson", "full_arg", "dtwf"])
+def test_incremental_covariance_equals_rebuild(model):
+    ts = simulate(model)
+    inds = Inds(ts.num_samples)
+    covariance_engine = tt.TIncrementalCovariance(ts)
+    num_tested = 0
+    for tree in ts.trees():
+        covariance_engine.next_tree(skip=tree.index % 10 == 3)
+        if covariance_engine.is_valid():
+            expected = tt.TTree(tree).get_covariance(inds)
+            np.testing.assert_allclose(covariance_engine.get_covariance(), expected, rtol=1e-10, atol=1e-8)
+            num_tested += 1
+    assert num_tested > 10
+
+
+def test_incremental_covariance_writes_fewer_pairs_than_rebuild(monkeypatch):
+    ts = msprime.sim_ancestry(300, ploidy=1, sequence_length=1e5, recombination_rate=1e-8, population_size=1e4,
+                             random_seed=2)
+    covariance_engine = tt.TIncrementalCovariance(ts)
+    set_mrca_time = covariance_engine._set_mrca_time
+    num_written = [0]
+
+    def count_pairs(samples1, samples2, time):
+        num_written[0] += 2 * len(samples1) * len(samples2)
+        set_mrca_time(samples1, samples2, time)
+
+    monkeypatch.setattr(covariance_engine, "_set_mrca_time", count_pairs)
+    for _ in range(ts.num_trees):
+        covariance_engine.next_tree()
+
+    # a rebuild writes all pairs of every tree after the first
+    assert ts.num_trees > 20
+    assert num_written[0] < 0.25 * (ts.num_trees - 1) * ts.num_samples ** 2
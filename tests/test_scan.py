@@ -0,0 +1,35 @@
+import msprime
+import numpy as np
+import pytest
+import TTree as tt
+
+
+def with_sample_free_component(ts):
+    # two non-sample nodes connected by an edge over the whole sequence, a component of every tree without samples
+    tables = ts.dump_tables()
+    child = tables.nodes.add_row(time=1.0)
+    parent = tables.nodes.add_row(time=2.0)
+    tables.edges.add_row(left=0, right=ts.sequence_length, parent=parent, child=child)
+    tables.sort()
+    return tables.tree_sequence()
+
+
+def with_fewer_samples(ts):
+    # unsimplified: the lineages of the former samples stay in the trees, some without samples below them
+    tables = ts.dump_tables()
+    flags = tables.nodes.flags
+    flags[ts.samples()[::2]] = 0
+    tables.nodes.flags = flags
+    return tables.tree_sequence()
+
+
+@pytest.mark.parametrize("transform", [lambda ts: ts, lambda ts: ts.decapitate(0.5 * ts.max_root_time),
+                                       with_sample_free_component, with_fewer_samples])
+def test_scan_counts_roots_with_samples(transform):
+    ts = msprime.sim_ancestry(10, ploidy=1, sequence_length=1e5, recombination_rate=1e-8, population_size=1e4,
+                             random_seed=3, record_full_arg=True)
+    ts = transform(ts)
+    scan = tt.TTrees.scan(ts)
+    expected = [len(tt.TTree(tree).tree.roots) for tree in ts.trees()]
+    np.testing.assert_array_equal(scan['num_roots'].to_numpy(), expected)
+    assert np.array_equal(tt.TTrees.skip_reasons(scan) == "", np.array(expected) == 1)
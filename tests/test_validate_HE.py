@@ -0,0 +1,79 @@
+import os
+import numpy as np
+import pytest
+import validate_HE
+import variance_components as vc
+
+
+def gcta_output(prefix):
+    return prefix + "_GRM_covariance_tests.HEreg"
+
+
+@pytest.mark.parametrize("prefix", validate_HE.fixture_prefixes(), ids=os.path.basename)
+def test_HE_matches_GCTA(prefix):
+    if not os.path.exists(gcta_output(prefix)):
+        pytest.skip("no GCTA output " + gcta_output(prefix) + ", create it with python validate_HE.py --run_gcta")
+    for method, diffs, close in validate_HE.compare(prefix):
+        assert all(close), (method, dict(zip(validate_HE.fields, diffs)))
+
+
+def brute_force_HE(covariance, y):
+    """
+    HE-CP and HE-SD slopes, OLS standard errors and delete-one-pair jackknife standard errors with an explicit
+    least-squares fit for every set of pairs.
+    """
+    y = (y - np.mean(y)) / np.std(y, ddof=1)
+    rows, columns = np.triu_indices(len(y), k=1)
+    x = covariance[rows, columns]
+    design = np.column_stack([np.ones(len(x)), x])
+    results = {}
+    for method, z in (("CP", y[rows] * y[columns]), ("SD", (y[rows] - y[columns]) ** 2)):
+        coefficients, residual_sum_of_squares, _, _ = np.linalg.lstsq(design, z, rcond=None)
+        se = np.sqrt(residual_sum_of_squares[0] / (len(x) - 2) * np.linalg.inv(design.T @ design)[1, 1])
+        keep = np.ones(len(x), dtype=bool)
+        slopes = np.empty(len(x))
+        for k in range(len(x)):
+            keep[k] = False
+            slopes[k] = np.linalg.lstsq(design[keep], z[keep], rcond=None)[0][1]
+            keep[k] = True
+        se_jackknife = np.sqrt((len(x) - 1) / len(x) * np.sum((slopes - np.mean(slopes)) ** 2))
+        results[method] = coefficients[1], se, se_jackknife
+    return results
+
+
+@pytest.mark.parametrize("prefix", validate_HE.fixture_prefixes(), ids=os.path.basename)
+def test_HE_matches_brute_force(prefix):
+    covariance, y = validate_HE.read_inputs(prefix)
+    HE_CP, HE_SD = vc.HE_regression(covariance=covariance, y=y)
+    reference = brute_force_HE(covariance, y)
+    for result, method, factor in ((HE_CP, "CP", 1.0), (HE_SD, "SD", -0.5)):
+        slope, se, se_jackknife = reference[method]
+        np.testing.assert_allclose(result["Estimate"], factor * slope, rtol=1e-8)
+        np.testing.assert_allclose(result["SE_OLS"], abs(factor) * se, rtol=1e-8)
+        np.testing.assert_allclose(result["SE_Jackknife"], abs(factor) * se_jackknife, rtol=1e-8)
+
+
+def write_HEreg(file_name, results):
+    with open(file_name, "w") as f:
+        for method, result in zip(["HE-CP", "HE-SD"], results):
+            f.write(method + "\n")
+            f.write("Coefficient\t" + "\t".join(validate_HE.fields) + "\n")
+            f.write("V(G)/Vp\t" + "\t".join("%.6g" % result[field] for field in validate_HE.fields) + "\n")
+
+
+def test_compare_tolerances(tmp_path):
+    # GCTA writes about 6 significant digits, which must be within the tolerances, while a difference of 1% is not
+    fixture = validate_HE.fixture_prefixes()[-1]
+    prefix = str(tmp_path / os.path.basename(fixture))
+    for suffix in [".grm.bin", "_phenotypes.phen"]:
+        with open(fixture + suffix, "rb") as source, open(prefix + suffix, "wb") as target:
+            target.write(source.read())
+    covariance, y = validate_HE.read_inputs(prefix)
+    results = vc.HE_regression(covariance=covariance, y=y)
+
+    write_HEreg(gcta_output(prefix), results)
+    assert all(all(close) for _, _, close in validate_HE.compare(prefix))
+
+    results[0]["Estimate"] *= 1.01
+    write_HEreg(gcta_output(prefix), results)
+    assert not all(validate_HE.compare(prefix)[0][2])
@@ -0,0 +1,38 @@
+import logging
+import types
+import msprime
+import numpy as np
+import pytest
+import TAssociationTesting as at
+import TIndividuals as ti
+import TPhenotypes as tp
+
+
+@pytest.fixture
+def trees():
+    # the full ARG has trees with the same covariance, whose results are reused (cached_from)
+    return msprime.sim_ancestry(10, ploidy=1, sequence_length=2e5, recombination_rate=1e-8, population_size=1e4,
+                                random_seed=4, record_full_arg=True)
+
+
+@pytest.mark.parametrize("association_class, kwargs", [
+    (at.TAssociationTesting_trees_score, {}),
+    (at.TAssociationTesting_trees_gcta_HE, {"engine": "native"})])
+def test_workers_give_same_results_as_serial_run(tmp_path, trees, association_class, kwargs):
+    logfile = logging.getLogger("test_workers")
+    inds = ti.Individuals(1, trees.num_samples)
+    phenotypes = tp.Phenotypes(types.SimpleNamespace(number=0), inds, logfile)
+    phenotypes.y = np.random.default_rng(1).normal(size=(inds.num_inds, 2))
+    phenotypes.causal_tree_indeces = []
+
+    results = []
+    for workers in [1, 2]:
+        association = association_class(trees, phenotypes, permutations=5, seed=3, **kwargs)
+        association.run_association(trees, None, inds, str(tmp_path / ("workers" + str(workers))), logfile,
+                                    covariance_type="scaled", skip_first_tree=False, workers=workers)
+        results.append((association.results_table(trees), association.min_p_values_permuted))
+
+    (table_serial, permuted_serial), (table_workers, permuted_workers) = results
+    assert table_serial['cached_from'].notna().any()
+    assert table_serial.equals(table_workers)
+    np.testing.assert_array_equal(permuted_serial, permuted_workers)
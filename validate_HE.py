@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare the in-process Haseman-Elston regression (variance_components.HE_regression) with GCTA --HEreg on the input
+and output files of GCTA runs, as written by TGCTA.HE: <prefix>.grm.bin, <prefix>_phenotypes.phen and
+<prefix>_GRM_covariance_tests.HEreg.
+
+Without prefixes, the fixtures in fixtures/HE are checked: the scaled covariance of a simulated tree (60 haploids)
+with a phenotype without (tree_null) and with (tree_signal) a genetic effect. All fields of HE-CP and HE-SD (Estimate,
+SE_OLS, SE_Jackknife, P_OLS, P_Jackknife) must agree within a relative tolerance of 1e-4 and an absolute tolerance of
+1e-6, GCTA writes its results with about 6 significant digits. Both read the covariance as float32 from .grm.bin.
+The jackknife of GCTA deletes one pair of individuals at a time, as variance_components.HE_jackknife.
+
+With --run_gcta, GCTA is first run on the input files (see TGCTA) to write the .HEreg files, e.g. to create the
+GCTA output of the fixtures. The exit status is 1 if a result differs or the GCTA output of a prefix is missing.
+tests/test_validate_HE.py runs the same comparison for the fixtures that have GCTA output.
+
+usage: python validate_HE.py [--run_gcta] [--gcta_executable path] [prefix ...]
+"""
+import argparse
+import glob
+import os
+import sys
+import numpy as np
+import pandas as pd
+import variance_components as vc
+import TGCTA
+
+fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "HE")
+fields = ["Estimate", "SE_OLS", "SE_Jackknife", "P_OLS", "P_Jackknife"]
+relative_tolerance = 1e-4
+absolute_tolerance = 1e-6
+
+
+def read_grm_bin(prefix, num_inds):
+    # lower triangle including the diagonal, row by row, as float32
+    values = np.fromfile(prefix + ".grm.bin", dtype=np.float32).astype(float)
+    covariance = np.zeros([num_inds, num_inds])
+    covariance[np.tril_indices(num_inds)] = values
+    return covariance + np.tril(covariance, -1).T
+
+
+def fixture_prefixes():
+    return sorted(file_name[:-len(".grm.bin")] for file_name in glob.glob(os.path.join(fixtures, "*.grm.bin")))
+
+
+def read_inputs(prefix):
+    y = pd.read_csv(prefix + "_phenotypes.phen", sep=r"\s+", header=None)[2].to_numpy()
+    return read_grm_bin(prefix, len(y)), y
+
+
+def compare(prefix):
+    """
+    Compare the native HE regression with the GCTA output of prefix.
+
+    Returns
+    -------
+    list with one tuple (method, relative differences of the fields, whether each field is within the tolerances)
+    for HE-CP and HE-SD
+    """
+    covariance, y = read_inputs(prefix)
+    native = vc.HE_regression(covariance=covariance, y=y)
+    gcta_results = TGCTA.TGCTA.parse_HEreg(prefix + "_GRM_covariance_tests.HEreg")
+    comparison = []
+    for method, gcta_result, result in zip(["HE-CP", "HE-SD"], gcta_results, native):
+        diffs = [abs(result[f] - gcta_result[f]) / max(abs(gcta_result[f]), 1e-300) for f in fields]
+        close = [np.isclose(result[f], gcta_result[f], rtol=relative_tolerance, atol=absolute_tolerance) for f in
+                 fields]
+        comparison.append((method, diffs, close))
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the in-process HE regression with GCTA --HEreg")
+    parser.add_argument('prefixes', nargs='*', help="Prefixes of the GCTA files, the fixtures in fixtures/HE if none")
+    parser.add_argument('--run_gcta', action='store_true', help="Run GCTA to write the .HEreg files first")
+    parser.add_argument('--gcta_executable', type=str, help="Path of the GCTA executable, see TGCTA")
+    args = parser.parse_args()
+
+    gcta = TGCTA.TGCTA(executable=args.gcta_executable) if args.run_gcta else None
+    prefixes = args.prefixes if len(args.prefixes) > 0 else fixture_prefixes()
+
+    passed = True
+    print("prefix", "method", *["rel_diff_" + f for f in fields], sep="\t")
+    for prefix in prefixes:
+        if gcta is not None and gcta.HE(prefix) is None:
+            print(prefix, "GCTA failed, see " + prefix + "_tmp.out", sep="\t")
+            passed = False
+            continue
+        output = prefix + "_GRM_covariance_tests.HEreg"
+        if not os.path.exists(output):
+            print(prefix, "missing GCTA output " + output + ", run with --run_gcta to create it", sep="\t")
+            passed = False
+            continue
+
+        for method, diffs, close in compare(prefix):
+            passed &= all(close)
+            print(prefix, method, *["%.2e" % d for d in diffs], "ok" if all(close) else "FAILED", sep="\t")
+
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
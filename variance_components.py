@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Estimation of the variance explained by a covariance matrix, done in-process instead of calling GCTA.
+
+Haseman-Elston regression as in GCTA --HEreg: the phenotype is standardized and for all pairs of individuals i < j
+the cross-product y_i * y_j (HE-CP) or the squared difference (y_i - y_j)^2 (HE-SD) is regressed on the covariance
+A_ij. The HE-CP slope and minus half the HE-SD slope estimate V(G)/Vp. The results have the same fields as the
+V(G)/Vp line of the GCTA .HEreg output.
+
+REML as in GCTA --reml, see REML. The results have the same fields as the GCTA .hsq file.
+
+Variance-component score test, see score_test. Nothing is fitted per covariance matrix.
+"""
+
+import numpy as np
+import scipy.optimize
+import scipy.stats
+
+
+def standardize(y):
+    """
+    Standardize phenotype to mean 0 and variance 1 as GCTA does for HE regression (sample variance). A matrix is
+    standardized by column.
+    """
+    y = np.asarray(y, dtype=float)
+    return (y - np.mean(y, axis=0)) / np.std(y, axis=0, ddof=1)
+
+
+def covariance_moments(covariance, y):
+    """
+    Sums over the covariance needed by HE_statistics_from_moments. They only require products of the covariance with
+    vectors, its diagonal and its Frobenius norm, so covariance can be a dense np.array or a TTree.TFactoredCovariance
+    (see TTree.TIncrementalBranchSums for the same sums calculated from the branches of a tree).
+
+    Parameters
+    ----------
+    covariance : np.array or TFactoredCovariance
+        Covariance between individuals.
+    y : np.array
+        Phenotype, or matrix with one phenotype per column.
+
+    Returns
+    -------
+    dict with the sum of all entries, the trace, the sum of the squared diagonal and the squared Frobenius norm of the
+    covariance, and (one per phenotype) y^T K y, sum_i K_ii y_i^2 and sum_ij K_ij y_i^2.
+    """
+    N = len(y)
+    if isinstance(covariance, np.ndarray):
+        diagonal = np.diagonal(covariance)
+        row_sums = covariance.sum(axis=1)
+        covariance_y = covariance @ y
+        frobenius_squared = np.sum(covariance ** 2)
+    else:
+        diagonal = covariance.diagonal()
+        row_sums = covariance.matvec(np.ones(N))
+        covariance_y = covariance.matvec(y)
+        frobenius_squared = covariance.frobenius_norm() ** 2
+
+    if y.ndim == 2:
+        diagonal = diagonal[:, np.newaxis]
+        row_sums = row_sums[:, np.newaxis]
+
+    return {'sum': np.sum(row_sums),
+            'trace': np.sum(diagonal),
+            'diagonal_squared': np.sum(diagonal ** 2),
+            'frobenius_squared': frobenius_squared,
+            'yKy': np.sum(y * covariance_y, axis=0),
+            'diagonal_y_squared': np.sum(diagonal * y ** 2, axis=0),
+            'row_sums_y_squared': np.sum(row_sums * y ** 2, axis=0)}
+
+
+def HE_statistics_from_moments(moments, y):
+    """
+    Sums over all pairs i < j needed for the OLS fit of the two HE regressions, from the sums over the covariance of
+    covariance_moments and the standardized phenotype y (a vector, or a matrix with one phenotype per column, in which
+    case the phenotype dependent statistics are np.arrays).
+
+    Returns
+    -------
+    dict with the number of pairs n, the sums of the covariance Sx and Sxx, and the sums Sz, Szz and Sxz of the
+    dependent variable of HE-CP and HE-SD.
+    """
+    N = len(y)
+    S1 = np.sum(y, axis=0)
+    S2 = np.sum(y ** 2, axis=0)
+    S3 = np.sum(y ** 3, axis=0)
+    S4 = np.sum(y ** 4, axis=0)
+
+    statistics = {'n': N * (N - 1) / 2.0,
+                  'Sx': (moments['sum'] - moments['trace']) / 2.0,
+                  'Sxx': (moments['frobenius_squared'] - moments['diagonal_squared']) / 2.0}
+
+    # cross-products y_i * y_j
+    statistics['Sz_CP'] = (S1 ** 2 - S2) / 2.0
+    statistics['Szz_CP'] = (S2 ** 2 - S4) / 2.0
+    statistics['Sxz_CP'] = (moments['yKy'] - moments['diagonal_y_squared']) / 2.0
+
+    # squared differences (y_i - y_j)^2 = y_i^2 + y_j^2 - 2 y_i y_j
+    statistics['Sz_SD'] = N * S2 - S1 ** 2
+    statistics['Szz_SD'] = N * S4 - 4 * S3 * S1 + 3 * S2 ** 2
+    statistics['Sxz_SD'] = moments['row_sums_y_squared'] - moments['diagonal_y_squared'] - 2 * statistics['Sxz_CP']
+
+    return statistics
+
+
+def HE_sufficient_statistics(covariance, y):
+    """
+    Sums over all pairs i < j needed for the OLS fit of the two HE regressions, see covariance_moments and
+    HE_statistics_from_moments.
+
+    Parameters
+    ----------
+    covariance : np.array or TFactoredCovariance
+        Covariance between individuals.
+    y : np.array
+        Standardized phenotype.
+    """
+    return HE_statistics_from_moments(covariance_moments(covariance, y), y)
+
+
+def _OLS_slope(n, Sx, Sxx, Sz, Szz, Sxz):
+    """
+    Slope, intercept and standard error of the slope of a simple linear regression from its sufficient statistics.
+    The sums of the dependent variable can be np.arrays, one entry per phenotype.
+    """
+    Sxx_centered = Sxx - Sx ** 2 / n
+    Sxz_centered = Sxz - Sx * Sz / n
+    Szz_centered = Szz - Sz ** 2 / n
+    if Sxx_centered <= 0:
+        return np.nan, np.nan, np.nan
+
+    slope = Sxz_centered / Sxx_centered
+    intercept = (Sz - slope * Sx) / n
+    residual_sum_of_squares = np.maximum(Szz_centered - slope * Sxz_centered, 0.0)
+    se = np.sqrt(residual_sum_of_squares / (n - 2) / Sxx_centered)
+
+    return slope, intercept, se
+
+
+def HE_jackknife(covariance, y, fits, statistics, chunk_size=256):
+    """
+    Delete-one-pair jackknife standard errors of the HE slopes. Deleting pair k changes the slope by
+    -(x_k - mean(x)) * e_k / (Sxx_centered * (1 - h_k)), with e_k the residual and h_k the leverage of the pair, so
+    all pairs are processed in chunks of rows of the covariance without refitting.
+
+    Parameters
+    ----------
+    covariance : np.array
+    y : np.array
+        Standardized phenotype.
+    fits : dict
+        (slope, intercept, se) for 'CP' and 'SD'.
+    statistics : dict
+        Output of HE_sufficient_statistics.
+    chunk_size : int
+
+    Returns
+    -------
+    dict with the jackknife standard errors of the slopes for 'CP' and 'SD'.
+    """
+    n = statistics['n']
+    x_mean = statistics['Sx'] / n
+    Sxx_centered = statistics['Sxx'] - statistics['Sx'] ** 2 / n
+
+    N = len(y)
+    sum_deltas = {'CP': 0.0, 'SD': 0.0}
+    sum_deltas_squared = {'CP': 0.0, 'SD': 0.0}
+    for start in range(0, N, chunk_size):
+        end = min(start + chunk_size, N)
+        rows, columns = np.nonzero(np.arange(start, end)[:, np.newaxis] < np.arange(N))
+        x = covariance[rows + start, columns]
+        y_i = y[rows + start]
+        y_j = y[columns]
+        leverage = 1.0 / n + (x - x_mean) ** 2 / Sxx_centered
+        for method, z in (('CP', y_i * y_j), ('SD', (y_i - y_j) ** 2)):
+            slope, intercept, _ = fits[method]
+            residuals = z - intercept - slope * x
+            deltas = -(x - x_mean) * residuals / (Sxx_centered * (1 - leverage))
+            sum_deltas[method] += np.sum(deltas)
+            sum_deltas_squared[method] += np.sum(deltas ** 2)
+
+    return {method: np.sqrt((n - 1) / n * (sum_deltas_squared[method] - sum_deltas[method] ** 2 / n)) for method in
+            ('CP', 'SD')}
+
+
+def HE_regression(covariance, y, jackknife=True, chunk_size=256):
+    """
+    Haseman-Elston regression of a phenotype on a covariance matrix, HE-CP and HE-SD as in GCTA --HEreg.
+
+    Parameters
+    ----------
+    covariance : np.array or TFactoredCovariance
+        Covariance between individuals, in the same order as y.
+    y : np.array
+        Phenotype, is standardized here. Without jackknife, a matrix with one phenotype per column can be tested at
+        once.
+    jackknife : bool
+        Calculate jackknife standard errors and p-values. Requires a dense covariance, they are nan otherwise.
+    chunk_size : int
+        Number of rows of the covariance processed at once by the jackknife.
+
+    Returns
+    -------
+    HE_CP, HE_SD : dicts with fields Estimate, SE_OLS, SE_Jackknife, P_OLS and P_Jackknife for V(G)/Vp
+    """
+    y = standardize(y)
+    statistics = HE_sufficient_statistics(covariance, y)
+    return HE_regression_from_statistics(statistics, covariance=covariance if jackknife else None, y=y,
+                                         chunk_size=chunk_size)
+
+
+def HE_regression_from_statistics(statistics, covariance=None, y=None, chunk_size=256):
+    """
+    HE-CP and HE-SD results from the sufficient statistics of HE_sufficient_statistics. The jackknife is only
+    calculated if the dense covariance and standardized phenotype are given. Without jackknife, the statistics can be
+    those of several phenotypes, and the fields of the results are then np.arrays.
+    """
+    fits = {method: _OLS_slope(statistics['n'], statistics['Sx'], statistics['Sxx'], statistics['Sz_' + method],
+                               statistics['Szz_' + method], statistics['Sxz_' + method]) for method in ('CP', 'SD')}
+
+    se_jackknife = {'CP': np.nan, 'SD': np.nan}
+    if isinstance(covariance, np.ndarray) and not np.isnan(fits['CP'][0]):
+        se_jackknife = HE_jackknife(covariance=covariance, y=y, fits=fits, statistics=statistics,
+                                    chunk_size=chunk_size)
+
+    results = []
+    # V(G)/Vp is minus half the slope for HE-SD
+    for method, factor in (('CP', 1.0), ('SD', -0.5)):
+        slope, _, se = fits[method]
+        results.append({'Estimate': factor * slope,
+                        'SE_OLS': abs(factor) * se,
+                        'SE_Jackknife': abs(factor) * se_jackknife[method],
+                        'P_OLS': scipy.stats.chi2.sf((slope / se) ** 2, 1),
+                        'P_Jackknife': scipy.stats.chi2.sf((slope / se_jackknife[method]) ** 2, 1)})
+
+    return results[0], results[1]
+
+
+def _REML_profile(h_squared, eigenvalues, y_rotated, x_rotated):
+    """
+    REML log-likelihood with Vp profiled out, for the model V = Vp * (h_squared * K + (1 - h_squared) * I) and the
+    mean as only fixed effect. In the eigenbasis of K the model is diagonal with entries
+    D = h_squared * eigenvalues + 1 - h_squared.
+
+    Returns
+    -------
+    logL : log-likelihood as reported by GCTA, -0.5 * (log|V| + log|X^T V^-1 X| + y^T P y)
+    Vp : maximum likelihood estimate of Vp for h_squared
+    """
+    D = h_squared * eigenvalues + 1 - h_squared
+    if np.any(D <= 0):
+        return -np.inf, np.nan
+    weights = 1.0 / D
+    x_weighted = np.sum(x_rotated ** 2 * weights)
+    mean = np.sum(x_rotated * y_rotated * weights) / x_weighted
+    yPy = np.sum((y_rotated - x_rotated * mean) ** 2 * weights)
+
+    degrees_of_freedom = len(y_rotated) - 1
+    Vp = yPy / degrees_of_freedom
+    logL = -0.5 * (degrees_of_freedom * np.log(Vp) + np.sum(np.log(D)) + np.log(x_weighted) + degrees_of_freedom)
+
+    return logL, Vp
+
+
+def _REML_information(V_G, V_e, eigenvalues, x_rotated):
+    """
+    REML Fisher information of (V(G), V(e)), I_kl = 0.5 * tr(P V_k P V_l) with V_G = K and V_e = I. In the eigenbasis
+    P = W - w w^T / c with W = diag(1 / (V_G * eigenvalues + V_e)), w = W x and c = x^T W x, so the traces only need
+    sums over the individuals.
+    """
+    W = 1.0 / (V_G * eigenvalues + V_e)
+    w = W * x_rotated
+    c = np.sum(w * x_rotated)
+
+    derivatives = [eigenvalues, np.ones(len(eigenvalues))]
+    information = np.empty([2, 2])
+    for k in range(2):
+        for l in range(2):
+            a = derivatives[k]
+            b = derivatives[l]
+            trace = np.sum((W ** 2 - 2 * W * w ** 2 / c) * a * b) + np.sum(w ** 2 * a) * np.sum(w ** 2 * b) / c ** 2
+            information[k, l] = 0.5 * trace
+
+    return information
+
+
+def REML_eigendecomposition(covariance):
+    """
+    Eigendecomposition of the covariance used by REML, can be shared between phenotypes.
+    """
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    return np.clip(eigenvalues, 0, None), eigenvectors
+
+
+def REML(covariance, y, eigendecomposition=None):
+    """
+    REML estimate of the variance explained by a covariance matrix, y = mean + g + e with var(g) = V(G) * K and
+    var(e) = V(e) * I, as in GCTA --reml. K is eigendecomposed once, then the likelihood is maximized over
+    h^2 = V(G) / Vp in [0, 1] with Vp profiled out. The p-value is that of GCTA for one variance component, half the
+    chi2 (1 df) tail probability of the LRT against the model without K. Standard errors are from the inverse of the
+    REML Fisher information.
+
+    Parameters
+    ----------
+    covariance : np.array
+        Covariance between individuals, in the same order as y.
+    y : np.array
+        Phenotype.
+    eigendecomposition : tuple
+        Output of REML_eigendecomposition(covariance), calculated here if None.
+
+    Returns
+    -------
+    variance : dict with entries V(G), V(e), Vp, V(G)/Vp, logL, logL0, LRT and Pval (the Variance column of the GCTA
+        .hsq file)
+    SE : dict with the standard errors of V(G), V(e), Vp and V(G)/Vp
+    """
+    y = np.asarray(y, dtype=float)
+    if eigendecomposition is None:
+        eigendecomposition = REML_eigendecomposition(covariance)
+    eigenvalues, eigenvectors = eigendecomposition
+    y_rotated = eigenvectors.T @ y
+    x_rotated = eigenvectors.T @ np.ones(len(y))
+
+    def negative_logL(h_squared):
+        return -_REML_profile(h_squared, eigenvalues, y_rotated, x_rotated)[0]
+
+    optimum = scipy.optimize.minimize_scalar(negative_logL, bounds=(0.0, 1.0), method="bounded",
+                                             options={'xatol': 1e-8})
+    # the bounded search does not evaluate the boundaries
+    candidates = [optimum.x, 0.0, 1.0]
+    h_squared = candidates[int(np.argmin([negative_logL(h) for h in candidates]))]
+
+    logL, Vp = _REML_profile(h_squared, eigenvalues, y_rotated, x_rotated)
+    logL0, _ = _REML_profile(0.0, eigenvalues, y_rotated, x_rotated)
+    LRT = max(2 * (logL - logL0), 0.0)
+
+    variance = {'V(G)': h_squared * Vp,
+                'V(e)': (1 - h_squared) * Vp,
+                'Vp': Vp,
+                'V(G)/Vp': h_squared,
+                'logL': logL,
+                'logL0': logL0,
+                'LRT': LRT,
+                'Pval': 0.5 * scipy.stats.chi2.sf(LRT, 1)}
+
+    SE = {'V(G)': np.nan, 'V(e)': np.nan, 'Vp': np.nan, 'V(G)/Vp': np.nan}
+    try:
+        sampling_covariance = np.linalg.inv(
+            _REML_information(variance['V(G)'], variance['V(e)'], eigenvalues, x_rotated))
+    except np.linalg.LinAlgError:
+        return variance, SE
+
+    # delta method for Vp = V(G) + V(e) and V(G) / Vp
+    gradient_Vp = np.array([1.0, 1.0])
+    gradient_h_squared = np.array([variance['V(e)'], -variance['V(G)']]) / Vp ** 2
+    SE['V(G)'] = np.sqrt(sampling_covariance[0, 0])
+    SE['V(e)'] = np.sqrt(sampling_covariance[1, 1])
+    SE['Vp'] = np.sqrt(gradient_Vp @ sampling_covariance @ gradient_Vp)
+    SE['V(G)/Vp'] = np.sqrt(gradient_h_squared @ sampling_covariance @ gradient_h_squared)
+
+    return variance, SE
+
+
+def score_test(covariance, y):
+    """
+    Variance-component score test of V(G) = 0 for y = mean + g + e with var(g) = V(G) * K. Under the null model
+    (intercept only), the statistic is Q = e^T K e / s^2, with e the centered phenotype and s^2 its sample variance.
+    With P = I - 11^T / n and A = P K P, e / |e| is uniform on the sphere orthogonal to 1, so Q has mean tr(A) and
+    variance 2 ((n - 1) tr(A^2) - tr(A)^2) / (n + 1). The p-value matches these moments with a scaled chi2
+    (Satterthwaite). tr(A) and tr(A^2) only require K1, the trace and the Frobenius norm of K, so covariance can be a
+    dense np.array or a TTree.TFactoredCovariance.
+
+    Parameters
+    ----------
+    covariance : np.array or TFactoredCovariance
+        Covariance between individuals, in the same order as y.
+    y : np.array
+        Phenotype, or matrix of dimension num_inds x num_phenotypes.
+
+    Returns
+    -------
+    dict with entries Q, scale, df and Pval, np.arrays of length num_phenotypes if y is a matrix
+    """
+    y = np.asarray(y, dtype=float)
+    N = y.shape[0]
+    e = y - np.mean(y, axis=0)
+    if isinstance(covariance, np.ndarray):
+        trace = np.trace(covariance)
+        row_sums = covariance.sum(axis=1)
+        covariance_e = covariance @ e
+        frobenius_squared = np.sum(covariance ** 2)
+    else:
+        trace = covariance.trace()
+        row_sums = covariance.matvec(np.ones(N))
+        covariance_e = covariance.matvec(e)
+        frobenius_squared = covariance.frobenius_norm() ** 2
+
+    total = np.sum(row_sums)
+    trace_A = trace - total / N
+    trace_A_squared = frobenius_squared - 2 * np.sum(row_sums ** 2) / N + (total / N) ** 2
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Q = (N - 1) * np.sum(e * covariance_e, axis=0) / np.sum(e ** 2, axis=0)
+        variance = 2 * ((N - 1) * trace_A_squared - trace_A ** 2) / (N + 1)
+        scale = variance / (2 * trace_A)
+        df = 2 * trace_A ** 2 / variance
+
+    return {'Q': Q,
+            'scale': scale,
+            'df': df,
+            'Pval': scipy.stats.chi2.sf(Q / scale, df)}